@@ -0,0 +1 @@
+"""Benchmarks for morphoeval on synthetic data (run with python -m benchmarks)"""
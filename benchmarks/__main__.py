@@ -0,0 +1,137 @@
+"""Command-line interface for the benchmarks"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from morphoeval.evaluation import METRICS
+
+from .loading import run_loading
+from .runner import SCALES, compare_results, read_results, run_benchmarks
+from .startup import check_budget, run_startup
+from .synthetic import generate_corpus, write_analyses
+
+
+def print_comparison(comparison, threshold):
+    """Print a comparison table and return the number of regressions"""
+    print(f"{'scale':8} {'phase':24} {'time':>8} {'memory':>8}  status")
+    n_regressions = 0
+    for scale, phase, time_ratio, memory_ratio, status in comparison:
+        memory = f'{memory_ratio:8.2f}' if memory_ratio is not None else f"{'-':>8}"
+        print(f"{scale:8} {phase:24} {time_ratio:8.2f} {memory}  {status}")
+        n_regressions += status in ('slower', 'more memory')
+    if n_regressions:
+        print(f"{n_regressions} phases regressed more than {threshold}x")
+    return n_regressions
+
+
+def main(argv=None):
+    """Main method"""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmarks for morphoeval')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    generate = subparsers.add_parser('generate', help='write a synthetic gold standard and predictions')
+    generate.add_argument('--words', metavar='INT', type=int, default=10000, help='number of words (default 10000)')
+    generate.add_argument('--stems', metavar='INT', type=int, default=None, help='number of stems (default words / 3)')
+    generate.add_argument('--affixes', metavar='INT', type=int, default=200, help='number of affixes (default 200)')
+    generate.add_argument('--hubs', metavar='INT', type=int, default=5,
+                          help='number of very frequent affixes (default 5)')
+    generate.add_argument('--hub-share', metavar='FLOAT', type=float, default=0.3,
+                          help='share of the affix occurrences that go to the hubs (default 0.3)')
+    generate.add_argument('--exponent', metavar='FLOAT', type=float, default=1.1,
+                          help='exponent of the Zipfian morph distributions (default 1.1)')
+    generate.add_argument('--alternatives', metavar='INT', type=int, default=3,
+                          help='maximum number of alternative analyses per word (default 3)')
+    generate.add_argument('--alternative-rate', metavar='FLOAT', type=float, default=0.1,
+                          help='share of words with alternative analyses (default 0.1)')
+    generate.add_argument('--error-rate', metavar='FLOAT', type=float, default=0.15,
+                          help='rate of segmentation errors in the predictions (default 0.15)')
+    generate.add_argument('--seed', metavar='INT', type=int, default=0, help='random seed (default 0)')
+    generate.add_argument('goldfile', help='output file for the gold standard')
+    generate.add_argument('predfile', help='output file for the predictions')
+    run = subparsers.add_parser('run', help='time each phase and metric at several scales')
+    run.add_argument('--scale', '-s', action='append', choices=list(SCALES),
+                     help=f"scale to run ({', '.join(f'{name}: {size} words' for name, size in SCALES.items())}); "
+                     "can be repeated (default tiny and small)")
+    run.add_argument('--metric', '-m', action='append', choices=METRICS,
+                     help='metric to run; can be repeated (default all)')
+    run.add_argument('--repeat', metavar='INT', type=int, default=3,
+                     help='number of timed runs of each phase (default 3)')
+    run.add_argument('--no-memory', action='store_true', help='do not measure the peak memory with tracemalloc')
+    run.add_argument('--seed', metavar='INT', type=int, default=0, help='seed of the synthetic data (default 0)')
+    run.add_argument('--data-dir', metavar='DIR', default=None,
+                     help='keep the generated data in DIR for later runs (default a temporary directory)')
+    run.add_argument('--baseline', metavar='FILE', default=None, help='compare the results against FILE')
+    run.add_argument('--threshold', metavar='FLOAT', type=float, default=1.25,
+                     help='ratio to the baseline considered a regression (default 1.25)')
+    run.add_argument('--output', '-o', metavar='FILE', default=None, help='write the results as JSON to FILE')
+    load = subparsers.add_parser('load', help='compare the loaders of analysis files')
+    load.add_argument('--scale', '-s', action='append', choices=list(SCALES),
+                      help='scale of the gold standard file; can be repeated (default medium)')
+    load.add_argument('--workers', '-w', metavar='INT', type=int, action='append',
+                      help='number of processes of the parallel loader; can be repeated (default the number of CPUs)')
+    load.add_argument('--repeat', metavar='INT', type=int, default=3,
+                      help='number of timed runs of each loader (default 3)')
+    load.add_argument('--seed', metavar='INT', type=int, default=0, help='seed of the synthetic data (default 0)')
+    load.add_argument('--data-dir', metavar='DIR', default=None,
+                      help='keep the generated data in DIR for later runs (default a temporary directory)')
+    load.add_argument('--output', '-o', metavar='FILE', default=None, help='write the results as JSON to FILE')
+    startup = subparsers.add_parser('startup', help='time the start-up of the package and the command line')
+    startup.add_argument('--repeat', metavar='INT', type=int, default=5,
+                         help='number of timed runs of each command (default 5)')
+    startup.add_argument('--budget', metavar='SECONDS', type=float, default=None,
+                         help='exit with an error if a command takes longer than SECONDS or imports '
+                         'unneeded heavy modules')
+    startup.add_argument('--data-dir', metavar='DIR', default=None,
+                         help='keep the generated data in DIR for later runs (default a temporary directory)')
+    startup.add_argument('--output', '-o', metavar='FILE', default=None, help='write the results as JSON to FILE')
+    compare = subparsers.add_parser('compare', help='compare benchmark results against a baseline')
+    compare.add_argument('--threshold', metavar='FLOAT', type=float, default=1.25,
+                         help='ratio to the baseline considered a regression (default 1.25)')
+    compare.add_argument('baseline', help='baseline results')
+    compare.add_argument('results', help='new results')
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        gold, pred = generate_corpus(args.words, n_stems=args.stems, n_affixes=args.affixes, n_hubs=args.hubs,
+                                     hub_share=args.hub_share, exponent=args.exponent,
+                                     alternative_rate=args.alternative_rate, max_alternatives=args.alternatives,
+                                     error_rate=args.error_rate, seed=args.seed)
+        write_analyses(args.goldfile, gold)
+        write_analyses(args.predfile, pred)
+        return
+    if args.command == 'compare':
+        sys.exit(1 if print_comparison(compare_results(read_results(args.baseline), read_results(args.results),
+                                                       threshold=args.threshold), args.threshold) else 0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_dir = args.data_dir or tmpdir
+        os.makedirs(data_dir, exist_ok=True)
+        if args.command == 'load':
+            results = run_loading(args.scale or ['medium'], data_dir, workers=args.workers, repeat=args.repeat,
+                                  seed=args.seed, log=lambda line: print(line, file=sys.stderr))
+        elif args.command == 'startup':
+            results = run_startup(data_dir, repeat=args.repeat, log=lambda line: print(line, file=sys.stderr))
+        else:
+            results = run_benchmarks(args.scale or ['tiny', 'small'], args.metric or METRICS, data_dir,
+                                     repeat=args.repeat, memory=not args.no_memory, seed=args.seed,
+                                     log=lambda line: print(line, file=sys.stderr))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fobj:
+            json.dump(results, fobj, indent=1)
+    if args.command == 'load':
+        sys.exit(0 if all(result['identical'] for result in results['results']) else 1)
+    if args.command == 'startup':
+        if args.budget is not None:
+            messages = check_budget(results, args.budget)
+            for message in messages:
+                print(message)
+            sys.exit(1 if messages else 0)
+        return
+    if args.baseline:
+        sys.exit(1 if print_comparison(compare_results(read_results(args.baseline), results,
+                                                       threshold=args.threshold), args.threshold) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Throughput of loading analysis files
+
+The bulk parser of AnalysisSet.load and its parallel variant
+load_parallel are compared with a reference loader that adds the
+analyses line by line, like the original implementation did. All
+loaders must give the same words, morphs, and morph ids.
+
+"""
+
+import os
+
+import numpy as np
+
+from morphoeval.common import AnalysisSet
+
+from .runner import SCALES, corpus_files, environment, measure
+
+
+def load_lines(path):
+    """Load an analysis file one line and alternative at a time (the reference)"""
+    aset = AnalysisSet()
+    with open(path, encoding='utf-8') as fobj:
+        for line in fobj:
+            if line[0] == '#':
+                continue
+            word, rest = line.rstrip('\n').split('\t')
+            for alternative in rest.split(', '):
+                aset.add(word, alternative.split())
+    return aset
+
+
+def load_chunked(path):
+    """Load an analysis file with the bulk parser in a single process"""
+    aset = AnalysisSet()
+    with open(path, encoding='utf-8') as fobj:
+        aset.load(fobj)
+    return aset
+
+
+def load_parallel(path, workers):
+    """Load an analysis file in byte ranges parsed by worker processes"""
+    aset = AnalysisSet()
+    aset.load_parallel(path, workers, encoding='utf-8')
+    return aset
+
+
+def same_analyses(aset, other):
+    """Return whether two analysis sets have the same words, morphs, and morph ids"""
+    return aset.words == other.words and aset.morph_list == other.morph_list and \
+        all(np.array_equal(getattr(aset, name), getattr(other, name))
+            for name in ('word_offsets', 'alt_offsets', 'morph_ids'))
+
+
+def run_loading(scales, data_dir, workers=None, repeat=3, seed=0, log=None):
+    """Time the loaders on the gold standard files of the scales
+
+    Each result has the speedup over the reference loader and tells
+    whether the loaded set equals the reference. The parallel loader
+    is run with the given numbers of workers (default the number of
+    CPUs). The results have the same format as those of
+    runner.run_benchmarks.
+
+    """
+    workers = workers or [os.cpu_count() or 1]
+    results = []
+    for scale in scales:
+        gold_path, _ = corpus_files(scale, data_dir, seed=seed)
+        loaders = [('load:lines', lambda: load_lines(gold_path)), ('load:chunked', lambda: load_chunked(gold_path))]
+        loaders.extend((f'load:parallel-{count}', lambda count=count: load_parallel(gold_path, count))
+                       for count in workers)
+        reference_time = reference = None
+        for name, func in loaders:
+            result, aset = measure(func, repeat=repeat, memory=False)
+            if reference is None:
+                reference_time, reference = result['wall_time'], aset
+            result.update(scale=scale, n_words=SCALES[scale], phase=name,
+                          speedup=reference_time / max(result['wall_time'], 1e-9),
+                          identical=same_analyses(aset, reference))
+            results.append(result)
+            if log:
+                log(f"{scale:8} {name:24} {result['wall_time']:10.4f} s {result['speedup']:6.2f}x"
+                    + ('' if result['identical'] else ' DIFFERENT'))
+    return {'environment': environment(), 'seed': seed, 'repeat': repeat, 'results': results}
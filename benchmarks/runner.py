@@ -0,0 +1,148 @@
+"""Timing and memory measurements of the evaluation phases"""
+
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+from morphoeval.common import AnalysisSet
+from morphoeval.evaluation import evaluate
+
+from .synthetic import generate_corpus, write_analyses
+
+
+# Numbers of words in the synthetic corpora of each scale
+SCALES = {'tiny': 1000, 'small': 10000, 'medium': 100000, 'large': 1000000}
+
+
+def corpus_files(scale, data_dir, seed=0):
+    """Return the gold and predicted files of a scale, generating them if needed"""
+    gold_path = os.path.join(data_dir, f'{scale}-{seed}.gold.txt')
+    pred_path = os.path.join(data_dir, f'{scale}-{seed}.pred.txt')
+    if not (os.path.exists(gold_path) and os.path.exists(pred_path)):
+        gold, pred = generate_corpus(SCALES[scale], seed=seed)
+        write_analyses(gold_path, gold)
+        write_analyses(pred_path, pred)
+    return gold_path, pred_path
+
+
+def measure(func, repeat=3, memory=True):
+    """Return the wall times, CPU time, and peak traced memory of calls of func
+
+    The function is called repeat times without tracing memory, and
+    once more with tracemalloc if memory is True. Returns a dictionary
+    and the value of the last call.
+
+    """
+    wall_times, cpu_times = [], []
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        value = func()
+        wall_times.append(time.perf_counter() - wall)
+        cpu_times.append(time.process_time() - cpu)
+    result = {'wall_time': min(wall_times), 'wall_time_median': statistics.median(wall_times),
+              'wall_times': wall_times, 'cpu_time': min(cpu_times)}
+    if memory:
+        tracemalloc.start()
+        try:
+            value = func()
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, value
+
+
+def phases(gold_path, pred_path, metrics):
+    """Yield the names and functions of the benchmarked phases
+
+    The loading phases return the analysis sets used by the later
+    phases, so they are run first.
+
+    """
+    sets = {}
+
+    def load_gold():
+        sets['gold'] = AnalysisSet.from_file(gold_path)
+        return sets['gold']
+
+    def load_pred():
+        sets['pred'] = AnalysisSet.from_file(pred_path, vocab=sets['gold'])
+        return sets['pred']
+
+    def word_morpheme_matrices():
+        windex = sets['pred'].get_word_index()
+        return (sets['gold'].to_word_morpheme_matrix(windex), sets['pred'].to_word_morpheme_matrix(windex))
+
+    def word_graph():
+        return sets['pred'].to_word_matrix(sets['pred'].get_word_index())
+
+    yield 'load-gold', load_gold
+    yield 'load-pred', load_pred
+    yield 'word-morpheme-matrices', word_morpheme_matrices
+    yield 'word-graph', word_graph
+    for metric in metrics:
+        yield f'metric:{metric}', lambda metric=metric: evaluate(sets['gold'], sets['pred'], [metric])
+
+
+def environment():
+    """Return a description of the environment of the benchmark"""
+    return {'python': sys.version.split()[0], 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def run_benchmarks(scales, metrics, data_dir, repeat=3, memory=True, seed=0, log=None):
+    """Run the benchmarks and return the results as a dictionary"""
+    results = []
+    for scale in scales:
+        gold_path, pred_path = corpus_files(scale, data_dir, seed=seed)
+        for phase, func in phases(gold_path, pred_path, metrics):
+            result, _ = measure(func, repeat=repeat, memory=memory)
+            result.update(scale=scale, n_words=SCALES[scale], phase=phase)
+            results.append(result)
+            if log:
+                log(f"{scale:8} {phase:24} {result['wall_time']:10.4f} s"
+                    + (f" {result['peak_memory'] / 2**20:10.1f} MiB" if memory else ''))
+    return {'environment': environment(), 'seed': seed, 'repeat': repeat, 'results': results}
+
+
+def compare_results(baseline, current, threshold=1.25):
+    """Compare benchmark results against a baseline
+
+    Returns a list of (scale, phase, time ratio, memory ratio, status)
+    tuples for the phases in both, where the status is 'slower' or
+    'more memory' if a ratio exceeds threshold, 'faster' if the time
+    ratio is below its inverse, and 'ok' otherwise. The memory ratio
+    is None if either result lacks memory measurements.
+
+    """
+    base = {(item['scale'], item['phase']): item for item in baseline['results']}
+    comparison = []
+    for item in current['results']:
+        key = (item['scale'], item['phase'])
+        if key not in base:
+            continue
+        time_ratio = item['wall_time'] / max(base[key]['wall_time'], 1e-9)
+        memory_ratio = None
+        if 'peak_memory' in item and 'peak_memory' in base[key]:
+            memory_ratio = item['peak_memory'] / max(base[key]['peak_memory'], 1)
+        status = 'ok'
+        if time_ratio > threshold:
+            status = 'slower'
+        elif memory_ratio is not None and memory_ratio > threshold:
+            status = 'more memory'
+        elif time_ratio < 1 / threshold:
+            status = 'faster'
+        comparison.append((*key, time_ratio, memory_ratio, status))
+    return comparison
+
+
+def read_results(path):
+    """Read benchmark results from a JSON file"""
+    with open(path, encoding='utf-8') as fobj:
+        return json.load(fobj)
@@ -0,0 +1,87 @@
+"""Start-up time of the package and the command-line interface
+
+Short evaluations spend much of their time in importing modules, so
+the start-up is measured by running fresh interpreters: importing the
+package, printing the help of the command-line interface, and a BPR
+evaluation of a small synthetic corpus.
+
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+from .runner import corpus_files
+
+
+# Modules that should not be imported by the commands, as they are not needed
+HEAVY_MODULES = {
+    'import': ['numpy', 'scipy', 'munkres', 'tqdm', 'ruamel.yaml'],
+    'help': ['scipy', 'munkres', 'tqdm', 'ruamel.yaml', 'cProfile'],
+    'bpr': ['scipy', 'munkres', 'cProfile'],
+}
+
+# Code run in the measured interpreter; prints the heavy modules that were imported
+SCRIPT = """
+import sys
+sys.argv = ['morphoeval'] + {argv!r}
+try:
+    {statement}
+except SystemExit:
+    pass
+print('heavy modules:', *(module for module in {modules!r} if module in sys.modules), file=sys.stderr)
+"""
+
+
+def startup_commands(data_dir, seed=0):
+    """Return the names, statements, and arguments of the measured commands"""
+    gold_path, pred_path = corpus_files('tiny', data_dir, seed=seed)
+    return [
+        ('import', 'import morphoeval', []),
+        ('help', 'from morphoeval.__main__ import main; main()', ['--help']),
+        ('bpr', 'from morphoeval.__main__ import main; main()',
+         ['--metric', 'bpr', gold_path, pred_path, os.devnull]),
+    ]
+
+
+def command_time(name, statement, argv, repeat=5):
+    """Return the wall times of running a statement in fresh interpreters and the heavy modules it imported"""
+    script = SCRIPT.format(argv=argv, statement=statement, modules=HEAVY_MODULES[name])
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', script], stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, text=True, check=True)
+        times.append(time.perf_counter() - start)
+    [line] = [line for line in process.stderr.splitlines() if line.startswith('heavy modules:')]
+    return times, line.split()[2:]
+
+
+def run_startup(data_dir, repeat=5, seed=0, log=None):
+    """Measure the start-up commands and return the results as a dictionary
+
+    The results have the same format as those of runner.run_benchmarks
+    with the scale 'startup', and list the unneeded heavy modules
+    imported by each command.
+
+    """
+    results = []
+    for name, statement, argv in startup_commands(data_dir, seed=seed):
+        times, modules = command_time(name, statement, argv, repeat=repeat)
+        results.append({'scale': 'startup', 'phase': name, 'wall_time': min(times), 'wall_times': times,
+                        'heavy_modules': modules})
+        if log:
+            log(f"{'startup':8} {name:24} {min(times):10.4f} s" + (f" imports {', '.join(modules)}" if modules else ''))
+    return {'repeat': repeat, 'results': results}
+
+
+def check_budget(results, budget):
+    """Return the messages for the commands that took longer than budget seconds or imported heavy modules"""
+    messages = []
+    for item in results['results']:
+        if item['wall_time'] > budget:
+            messages.append(f"{item['phase']} took {item['wall_time']:.3f} s (budget {budget} s)")
+        if item['heavy_modules']:
+            messages.append(f"{item['phase']} imported {', '.join(item['heavy_modules'])}")
+    return messages
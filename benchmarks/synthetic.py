@@ -0,0 +1,114 @@
+"""Synthetic gold standard and predicted segmentations for benchmarking
+
+The words are built from stems and affixes drawn from Zipfian
+distributions. A few very frequent affixes ("hubs") are shared by a
+large part of the words, which makes the word graphs of CoMMA dense
+like in real agglutinative languages. The predictions are made by
+perturbing the gold segmentations: dropping boundaries and splitting
+morphs at random.
+
+"""
+
+import numpy as np
+
+
+ALPHABET = list('abcdefghijklmnopqrstuvwxyz')
+
+
+def zipf_probabilities(size, exponent=1.0):
+    """Return Zipfian probabilities for ranks 1...size"""
+    weights = 1 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+def random_strings(rng, count, min_length, max_length):
+    """Return a list of count distinct random strings"""
+    strings = set()
+    while len(strings) < count:
+        lengths = rng.integers(min_length, max_length + 1, size=count - len(strings))
+        letters = rng.choice(ALPHABET, size=lengths.sum())
+        starts = np.cumsum(lengths) - lengths
+        strings.update(''.join(letters[start:start + length]) for start, length in zip(starts.tolist(), lengths.tolist()))
+    return sorted(strings)[:count]
+
+
+def affix_probabilities(n_affixes, n_hubs, hub_share, exponent):
+    """Return the probabilities of the affixes with hub_share of the mass on the first n_hubs affixes"""
+    probs = zipf_probabilities(n_affixes, exponent) * (1 - hub_share)
+    probs[:n_hubs] += hub_share / n_hubs
+    return probs
+
+
+def perturb(rng, morphs, error_rate):
+    """Return a segmentation with boundaries dropped and morphs split at random"""
+    result = [morphs[0]]
+    for morph in morphs[1:]:
+        if rng.random() < error_rate:
+            result[-1] += morph
+        else:
+            result.append(morph)
+    split = []
+    for morph in result:
+        if len(morph) > 1 and rng.random() < error_rate / 2:
+            point = int(rng.integers(1, len(morph)))
+            split.extend([morph[:point], morph[point:]])
+        else:
+            split.append(morph)
+    return split
+
+
+def generate_corpus(n_words, n_stems=None, n_affixes=200, n_hubs=5, hub_share=0.3, exponent=1.1, max_affixes=3,
+                    alternative_rate=0.1, max_alternatives=3, error_rate=0.15, seed=0):
+    """Return synthetic gold and predicted analyses of n_words words
+
+    Each word is a stem followed by up to max_affixes affixes. The
+    stems and affixes are drawn from Zipfian distributions with the
+    given exponent, and hub_share of the affix occurrences go to the
+    first n_hubs affixes. A share alternative_rate of the words get
+    alternative analyses, up to max_alternatives in total. The
+    predictions perturb the gold analyses with error_rate (see
+    perturb). Returns two dictionaries from words to lists of
+    analyses, each a list of morphs.
+
+    """
+    rng = np.random.default_rng(seed)
+    n_stems = n_stems or max(1, n_words // 3)
+    stems = random_strings(rng, n_stems, 3, 9)
+    affixes = random_strings(rng, n_affixes, 1, 4)
+    stem_probs = zipf_probabilities(n_stems, exponent)
+    affix_probs = affix_probabilities(n_affixes, min(n_hubs, n_affixes), hub_share, exponent)
+    gold = {}
+    while len(gold) < n_words:
+        count = n_words - len(gold)
+        stem_ids = rng.choice(n_stems, size=count, p=stem_probs)
+        n_word_affixes = rng.integers(0, max_affixes + 1, size=count)
+        affix_ids = rng.choice(n_affixes, size=n_word_affixes.sum(), p=affix_probs)
+        starts = np.cumsum(n_word_affixes) - n_word_affixes
+        for stem_id, start, n_affix in zip(stem_ids.tolist(), starts.tolist(), n_word_affixes.tolist()):
+            morphs = [stems[stem_id]] + [affixes[idx] for idx in affix_ids[start:start + n_affix].tolist()]
+            word = ''.join(morphs)
+            if word in gold or len(gold) >= n_words:
+                continue
+            analyses = [morphs]
+            if len(morphs) > 1 and rng.random() < alternative_rate:
+                for _ in range(int(rng.integers(1, max_alternatives))):
+                    alternative = perturb(rng, morphs, 0.5)
+                    if alternative not in analyses:
+                        analyses.append(alternative)
+            gold[word] = analyses
+    pred = {}
+    for word, analyses in gold.items():
+        predicted = [perturb(rng, analyses[0], error_rate)]
+        if rng.random() < alternative_rate:
+            alternative = perturb(rng, analyses[-1], error_rate)
+            if alternative not in predicted:
+                predicted.append(alternative)
+        pred[word] = predicted
+    return gold, pred
+
+
+def write_analyses(path, analyses):
+    """Write analyses in the Morpho Challenge format"""
+    with open(path, 'w', encoding='utf-8') as fobj:
+        for word, alternatives in analyses.items():
+            fobj.write(word + '\t' + ', '.join(' '.join(morphs) for morphs in alternatives) + '\n')
@@ -1,5 +1,32 @@
 """Metrics for morphological analysis and segmentation"""
 
-from .common import AnalysisSet  # noqa: F401
-from .cooccurrence import emma2, comma, comma_strict  # noqa: F401
-from .boundary import bpr, bpr_strict  # noqa: F401
+import importlib
+
+# Public names and the modules defining them; the modules are imported
+# on first access so that importing the package stays fast
+_EXPORTS = {
+    'AnalysisSet': 'common',
+    'emma': 'cooccurrence',
+    'emma2': 'cooccurrence',
+    'comma': 'cooccurrence',
+    'comma_strict': 'cooccurrence',
+    'bpr': 'boundary',
+    'bpr_strict': 'boundary',
+    'evaluate': 'evaluation',
+    'evaluate_words': 'evaluation',
+    'METRICS': 'evaluation',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -2,60 +2,353 @@
 """Command-line interface for morphoeval"""
 
 import argparse
+import contextlib
+import json
 import logging
-
-import ruamel.yaml
+import os
+import signal
+import sys
 
 from .common import AnalysisSet
-from . import comma, comma_strict, emma2, bpr, bpr_strict
+from .evaluation import METRICS, WordScoreWriter, evaluate, evaluate_words, process_word_scores, score_dict
+from .planning import plan_dict
+from .profiling import PhaseRecorder
+from .progress import RateLimited, TqdmProgress
+
+# The modules needed only by some of the commands and options are
+# imported when used to keep the start-up time short
 
 
 logger = logging.getLogger(__name__)
 
 
-def main():
-    """Main method"""
-    parser = argparse.ArgumentParser(description='Evaluation for morphological analysis and segmentation')
-    parser.add_argument('--metric', '-m',
-                        choices=['comma-b0', 'comma-b1', 'comma-s0', 'comma-s1', 'emma-2', 'bpr', 'bpr-s'],
-                        default='comma-b0', help='metric (default %(default)s)')
+def metric_list(value):
+    """Parse a comma-separated list of metrics or 'all'"""
+    if value == 'all':
+        return list(METRICS)
+    metrics = value.split(',')
+    for metric in metrics:
+        if metric not in METRICS:
+            raise argparse.ArgumentTypeError(f"invalid metric: {metric} (choose from {', '.join(METRICS)}, all)")
+    return metrics
+
+
+def parse_size(value):
+    """Parse a memory size in bytes with an optional K, M, G, or T suffix"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    try:
+        if value[-1:].upper() in units:
+            return int(float(value[:-1]) * units[value[-1].upper()])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}") from None
+
+
+def progress_bars(args):
+    """Return a progress callback that shows progress bars unless disabled by the arguments"""
+    return None if args.no_progress else RateLimited(TqdmProgress(), interval=0.1)
+
+
+def gold_spec(value):
+    """Parse a NAME=PATH specification of a gold standard"""
+    name, sep, path = value.partition('=')
+    if not sep or not name or not path:
+        raise argparse.ArgumentTypeError(f"invalid gold standard: {value} (use NAME=PATH)")
+    return name, path
+
+
+def serve_main(argv):
+    """Main method for the server mode"""
+    parser = argparse.ArgumentParser(prog='morphoeval serve',
+                                     description='Run an evaluation server that keeps gold standards in memory')
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port to listen on (default 8765)')
+    parser.add_argument('--socket', metavar='PATH', default=None, help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--gold', metavar='NAME=PATH', type=gold_spec, action='append', default=[],
+                        help='gold standard to load at startup (can be repeated)')
+    parser.add_argument('--memory-limit', metavar='SIZE', type=parse_size, default=None,
+                        help='drop least recently used gold standards from memory above SIZE bytes '
+                        '(suffixes K, M, G, T)')
+    parser.add_argument('--max-concurrent', metavar='INT', type=int, default=1,
+                        help='maximum number of evaluations run at the same time (default 1)')
+    parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                        help='save parsed gold standard files to DIR and load them from there')
+    parser.add_argument('--verbose', '-v', action='store_true', help='increase verbosity')
+    args = parser.parse_args(argv)
+    from .serve import Evaluator, GoldCache, make_server
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    golds = GoldCache(memory_limit=args.memory_limit, cache_dir=args.cache_dir)
+    for name, path in args.gold:
+        golds.register(name, path)
+        golds.get(name)
+    server = make_server(Evaluator(golds, max_concurrent=args.max_concurrent),
+                         host=args.host, port=args.port, socket_path=args.socket)
+    logger.info("Listening on %s", args.socket or f"{args.host}:{args.port}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+def batch_main(argv):
+    """Main method for the batch mode"""
+    parser = argparse.ArgumentParser(prog='morphoeval batch',
+                                     description='Evaluate several prediction files listed in a manifest')
+    parser.add_argument('--format', choices=['yaml', 'json'], default='yaml',
+                        help='output format: a stream of YAML documents or JSON lines (default yaml)')
+    parser.add_argument('--block-size', metavar='INT', type=int, default=None,
+                        help='calculate CoMMA-B word graphs in blocks of INT words to limit memory usage')
+    parser.add_argument('--chunk-size', metavar='INT', type=int, default=None,
+                        help='calculate EMMA and EMMA-2 in chunks of INT words to limit memory usage')
+    parser.add_argument('--jobs', '-j', metavar='INT', type=int, default=None,
+                        help='number of jobs to run in parallel (default 1)')
+    parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                        help='save parsed input files to DIR and load them from there on later runs')
+    parser.add_argument('--verbose', '-v', action='store_true', help='increase verbosity')
+    parser.add_argument('manifest', help='manifest file (YAML or JSON)')
+    parser.add_argument('output', type=argparse.FileType('w'), nargs='?', default='-', help='output file')
+    args = parser.parse_args(argv)
+    import ruamel.yaml
+    from .batch import evaluate_batch, read_manifest
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        jobs = read_manifest(args.manifest)
+    except (OSError, ValueError, ruamel.yaml.YAMLError) as err:
+        parser.error(str(err))
+    ruamel_yaml = ruamel.yaml.YAML(typ='safe', pure=True)
+    ruamel_yaml.explicit_start = True
+    n_failed = 0
+    for result in evaluate_batch(jobs, workers=args.jobs, block_size=args.block_size, cache_dir=args.cache_dir,
+                                 chunk_size=args.chunk_size):
+        n_failed += 'error' in result
+        if args.format == 'json':
+            args.output.write(json.dumps(result) + '\n')
+        else:
+            ruamel_yaml.dump(result, stream=args.output)
+        args.output.flush()
+    if n_failed:
+        logger.warning("%s of %s jobs failed", n_failed, len(jobs))
+        sys.exit(1)
+
+
+def compare_main(argv):
+    """Main method for the paired comparison of two systems"""
+    parser = argparse.ArgumentParser(prog='morphoeval compare',
+                                     description='Compare two predicted analysis files with a paired '
+                                     'approximate randomization test')
+    parser.add_argument('--metric', '-m', type=metric_list, action='append', metavar='METRIC',
+                        help=f"metric: {', '.join(METRICS)}; use a comma-separated list, repeat the option, "
+                        "or use 'all' to compute several metrics (default comma-b0)")
     parser.add_argument('--beta', metavar='FLOAT', type=float, default=1, help='beta for using F_beta score')
+    parser.add_argument('--samples', metavar='INT', type=int, default=10000,
+                        help='number of random resamples (default 10000)')
+    parser.add_argument('--seed', metavar='INT', type=int, default=None, help='seed for the random resamples')
+    parser.add_argument('--block-size', metavar='INT', type=int, default=None,
+                        help='calculate CoMMA-B word graphs in blocks of INT words to limit memory usage')
+    parser.add_argument('--chunk-size', metavar='INT', type=int, default=None,
+                        help='calculate EMMA and EMMA-2 in chunks of INT words to limit memory usage')
+    parser.add_argument('--jobs', '-j', metavar='INT', type=int, default=None,
+                        help='number of worker processes for parsing large files, CoMMA-S and BPR (default 1)')
+    parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                        help='save parsed input files to DIR and load them from there on later runs')
+    parser.add_argument('--no-progress', action='store_true', help='do not show progress bars')
     parser.add_argument('--verbose', '-v', action='store_true', help='increase verbosity')
-    parser.add_argument('goldfile', type=argparse.FileType('r'), help='gold standard analysis file')
-    parser.add_argument('predfile', type=argparse.FileType('r'), help='predicted analysis file')
+    parser.add_argument('goldfile', help="gold standard analysis file (may be compressed)")
+    parser.add_argument('predfiles', nargs=2, metavar='predfile', help="predicted analysis file (may be compressed)")
     parser.add_argument('output', type=argparse.FileType('w'), nargs='?', default='-', help='output file')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    import ruamel.yaml
+    from .significance import align_terms, randomization_test
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    metrics = list(dict.fromkeys(sum(args.metric or [['comma-b0']], [])))
+    progress = progress_bars(args)
+    logger.info("Loading gold standard analyses")
+    goldlist = AnalysisSet.from_file(args.goldfile, cache_dir=args.cache_dir, workers=args.jobs, progress=progress)
+    systems = []
+    for predfile in args.predfiles:
+        logger.info("Evaluating %s", predfile)
+        predlist = AnalysisSet.from_file(predfile, vocab=goldlist, cache_dir=args.cache_dir, workers=args.jobs,
+                                         progress=progress)
+        word_scores = {}
+        results = process_word_scores(
+            evaluate_words(goldlist, predlist, metrics, beta=args.beta, block_size=args.block_size, workers=args.jobs,
+                           chunk_size=args.chunk_size, progress=progress),
+            lambda scores: word_scores.__setitem__(scores.metric, scores))
+        systems.append((results, word_scores))
+    output = {'files': {'reference': args.goldfile, 'predictions': args.predfiles}, 'metrics': {}}
+    for metric in metrics:
+        logger.info("Testing the difference in %s", metric)
+        output['metrics'][metric] = {
+            'scores': [score_dict(*results[metric], beta=args.beta) for results, _ in systems],
+            **randomization_test(*align_terms(*(word_scores[metric] for _, word_scores in systems)),
+                                 args.samples, beta=args.beta, seed=args.seed)}
+    ruamel_yaml = ruamel.yaml.YAML(typ='safe', pure=True)
+    ruamel_yaml.dump(output, stream=args.output)
+
+
+def run_evaluation(args, metrics):
+    """Load the input files and evaluate them as given by the command-line arguments
+
+    Returns the scores of the metrics, the bootstrap or sampling
+    intervals if requested, and the plan of the CoMMA-B word graphs if
+    a memory limit is given.
 
+    """
+    progress = progress_bars(args)
     logger.info("Loading gold standard analyses")
-    goldlist = AnalysisSet.from_file(args.goldfile)
+    goldlist = AnalysisSet.from_file(args.goldfile, cache_dir=args.cache_dir, workers=args.jobs, progress=progress)
     logger.info("Loading predicted analyses")
-    predlist = AnalysisSet.from_file(args.predfile, vocab=goldlist)
-    if args.metric == 'emma-2':
-        pre, rec = emma2(goldlist, predlist)
-    elif args.metric == 'comma-b1':
-        pre, rec = comma(goldlist, predlist, diagonals=True)
-    elif args.metric == 'comma-b0':
-        pre, rec = comma(goldlist, predlist, diagonals=False)
-    elif args.metric == 'comma-s1':
-        pre, rec = comma_strict(goldlist, predlist, diagonals=True, beta=args.beta)
-    elif args.metric == 'comma-s0':
-        pre, rec = comma_strict(goldlist, predlist, diagonals=False, beta=args.beta)
-    elif args.metric == 'bpr-s':
-        pre, rec = bpr_strict(goldlist, predlist, beta=args.beta)
+    predlist = AnalysisSet.from_file(args.predfile, vocab=goldlist, cache_dir=args.cache_dir,
+                                     workers=args.jobs, progress=progress)
+    intervals = {}
+    # The construction of the CoMMA-B word graphs chosen by the evaluation
+    plans = []
+    approximate = args.sample_size is not None or args.time_budget is not None
+    if args.state:
+        from .incremental import IncrementalEvaluator
+        evaluator = IncrementalEvaluator.from_saved(args.state, goldlist, metrics, beta=args.beta,
+                                                    block_size=args.block_size, memory_limit=args.memory_limit)
+        results = evaluator.evaluate(predlist, plans=plans)
+        evaluator.save(args.state)
+    elif approximate:
+        from .sampling import approximate_evaluate
+        results, intervals = approximate_evaluate(
+            goldlist, predlist, metrics, beta=args.beta, sample_size=args.sample_size, time_budget=args.time_budget,
+            seed=args.seed, stratified=args.stratified, confidence=args.confidence, block_size=args.block_size,
+            workers=args.jobs, chunk_size=args.chunk_size, memory_limit=args.memory_limit, plans=plans)
+    elif args.word_scores or args.bootstrap:
+        word_scores = evaluate_words(goldlist, predlist, metrics, beta=args.beta, block_size=args.block_size,
+                                     workers=args.jobs, memory_limit=args.memory_limit, chunk_size=args.chunk_size,
+                                     progress=progress, plans=plans)
+        callbacks = []
+        if args.bootstrap:
+            from .significance import bootstrap_intervals
+
+            def add_intervals(scores):
+                intervals[scores.metric] = bootstrap_intervals(scores.precisions, scores.recalls, args.bootstrap,
+                                                               beta=args.beta, confidence=args.confidence,
+                                                               seed=args.seed)
+            callbacks.append(add_intervals)
+        if args.word_scores:
+            with WordScoreWriter(args.word_scores) as writer:
+                results = process_word_scores(word_scores, writer.write, *callbacks)
+        else:
+            results = process_word_scores(word_scores, *callbacks)
     else:
-        pre, rec = bpr(goldlist, predlist)
-    output = {
-        'metric': args.metric,
-        'files': {'reference': args.goldfile.name, 'predictions': args.predfile.name},
-        'scores': {'precision': round(pre, 4), 'recall': round(rec, 4)}
-    }
-    fscore = (1 + args.beta**2) * pre * rec / (args.beta**2 * pre + rec) if pre + rec > 0 else 0
-    if args.beta == 1:
-        output['scores']['f-score'] = round(fscore, 4)
+        results = evaluate(goldlist, predlist, metrics, beta=args.beta, block_size=args.block_size,
+                           workers=args.jobs, memory_limit=args.memory_limit, chunk_size=args.chunk_size,
+                           progress=progress, plans=plans)
+    return results, intervals, plans[0] if plans and args.memory_limit is not None else None
+
+
+def main(argv=None):
+    """Main method"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'batch':
+        batch_main(argv[1:])
+        return
+    if argv and argv[0] == 'serve':
+        serve_main(argv[1:])
+        return
+    if argv and argv[0] == 'compare':
+        compare_main(argv[1:])
+        return
+    parser = argparse.ArgumentParser(description='Evaluation for morphological analysis and segmentation',
+                                     epilog="Use 'morphoeval batch --help' for evaluating several files at once, "
+                                     "'morphoeval compare --help' for testing the difference of two systems, "
+                                     "and 'morphoeval serve --help' for running an evaluation server.")
+    parser.add_argument('--metric', '-m', type=metric_list, action='append', metavar='METRIC',
+                        help=f"metric: {', '.join(METRICS)}; use a comma-separated list, repeat the option, "
+                        "or use 'all' to compute several metrics (default comma-b0)")
+    parser.add_argument('--beta', metavar='FLOAT', type=float, default=1, help='beta for using F_beta score')
+    parser.add_argument('--block-size', metavar='INT', type=int, default=None,
+                        help='calculate CoMMA-B word graphs in blocks of INT words to limit memory usage')
+    parser.add_argument('--chunk-size', metavar='INT', type=int, default=None,
+                        help='calculate EMMA and EMMA-2 in chunks of INT words to limit memory usage')
+    parser.add_argument('--memory-limit', metavar='SIZE', type=parse_size, default=None,
+                        help='choose how to build the CoMMA-B word graphs to stay below SIZE bytes '
+                        '(suffixes K, M, G, T)')
+    parser.add_argument('--jobs', '-j', metavar='INT', type=int, default=None,
+                        help='number of worker processes for parsing large files, CoMMA-S and BPR (default 1)')
+    parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                        help='save parsed input files to DIR and load them from there on later runs')
+    parser.add_argument('--state', metavar='DIR', default=None,
+                        help='save per-word scores to DIR and re-evaluate only the changed words on later runs')
+    parser.add_argument('--word-scores', metavar='FILE', default=None,
+                        help='write per-word precisions and recalls to FILE (JSON lines, or NumPy arrays if FILE '
+                        'ends with .npz)')
+    parser.add_argument('--bootstrap', metavar='INT', type=int, default=None,
+                        help='add bootstrap confidence intervals from INT resamples of the words')
+    parser.add_argument('--confidence', metavar='FLOAT', type=float, default=0.95,
+                        help='confidence level of the bootstrap and sampling intervals (default 0.95)')
+    parser.add_argument('--sample-size', metavar='INT', type=int, default=None,
+                        help='estimate CoMMA from a random sample of INT words with confidence intervals')
+    parser.add_argument('--time-budget', metavar='SECONDS', type=float, default=None,
+                        help='estimate CoMMA from a random sample of words grown until SECONDS have passed')
+    parser.add_argument('--stratified', action='store_true',
+                        help='stratify the sample of words by their numbers of morphs')
+    parser.add_argument('--seed', metavar='INT', type=int, default=None,
+                        help='seed for the bootstrap resamples and the samples of words')
+    parser.add_argument('--profile', action='store_true',
+                        help='add the time, memory usage, and item counts of each phase to the output')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='like --profile, but trace the peak memory of each phase (slows down the evaluation)')
+    parser.add_argument('--cprofile', metavar='FILE', default=None, help='write cProfile statistics to FILE')
+    parser.add_argument('--no-progress', action='store_true', help='do not show progress bars')
+    parser.add_argument('--verbose', '-v', action='store_true', help='increase verbosity')
+    parser.add_argument('goldfile', help="gold standard analysis file (may be compressed; '-' for standard input)")
+    parser.add_argument('predfile', help="predicted analysis file (may be compressed; '-' for standard input)")
+    parser.add_argument('output', type=argparse.FileType('w'), nargs='?', default='-', help='output file')
+    args = parser.parse_args(argv)
+    if args.goldfile == '-' and args.predfile == '-':
+        parser.error("only one of goldfile and predfile can be read from standard input")
+    for name in ('word_scores', 'bootstrap'):
+        if args.state and getattr(args, name):
+            parser.error(f"argument --{name.replace('_', '-')}: not allowed with argument --state")
+    approximate = args.sample_size is not None or args.time_budget is not None
+    for name in ('state', 'word_scores', 'bootstrap'):
+        if approximate and getattr(args, name):
+            parser.error(f"argument --{name.replace('_', '-')}: not allowed with --sample-size or --time-budget")
+    for name in ('goldfile', 'predfile'):
+        path = getattr(args, name)
+        if path != '-' and not os.path.exists(path):
+            parser.error(f"argument {name}: can't open '{path}': No such file or directory")
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    metrics = []
+    for metric in sum(args.metric or [['comma-b0']], []):
+        if metric not in metrics:
+            metrics.append(metric)
+
+    recorder = PhaseRecorder(trace_memory=args.profile_memory) if args.profile or args.profile_memory else None
+    with contextlib.ExitStack() as stack:
+        if recorder is not None:
+            stack.enter_context(recorder)
+        if args.cprofile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            stack.callback(profiler.disable)
+        results, intervals, plan = run_evaluation(args, metrics)
+    if args.cprofile:
+        profiler.dump_stats(args.cprofile)
+    files = {'reference': args.goldfile, 'predictions': args.predfile}
+    sections = {metric: {'scores': score_dict(pre, rec, beta=args.beta)} for metric, (pre, rec) in results.items()}
+    for metric, metric_intervals in intervals.items():
+        sections[metric]['approximation' if approximate else 'bootstrap'] = metric_intervals
+    if len(metrics) == 1:
+        output = {'metric': metrics[0], 'files': files, **sections[metrics[0]]}
     else:
-        output['scores']['f_beta-score'] = round(fscore, 4)
-        output['scores']['beta'] = args.beta
+        output = {'files': files, 'metrics': sections}
+    if plan is not None:
+        output['word-graphs'] = plan_dict(plan)
+    if recorder is not None:
+        output['profile'] = recorder.as_list()
+    import ruamel.yaml
     ruamel_yaml = ruamel.yaml.YAML(typ='safe', pure=True)
     ruamel_yaml.dump(output, stream=args.output)
 
@@ -0,0 +1,169 @@
+"""Batch evaluation of several prediction files listed in a manifest
+
+A manifest is a YAML (or JSON) file with a list of jobs and optional
+defaults for them:
+
+    metrics: [bpr, emma-2]
+    beta: 1
+    jobs:
+      - gold: fi/gold.txt
+        predictions: [fi/system1.txt, fi/system2.txt]
+      - gold: en/gold.txt
+        predictions: en/system1.txt
+        metrics: [comma-b0]
+        name: en-system1
+
+Relative paths are relative to the directory of the manifest. A job
+with a list of predictions is expanded to one job per prediction file.
+
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+
+import ruamel.yaml
+
+from .common import AnalysisSet
+from .evaluation import METRICS, evaluate, score_dict
+
+
+logger = logging.getLogger(__name__)
+
+Job = collections.namedtuple('Job', ['index', 'name', 'gold', 'predictions', 'metrics', 'beta'])
+Job.__doc__ = """Evaluation of one prediction file against a gold standard"""
+
+# Relative cost of the metrics per byte of predictions, used for scheduling the jobs
+METRIC_COSTS = {'comma-b0': 4, 'comma-b1': 4, 'comma-s0': 20, 'comma-s1': 20, 'emma': 3, 'emma-2': 2, 'bpr': 1,
+                'bpr-s': 2}
+
+
+def _is_names(value):
+    """Return whether a manifest value is a string or a list of strings"""
+    return isinstance(value, str) or (isinstance(value, list) and all(isinstance(item, str) for item in value))
+
+
+def read_manifest(path):
+    """Return the list of jobs in a manifest file"""
+    with open(path, encoding='utf-8') as fobj:
+        manifest = ruamel.yaml.YAML(typ='safe', pure=True).load(fobj)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('jobs'), list):
+        raise ValueError(f"Manifest {path} does not contain a list of jobs")
+    basedir = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for index, entry in enumerate(manifest['jobs']):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Job {index} in manifest {path} is not a mapping: {entry}")
+        if not isinstance(entry.get('gold'), str) or not _is_names(entry.get('predictions')):
+            raise ValueError(f"Job {index} in manifest {path} has no gold file or predictions: {entry}")
+        metrics = entry.get('metrics', manifest.get('metrics', ['comma-b0']))
+        if not _is_names(metrics):
+            raise ValueError(f"Job {index} in manifest {path} has invalid metrics: {metrics}")
+        metrics = [metrics] if isinstance(metrics, str) else list(metrics)
+        unknown = set(metrics) - set(METRICS)
+        if unknown:
+            raise ValueError(f"Unknown metrics in manifest {path}: {', '.join(sorted(unknown))}")
+        predictions = entry['predictions']
+        predictions = [predictions] if isinstance(predictions, str) else predictions
+        for predfile in predictions:
+            name = entry.get('name') if len(predictions) == 1 else None
+            jobs.append(Job(len(jobs), name or predfile, os.path.join(basedir, entry['gold']),
+                            os.path.join(basedir, predfile), metrics, entry.get('beta', manifest.get('beta', 1))))
+    return jobs
+
+
+def job_cost(job):
+    """Return the estimated cost of a job"""
+    size = os.path.getsize(job.predictions) if os.path.isfile(job.predictions) else 0
+    return size * sum(METRIC_COSTS[metric] for metric in job.metrics)
+
+
+def schedule(jobs):
+    """Return the jobs in the order of execution
+
+    The jobs are grouped by the gold standard, the groups ordered by
+    their total estimated cost, and the jobs within a group by their
+    cost, most expensive first.
+
+    """
+    groups = collections.defaultdict(list)
+    for job in jobs:
+        groups[job.gold].append((job_cost(job), job))
+    ordered = []
+    for group in sorted(groups.values(), key=lambda group: -sum(cost for cost, _ in group)):
+        ordered.extend(job for _, job in sorted(group, key=lambda item: (-item[0], item[1].index)))
+    return ordered
+
+
+def run_job(goldlist, job, block_size=None, cache_dir=None, chunk_size=None):
+    """Run an evaluation job and return the result as a dictionary
+
+    Errors are included in the result instead of raising them.
+
+    """
+    result = {'job': job.index, 'name': job.name, 'files': {'reference': job.gold, 'predictions': job.predictions}}
+    try:
+        if isinstance(goldlist, Exception):
+            raise goldlist
+        predlist = AnalysisSet.from_file(job.predictions, vocab=goldlist, cache_dir=cache_dir)
+        scores = evaluate(goldlist, predlist, job.metrics, beta=job.beta, block_size=block_size, chunk_size=chunk_size)
+    except Exception as err:  # pylint: disable=broad-except
+        logger.warning("Job %s failed: %s", job.name, err)
+        result['error'] = f"{type(err).__name__}: {err}"
+        return result
+    result['metrics'] = {metric: {'scores': score_dict(pre, rec, beta=job.beta)} for metric, (pre, rec) in scores.items()}
+    return result
+
+
+def load_golds(jobs, cache_dir=None):
+    """Load each gold standard of the jobs once
+
+    Returns a dictionary from the paths to the analysis sets, or to
+    the exceptions raised when loading them.
+
+    """
+    golds = {}
+    for path in dict.fromkeys(job.gold for job in jobs):
+        logger.info("Loading gold standard analyses from %s", path)
+        try:
+            golds[path] = AnalysisSet.from_file(path, cache_dir=cache_dir)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning("Loading %s failed: %s", path, err)
+            golds[path] = err
+    return golds
+
+
+# Gold standards and options of the worker processes, set once per process by _init_worker
+_WORKER_DATA = {}
+
+
+def _init_worker(golds, block_size, cache_dir, chunk_size):
+    """Store the gold standards and options in a worker process"""
+    _WORKER_DATA.update(golds=golds, block_size=block_size, cache_dir=cache_dir, chunk_size=chunk_size)
+
+
+def _batch_worker(job):
+    """Run a job in a worker process"""
+    return run_job(_WORKER_DATA['golds'][job.gold], job, block_size=_WORKER_DATA['block_size'],
+                   cache_dir=_WORKER_DATA['cache_dir'], chunk_size=_WORKER_DATA['chunk_size'])
+
+
+def evaluate_batch(jobs, workers=None, block_size=None, cache_dir=None, chunk_size=None):
+    """Run evaluation jobs and yield the results as they are finished
+
+    The gold standards are loaded once before running the jobs. If
+    workers is larger than one, the jobs are run in a pool of worker
+    processes in the order given by schedule. A failing job does not
+    stop the others; its result contains the error instead of scores.
+
+    """
+    golds = load_golds(jobs, cache_dir=cache_dir)
+    ordered = schedule(jobs)
+    if workers and workers > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                  initargs=(golds, block_size, cache_dir, chunk_size)) as pool:
+            yield from pool.imap_unordered(_batch_worker, ordered)
+    else:
+        for job in ordered:
+            yield run_job(golds[job.gold], job, block_size=block_size, cache_dir=cache_dir, chunk_size=chunk_size)
@@ -1,93 +1,296 @@
 """Methods for boundary evaluation"""
 
+import collections
 import logging
 
-import munkres
 import numpy as np
-import tqdm
 
-from .common import vector_recall
+from .common import average_terms, from_shared, strict_matching, to_shared, vector_recall
+from .profiling import phase
+from .progress import track
 
 
 logger = logging.getLogger(__name__)
 
+BoundaryData = collections.namedtuple('BoundaryData', ['vectors', 'offsets', 'totals'])
+BoundaryData.__doc__ = """Boundary vectors and offsets of alternatives and their numbers of boundaries"""
 
-def boundary_recall(gold, predicted):
+
+def boundary_data(aset):
+    """Return the boundary data of the alternatives in an analysis set"""
+    vectors, offsets = aset.boundary_vectors()
+    cumulative = np.concatenate([[0], np.cumsum(vectors, dtype=np.int64)])
+    return BoundaryData(vectors, offsets, cumulative[offsets[1:]] - cumulative[offsets[:-1]])
+
+
+def evaluated_words(aset):
+    """Return the indices of the words included in boundary evaluation (single letter words are skipped)"""
+    return np.array([idx for idx, word in enumerate(aset.words) if len(word) > 1], dtype=np.int64)
+
+
+def word_alternatives(gold, predicted, word_idx=None):
+    """Return the alternatives of the evaluated words
+
+    The evaluated words are given by the indices word_idx in gold, by
+    default those returned by evaluated_words. Returns the indices of
+    the words in gold, and the indices of the first alternatives and
+    the numbers of alternatives of the words in gold and predicted
+    (zero for words missing from predicted).
+
+    """
+    word_idx = evaluated_words(gold) if word_idx is None else np.asarray(word_idx, dtype=np.int64)
+    pred_idx = np.fromiter((predicted.word_ids.get(gold.words[idx], -1) for idx in word_idx.tolist()),
+                           dtype=np.int64, count=len(word_idx))
+    gold_first = gold.word_offsets[word_idx]
+    n_gold = gold.word_offsets[word_idx + 1] - gold_first
+    pred_first = np.where(pred_idx >= 0, predicted.word_offsets[pred_idx], 0)
+    n_pred = np.where(pred_idx >= 0, predicted.word_offsets[pred_idx + 1] - pred_first, 0)
+    return word_idx, gold_first, n_gold, pred_first, n_pred
+
+
+def alternative_pairs(gold_first, n_gold, pred_first, n_pred):
+    """Return all pairs of gold and predicted alternatives of the words
+
+    The pairs of each word are in gold-major order. Returns the index
+    of the first pair of each word, the word of each pair, and the
+    gold and predicted alternative of each pair.
+
+    """
+    n_pairs = n_gold * n_pred
+    pair_starts = np.cumsum(n_pairs) - n_pairs
+    pair_words = np.repeat(np.arange(len(n_pairs)), n_pairs)
+    local = np.arange(n_pairs.sum()) - pair_starts[pair_words]
+    gold_alts = gold_first[pair_words] + local // n_pred[pair_words]
+    pred_alts = pred_first[pair_words] + local % n_pred[pair_words]
+    return pair_starts, pair_words, gold_alts, pred_alts
+
+
+def boundary_hits(gold_data, pred_data, gold_alts, pred_alts, batch_size=100000):
+    """Return the number of shared boundaries for pairs of alternatives
+
+    The boundary vectors are compared in batches of at most
+    batch_size pairs with the same vector length.
+
+    """
+    lengths = gold_data.offsets[gold_alts + 1] - gold_data.offsets[gold_alts]
+    pred_lengths = pred_data.offsets[pred_alts + 1] - pred_data.offsets[pred_alts]
+    if np.any(lengths != pred_lengths):
+        idx = np.argmax(lengths != pred_lengths)
+        raise ValueError(f"Vectors do not have the same shape: ({lengths[idx]},) ({pred_lengths[idx]},)")
+    hits = np.zeros(len(lengths), dtype=np.int64)
+    for length in np.unique(lengths).tolist():
+        selected = np.flatnonzero(lengths == length)
+        columns = np.arange(length)
+        for start in range(0, len(selected), batch_size):
+            batch = selected[start:start + batch_size]
+            gold_batch = gold_data.vectors[gold_data.offsets[gold_alts[batch], None] + columns]
+            pred_batch = pred_data.vectors[pred_data.offsets[pred_alts[batch], None] + columns]
+            hits[batch] = (gold_batch & pred_batch).sum(1)
+    return hits
+
+
+def best_boundary_recalls(gold_data, pred_data, gold_first, n_gold, pred_first, n_pred, batch_size=100000):
+    """Return the recall of the best matching pair of alternatives for each word"""
+    # Words with an unsegmented gold alternative get full points
+    cumulative = np.concatenate([[0], np.cumsum(gold_data.totals == 0)])
+    unsegmented = cumulative[gold_first + n_gold] > cumulative[gold_first]
+    n_pred = np.where(unsegmented, 0, n_pred)
+    pair_starts, _, gold_alts, pred_alts = alternative_pairs(gold_first, n_gold, pred_first, n_pred)
+    with phase('boundary-hits', words=len(n_gold), pairs=len(gold_alts)):
+        hits = boundary_hits(gold_data, pred_data, gold_alts, pred_alts, batch_size=batch_size)
+    best = unsegmented.astype(float)
+    if len(hits):
+        evaluated = n_gold * n_pred > 0
+        best[evaluated] = np.maximum.reduceat(hits / gold_data.totals[gold_alts], pair_starts[evaluated])
+    return best
+
+
+def strict_boundary_scores(gold_data, pred_data, gold_first, n_gold, pred_first, n_pred, beta=1, matchings=False):
+    """Return the precision and recall of each word from the optimal matching of the alternatives
+
+    If matchings is True, returns also the matched pairs of
+    alternatives (see strict_matching).
+
+    """
+    pair_starts, _, gold_alts, pred_alts = alternative_pairs(gold_first, n_gold, pred_first, n_pred)
+    with phase('boundary-hits', words=len(n_gold), pairs=len(gold_alts)):
+        hits = boundary_hits(gold_data, pred_data, gold_alts, pred_alts)
+    gold_totals = gold_data.totals[gold_alts]
+    pred_totals = pred_data.totals[pred_alts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recalls = np.where(gold_totals > 0, hits / gold_totals, 1.0)
+        precisions = np.where(pred_totals > 0, hits / pred_totals, 1.0)
+    pre_sums, rec_sums, *pairs = strict_matching(precisions, recalls, pair_starts, n_gold, n_pred, beta=beta,
+                                                 matchings=matchings)
+    return (pre_sums / n_pred, rec_sums / n_gold, *pairs)
+
+
+# Shared arrays of the worker processes, set once per process by _init_worker
+_WORKER_DATA = {}
+
+
+def _init_worker(shared):
+    """Store views to the shared arrays in a worker process"""
+    _WORKER_DATA.update({name: from_shared(value) for name, value in shared.items()})
+
+
+def _boundary_worker(task):
+    """Return per-word scores for a range of words in one direction"""
+    strict, direction, start, end, beta, matchings = task
+    ref, hyp = ('gold', 'pred') if direction == 'recall' else ('pred', 'gold')
+    ref_data = BoundaryData(*(_WORKER_DATA[f'{ref}_{field}'] for field in BoundaryData._fields))
+    hyp_data = BoundaryData(*(_WORKER_DATA[f'{hyp}_{field}'] for field in BoundaryData._fields))
+    words = [_WORKER_DATA[f'{direction}_{field}'][start:end]
+             for field in ('gold_first', 'n_gold', 'pred_first', 'n_pred')]
+    if strict:
+        return strict_boundary_scores(ref_data, hyp_data, *words, beta=beta, matchings=matchings)
+    return (best_boundary_recalls(ref_data, hyp_data, *words),)
+
+
+def parallel_boundary_scores(goldlist, predlist, directions, workers, strict=False, beta=1, matchings=False,
+                             progress=None):
+    """Return per-word boundary scores computed in a pool of worker processes
+
+    The boundary data of both analysis sets and the alternatives of
+    the evaluated words are copied to shared memory once, and the
+    words of each direction ('precision' or 'recall') are split into
+    shards for the workers. Returns a list of the concatenated results
+    for each direction: a tuple of the best recalls for BPR, or a
+    tuple of precisions and recalls for strict matching (and the
+    matched pairs if matchings is True). The progress over the shards
+    is reported to progress (see progress.track).
+
+    """
+    import multiprocessing
+    arrays = {}
+    for name, aset in (('gold', goldlist), ('pred', predlist)):
+        arrays.update({f'{name}_{field}': value for field, value in boundary_data(aset)._asdict().items()})
+    tasks = []
+    for direction in directions:
+        ref, hyp = (goldlist, predlist) if direction == 'recall' else (predlist, goldlist)
+        _, gold_first, n_gold, pred_first, n_pred = word_alternatives(ref, hyp)
+        arrays.update({f'{direction}_gold_first': gold_first, f'{direction}_n_gold': n_gold,
+                       f'{direction}_pred_first': pred_first, f'{direction}_n_pred': n_pred})
+        shard_size = max(1, -(-len(n_gold) // (4 * workers)))
+        tasks.extend((strict, direction, start, min(start + shard_size, len(n_gold)), beta, matchings)
+                     for start in range(0, len(n_gold), shard_size))
+    shared = {name: to_shared(value) for name, value in arrays.items()}
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(shared,)) as pool:
+        shards = list(track(pool.imap(_boundary_worker, tasks), progress, 'bpr', total=len(tasks), unit='shards'))
+    results = []
+    for direction in directions:
+        parts = [shard for task, shard in zip(tasks, shards) if task[1] == direction]
+        n_fields = (3 if matchings else 2) if strict else 1
+        results.append(tuple(np.concatenate([part[idx] for part in parts] or [np.zeros(0)])
+                             for idx in range(n_fields)))
+    return results
+
+
+def boundary_recall_terms(gold, predicted, batch_size=100000):
+    """Return the best boundary recall of each evaluated word in gold (see evaluated_words)
+
+    Uses the best local match for alternative segmentations. The
+    boundary vectors of all pairs of gold and predicted alternatives
+    are compared at once (see boundary_hits).
+
+    """
+    _, gold_first, n_gold, pred_first, n_pred = word_alternatives(gold, predicted)
+    return best_boundary_recalls(boundary_data(gold), boundary_data(predicted),
+                                 gold_first, n_gold, pred_first, n_pred, batch_size=batch_size)
+
+
+def boundary_recall(gold, predicted, batch_size=100000):
     """Calculate boundary recall
 
-    Uses the best local match for alternative segmentations.
+    Uses the best local match for alternative segmentations (see
+    boundary_recall_terms).
+
+    """
+    # Sum in word order to get the same result as summing word by word
+    return average_terms(boundary_recall_terms(gold, predicted, batch_size=batch_size), sequential=True)
+
+
+def bpr_terms(goldlist, predlist, workers=None, progress=None):
+    """Return per-word terms of boundary precision and recall
+
+    The precision terms are for the evaluated words of predlist and
+    the recall terms for those of goldlist (see evaluated_words). If
+    workers is larger than one, both directions are computed
+    concurrently in a pool of worker processes, and the progress is
+    reported to progress. Otherwise, the words are evaluated in a few
+    array operations without progress reports.
 
     """
-    total = 0
-    hits = 0
-    for word, gold_alternatives in tqdm.tqdm(gold.analyses.items()):
-        if len(word) < 2:
-            # Skip single letter words
-            continue
-        best = 0
-        for gold_mseq in gold_alternatives:
-            gold_v = gold_mseq.boundaries()
-            if gold_v.sum() == 0:
-                best = 1
-                break
-            for pred_mseq in predicted.analyses[word]:
-                rec, _ = vector_recall(gold_v, pred_mseq.boundaries())
-                if rec > best:
-                    best = rec
-        total += 1
-        hits += best
-    return hits / total
-
-
-def bpr(goldlist, predlist):
-    """Return boundary precision and recall (bpr)"""
+    if workers and workers > 1:
+        logger.info("Calculating precision and recall with %s workers", workers)
+        [(pre_terms,), (rec_terms,)] = parallel_boundary_scores(
+            goldlist, predlist, ['precision', 'recall'], workers, progress=progress)
+        return pre_terms, rec_terms
     logger.info("Calculating precision")
-    pre = boundary_recall(predlist, goldlist)
+    pre_terms = boundary_recall_terms(predlist, goldlist)
     logger.info("Calculating recall")
-    rec = boundary_recall(goldlist, predlist)
-    return pre, rec
+    rec_terms = boundary_recall_terms(goldlist, predlist)
+    return pre_terms, rec_terms
+
+
+def bpr(goldlist, predlist, workers=None, progress=None):
+    """Return boundary precision and recall (bpr)
+
+    If workers is larger than one, both directions are computed
+    concurrently in a pool of worker processes (see bpr_terms).
+
+    """
+    pre_terms, rec_terms = bpr_terms(goldlist, predlist, workers=workers, progress=progress)
+    # Sum in word order to get the same result as summing word by word
+    return average_terms(pre_terms, sequential=True), average_terms(rec_terms, sequential=True)
 
 
 def best_strict_boundary_recall(gold_alternatives, pred_alternatives, beta=1):
     """Find optimal matching between the alternatives and return scores"""
     n_gold = len(gold_alternatives)
     n_pred = len(pred_alternatives)
-    n_max = max(n_gold, n_pred)
-    recalls = np.zeros((n_max, n_max))
-    precisions = np.zeros((n_max, n_max))
-    costs = np.ones((n_max, n_max))
+    recalls = np.zeros((n_gold, n_pred))
+    precisions = np.zeros((n_gold, n_pred))
     for gold_idx, gold_mseq in enumerate(gold_alternatives):
         for pred_idx, pred_mseq in enumerate(pred_alternatives):
-            rec, _ = vector_recall(gold_mseq.boundaries(), pred_mseq.boundaries())
-            pre, _ = vector_recall(pred_mseq.boundaries(), gold_mseq.boundaries())
-            fscore = (1 + beta**2) * pre * rec / (beta**2 * pre + rec) if pre + rec > 0 else 0
-            recalls[gold_idx, pred_idx] = rec
-            precisions[gold_idx, pred_idx] = pre
-            costs[gold_idx, pred_idx] = 1 - fscore
-    indexes = munkres.Munkres().compute(costs)
-    if n_max > 1:
-        word = ''.join(gold_alternatives[0])
-        logger.debug("Costs for word %s:\n%s", word, costs)
-        logger.debug("Matching for word %s: %s", word, indexes)
-    pre_t, rec_t = 0, 0
-    for gold_idx, pred_idx in indexes:
-        pre_t += precisions[gold_idx, pred_idx].item()
-        rec_t += recalls[gold_idx, pred_idx].item()
-    return pre_t / n_pred, rec_t / n_gold
-
-
-def bpr_strict(goldlist, predlist, beta=1):
-    """Return boundary precision and recall (bpr) with strict matching"""
-    pre_total, rec_total = 0, 0
-    pre_hits, rec_hits = 0, 0
-    for word, gold_alternatives in tqdm.tqdm(goldlist.analyses.items()):
-        if len(word) < 2:
-            # Skip single letter words
-            continue
-        pre_score, rec_score = best_strict_boundary_recall(
-            gold_alternatives, predlist.analyses[word], beta=beta)
-        pre_hits += pre_score
-        rec_hits += rec_score
-        pre_total += 1
-        rec_total += 1
-    return pre_hits / pre_total, rec_hits / rec_total
+            recalls[gold_idx, pred_idx], _ = vector_recall(gold_mseq.boundaries(), pred_mseq.boundaries())
+            precisions[gold_idx, pred_idx], _ = vector_recall(pred_mseq.boundaries(), gold_mseq.boundaries())
+    pre_sums, rec_sums = strict_matching(precisions.ravel(), recalls.ravel(), np.zeros(1, dtype=np.int64),
+                                         np.array([n_gold]), np.array([n_pred]), beta=beta)
+    return pre_sums[0].item() / n_pred, rec_sums[0].item() / n_gold
+
+
+def bpr_strict_terms(goldlist, predlist, beta=1, workers=None, matchings=False, progress=None):
+    """Return per-word terms of boundary precision and recall with strict matching
+
+    The terms are for the evaluated words of goldlist (see
+    evaluated_words). The optimal matchings between the alternatives
+    are solved for all words with the same numbers of alternatives at
+    once. If matchings is True, returns also the matched pairs of
+    alternatives (see strict_matching). If workers is larger than
+    one, the words are split between worker processes, and the
+    progress is reported to progress.
+
+    """
+    word_idx, gold_first, n_gold, pred_first, n_pred = word_alternatives(goldlist, predlist)
+    if np.any(n_pred == 0):
+        word = goldlist.words[word_idx[np.argmax(n_pred == 0)]]
+        raise ValueError(f"No predicted analyses for word {word}")
+    if workers and workers > 1:
+        [terms] = parallel_boundary_scores(goldlist, predlist, ['recall'], workers, strict=True, beta=beta,
+                                           matchings=matchings, progress=progress)
+        return terms
+    return strict_boundary_scores(boundary_data(goldlist), boundary_data(predlist),
+                                  gold_first, n_gold, pred_first, n_pred, beta=beta, matchings=matchings)
+
+
+def bpr_strict(goldlist, predlist, beta=1, workers=None, progress=None):
+    """Return boundary precision and recall (bpr) with strict matching
+
+    If workers is larger than one, the words are split between worker
+    processes (see bpr_strict_terms).
+
+    """
+    pre_terms, rec_terms = bpr_strict_terms(goldlist, predlist, beta=beta, workers=workers, progress=progress)
+    # Sum in word order to get the same result as summing word by word
+    return average_terms(pre_terms, sequential=True), average_terms(rec_terms, sequential=True)
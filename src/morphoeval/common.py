@@ -1,15 +1,63 @@
 """Common classes and methods for the evaluation metrics"""
 
+import array
+import bz2
 import collections
+import collections.abc
+import contextlib
+import gc
+import gzip
+import hashlib
+import io
+import itertools
 import logging
+import locale
+import lzma
+import operator
+import os
+import shutil
+import sys
+import tempfile
 
 import numpy as np
-from scipy.sparse import lil_matrix
-import tqdm
+
+from .profiling import phase
+from .progress import report, track
+
+# SciPy, munkres, and multiprocessing are imported by the
+# functions that need them to keep the start-up time short
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
 
 
 logger = logging.getLogger(__name__)
 
+# Assignment problems with at most this many possible matchings are solved by enumeration
+MAX_PERMUTATIONS = 720
+
+# Version of the saved AnalysisSet layout, included in the cache keys
+CACHE_VERSION = 1
+
+# Size of the read buffer for input files
+BUFFER_SIZE = 1 << 20
+
+# Number of characters parsed at once when loading analyses
+CHUNK_SIZE = 1 << 24
+
+# Files smaller than this are not parsed in parallel
+PARALLEL_PARSE_SIZE = 1 << 24
+
+# Magic numbers of the supported compression formats and their modules
+COMPRESSION_FORMATS = [
+    (b'\x1f\x8b', 'gzip', gzip),
+    (b'BZh', 'bzip2', bz2),
+    (b'\xfd7zXZ\x00', 'xz', lzma),
+    (b'\x28\xb5\x2f\xfd', 'zstd', zstd),
+]
+
 
 def vector_recall(gold, pred):
     """Calculate recall from boundary vectors"""
@@ -23,6 +71,227 @@ def vector_recall(gold, pred):
     return ((gold - error).sum() / total).item(), total
 
 
+def detect_compression(header):
+    """Return the compression format of data starting with the header bytes
+
+    Returns a tuple of the format name and the module for reading it
+    (None if not available), or None for uncompressed data.
+
+    """
+    for magic, name, module in COMPRESSION_FORMATS:
+        if header.startswith(magic):
+            return name, module
+    return None
+
+
+def open_analysis_file(path, encoding=None, buffer_size=BUFFER_SIZE):
+    """Open an analysis file for reading text
+
+    Use '-' for standard input. Files and streams compressed with
+    gzip, bzip2, xz, or zstd (if supported by the Python version) are
+    decompressed transparently; the format is detected from the first
+    bytes of the data.
+
+    """
+    if path == '-':
+        stream = io.BufferedReader(sys.stdin.buffer.raw, buffer_size)
+    else:
+        stream = open(path, 'rb', buffering=buffer_size)
+    compressed = detect_compression(stream.peek(6))
+    if compressed:
+        name, module = compressed
+        if module is None:
+            stream.close()
+            raise ValueError(f"Decompressing {name} is not supported by this Python version: {path}")
+        if path != '-':
+            # Let the decompressor own the file so that it is closed with it
+            stream.close()
+            stream = module.open(path, 'rb')
+        else:
+            stream = module.open(stream, 'rb')
+        stream = io.BufferedReader(stream, buffer_size)
+    return io.TextIOWrapper(stream, encoding=encoding)
+
+
+def to_shared(array):
+    """Copy a numpy array to shared memory for worker processes
+
+    Returns a tuple that can be passed to new processes and converted
+    back to an array without copying with from_shared.
+
+    """
+    import multiprocessing
+    array = np.ascontiguousarray(array)
+    buffer = multiprocessing.RawArray('b', array.nbytes)
+    np.frombuffer(buffer, dtype=np.uint8)[:] = array.view(np.uint8).ravel()
+    return buffer, array.dtype.str, array.shape
+
+
+def from_shared(shared):
+    """Return a numpy array view to an array in shared memory (see to_shared)"""
+    buffer, dtype, shape = shared
+    return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def fscores(precisions, recalls, beta=1):
+    """Return F_beta scores for arrays of precisions and recalls"""
+    denominators = beta**2 * precisions + recalls
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (1 + beta**2) * precisions * recalls / denominators
+    return np.where(precisions + recalls > 0, scores, 0.0)
+
+
+def enumerate_assignments(n_rows, n_cols):
+    """Return all assignments of rows to distinct columns as an array of column indices
+
+    Returns None if there are more than MAX_PERMUTATIONS assignments.
+
+    """
+    n_assignments = 1
+    for factor in range(n_cols - n_rows + 1, n_cols + 1):
+        n_assignments *= factor
+        if n_assignments > MAX_PERMUTATIONS:
+            return None
+    permutations = np.array(list(itertools.permutations(range(n_cols), n_rows)), dtype=np.int64)
+    return permutations.reshape(-1, n_rows)
+
+
+def assignment_batch(costs):
+    """Solve a batch of minimum-cost assignment problems of the same shape
+
+    Takes an array of shape (n_batch, n_rows, n_cols) and returns the
+    row and column indices of the optimal one-to-one assignments as
+    arrays of shape (n_batch, min(n_rows, n_cols)), sorted by the row
+    index. Small problems are solved by scoring all possible
+    assignments at once, and larger ones with scipy's
+    linear_sum_assignment.
+
+    """
+    n_batch, n_rows, n_cols = costs.shape
+    if n_rows > n_cols:
+        cols, rows = assignment_batch(costs.transpose(0, 2, 1))
+        order = np.argsort(rows, axis=1)
+        return np.take_along_axis(rows, order, 1), np.take_along_axis(cols, order, 1)
+    rows = np.tile(np.arange(n_rows), (n_batch, 1))
+    permutations = enumerate_assignments(n_rows, n_cols)
+    if permutations is not None:
+        totals = costs[:, np.arange(n_rows), permutations].sum(-1)
+        cols = permutations[totals.argmin(1)]
+    else:
+        from scipy.optimize import linear_sum_assignment
+        cols = np.array([linear_sum_assignment(matrix)[1] for matrix in costs], dtype=np.int64)
+        cols = cols.reshape(n_batch, n_rows)
+    return rows, cols
+
+
+def ambiguous_assignments(costs, values, tolerance=1e-12):
+    """Return which assignment problems have optimal solutions with different values
+
+    Takes the costs as for assignment_batch and the values to be
+    summed over the assigned pairs as an array of shape (n_batch,
+    n_rows, n_cols, n_values). Only problems small enough for
+    enumeration are checked; the others are reported as ambiguous,
+    as linear_sum_assignment may select any of the optimal solutions.
+
+    """
+    n_batch, n_rows, n_cols = costs.shape
+    if n_rows > n_cols:
+        return ambiguous_assignments(costs.transpose(0, 2, 1), values.transpose(0, 2, 1, 3), tolerance=tolerance)
+    permutations = enumerate_assignments(n_rows, n_cols)
+    if permutations is None:
+        return np.ones(n_batch, dtype=bool)
+    totals = costs[:, np.arange(n_rows), permutations].sum(-1)
+    optimal = totals <= totals.min(1, keepdims=True) + tolerance
+    sums = values[:, np.arange(n_rows), permutations].sum(2)
+    first = sums[np.arange(n_batch), totals.argmin(1)]
+    return np.any(optimal[:, :, None] & (np.abs(sums - first[:, None, :]) > tolerance), axis=(1, 2))
+
+
+def munkres_assignment(costs):
+    """Return the assignment found by the Munkres algorithm for a padded square cost matrix"""
+    import munkres
+    n_rows, n_cols = costs.shape
+    n_max = max(n_rows, n_cols)
+    padded = np.ones((n_max, n_max))
+    padded[:n_rows, :n_cols] = costs
+    pairs = sorted((row, col) for row, col in munkres.Munkres().compute(padded.tolist())
+                   if row < n_rows and col < n_cols)
+    return np.array([row for row, _ in pairs], dtype=np.int64), np.array([col for _, col in pairs], dtype=np.int64)
+
+
+def average_terms(terms, sequential=False):
+    """Return the average of the per-word terms that are not NaN
+
+    If sequential is True, the terms are summed one by one in order
+    (as the word-by-word loops did) instead of with NumPy. Returns 1.0
+    if there are no terms.
+
+    """
+    terms = terms[~np.isnan(terms)]
+    if not sequential:
+        return terms.mean().item() if len(terms) else 1.0
+    values = terms.tolist()
+    return sum(values) / len(values) if values else 1.0
+
+
+def strict_matching(precisions, recalls, pair_starts, n_gold, n_pred, beta=1, matchings=False):
+    """Find optimal matchings between gold and predicted alternatives
+
+    The precisions and recalls of all pairs of gold and predicted
+    alternatives of a word are stored in gold-major order starting
+    from pair_starts. The matchings maximize the sum of the F_beta
+    scores of the pairs. Words with the same numbers of alternatives
+    are solved together. If there are several optimal matchings with
+    different precision and recall sums, the Munkres algorithm is used
+    to select the same matching as in the word-by-word evaluation.
+    Returns the sums of the matched precisions and recalls for each
+    word. If matchings is True, returns also the matched pairs as an
+    array of (gold, predicted) alternative indices within the words,
+    min(n_gold, n_pred) pairs for each word in order.
+
+    """
+    with phase('strict-matching', words=len(n_gold), pairs=len(precisions)) as counts:
+        return _strict_matching(precisions, recalls, pair_starts, n_gold, n_pred, beta, matchings, counts)
+
+
+def _strict_matching(precisions, recalls, pair_starts, n_gold, n_pred, beta, matchings, counts):
+    """Find optimal matchings between gold and predicted alternatives (see strict_matching)"""
+    costs = 1 - fscores(precisions, recalls, beta=beta)
+    counts['munkres'] = 0
+    pre_sums = np.zeros(len(n_gold))
+    rec_sums = np.zeros(len(n_gold))
+    n_matched = np.minimum(n_gold, n_pred)
+    match_starts = np.cumsum(n_matched) - n_matched
+    pairs = np.zeros((n_matched.sum(), 2), dtype=np.int64)
+    for n_g, n_p in set(zip(n_gold.tolist(), n_pred.tolist())):
+        words = np.flatnonzero((n_gold == n_g) & (n_pred == n_p))
+        index = pair_starts[words, None] + np.arange(n_g * n_p)
+        group_costs = costs[index].reshape(len(words), n_g, n_p)
+        rows, cols = assignment_batch(group_costs)
+        if max(n_g, n_p) > 1:
+            values = np.stack([precisions[index], recalls[index]], axis=-1).reshape(len(words), n_g, n_p, 2)
+            for idx in np.flatnonzero(ambiguous_assignments(group_costs, values)).tolist():
+                rows[idx], cols[idx] = munkres_assignment(group_costs[idx])
+                counts['munkres'] += 1
+        matched = np.take_along_axis(index, rows * n_p + cols, 1)
+        # Sum in the order of gold alternatives as the per-word loops did
+        pre_total, rec_total = np.zeros(len(words)), np.zeros(len(words))
+        for pair in matched.T:
+            pre_total = pre_total + precisions[pair]
+            rec_total = rec_total + recalls[pair]
+        pre_sums[words] = pre_total
+        rec_sums[words] = rec_total
+        if matchings:
+            positions = match_starts[words, None] + np.arange(rows.shape[1])
+            pairs[positions] = np.stack([rows, cols], axis=-1)
+        if logger.isEnabledFor(logging.DEBUG) and max(n_g, n_p) > 1:
+            logger.debug("Matchings for %s words with %s gold and %s predicted alternatives:\n%s",
+                         len(words), n_g, n_p, np.stack([rows, cols], axis=-1))
+    if matchings:
+        return pre_sums, rec_sums, pairs
+    return pre_sums, rec_sums
+
+
 class MorphSeq(list):
     """Sequence of morphs"""
 
@@ -46,71 +315,565 @@ class MorphSeq(list):
         return vect
 
 
+class AnalysisMapping(collections.abc.Mapping):
+    """Read-only mapping from words to lists of MorphSeq objects
+
+    The MorphSeq objects are created on demand from the compact arrays
+    of the parent AnalysisSet, so modifying them does not change the
+    stored analyses. Use AnalysisSet.add for adding new analyses.
+
+    """
+
+    def __init__(self, aset):
+        self._aset = aset
+
+    def __getitem__(self, word):
+        return self._aset.alternatives(self._aset.word_ids[word])
+
+    def __contains__(self, word):
+        return word in self._aset.word_ids
+
+    def __iter__(self):
+        return iter(self._aset.words)
+
+    def __len__(self):
+        return len(self._aset.words)
+
+
+ParsedLines = collections.namedtuple('ParsedLines', ['words', 'n_alternatives', 'lengths', 'morphs', 'codes'])
+ParsedLines.__doc__ = """Fields of lines of an analysis file (see parse_lines)"""
+
+
+def parse_lines(lines, vocab=None):
+    """Split lines of an analysis file to words and morphs in bulk
+
+    Comment lines starting with '#' are skipped. Given a container
+    vocab, only the words found in it are included. Returns a
+    ParsedLines tuple with the words of the lines, the number of
+    alternatives of each line, the number of morphs in each
+    alternative, the distinct morphs in the order of their first
+    occurrence, and the indices of the morphs of all alternatives in
+    the distinct morphs.
+
+    """
+    lines = list(itertools.filterfalse(operator.methodcaller('startswith', '#'), lines))
+    if set(map(operator.methodcaller('count', '\t'), lines)) - {1}:
+        line = next(line for line in lines if line.count('\t') != 1)
+        raise ValueError(f"Invalid line in analysis file: {line!r}")
+    fields = '\t'.join(lines).split('\t') if lines else []
+    words, rests = fields[0::2], fields[1::2]
+    if vocab:
+        included = list(map(vocab.word_ids.__contains__ if isinstance(vocab, AnalysisSet) else vocab.__contains__,
+                            words))
+        words = list(itertools.compress(words, included))
+        rests = list(itertools.compress(rests, included))
+    n_alternatives = np.fromiter(map(operator.methodcaller('count', ', '), rests),
+                                 dtype=np.int64, count=len(rests)) + 1
+    # Split all alternatives at once with a separator token that does not occur in the morphs
+    text = '\t'.join(rests)
+    separator = next(chr(code) for code in itertools.count() if chr(code) not in text)
+    tokens = text.replace('\t', f' {separator} ').replace(', ', f' {separator} ').split()
+    index = collections.defaultdict(itertools.count().__next__)
+    index[separator]  # pylint: disable=pointless-statement
+    codes = np.fromiter(map(index.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+    separators = np.flatnonzero(codes == 0)
+    lengths = np.diff(np.concatenate([[-1], separators, [len(codes)]])) - 1 if rests else np.zeros(0, dtype=np.int64)
+    return ParsedLines(words, n_alternatives, lengths, list(index)[1:], codes[codes != 0] - 1)
+
+
+@contextlib.contextmanager
+def gc_disabled():
+    """Context manager that disables the cyclic garbage collector
+
+    Parsing creates millions of objects that the collector would scan
+    repeatedly without finding any garbage.
+
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def line_ranges(path, n_ranges):
+    """Split a file to at most n_ranges byte ranges at line boundaries"""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as fobj:
+        for idx in range(1, n_ranges):
+            fobj.seek(max(size * idx // n_ranges, bounds[-1]))
+            fobj.readline()
+            bounds.append(min(fobj.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+# Vocabulary filter of the parser processes, set once per process by _init_parser
+_PARSER_VOCAB = []
+
+
+def _init_parser(vocab):
+    """Store the vocabulary filter in a parser process"""
+    _PARSER_VOCAB[:] = [vocab]
+    gc.disable()
+
+
+def _parse_range(task):
+    """Parse a byte range of an analysis file"""
+    path, start, end, encoding = task
+    with open(path, 'rb') as fobj:
+        fobj.seek(start)
+        data = fobj.read(end - start)
+    lines = data.decode(encoding).split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return parse_lines(lines, vocab=_PARSER_VOCAB[0])
+
+
+def segment_indices(starts, lengths):
+    """Return concatenated index ranges [start, start + length) as a single array"""
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def cache_key(path, vocab=None):
+    """Return a key for caching the analyses loaded from path with vocab
+
+    The key is a hash of the file contents and the words of the vocab
+    filter (in order for an AnalysisSet, otherwise sorted).
+
+    """
+    digest = hashlib.sha256(f'morphoeval-{CACHE_VERSION}\n'.encode('utf-8'))
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(1 << 20), b''):
+            digest.update(chunk)
+    if vocab:
+        words = vocab.words if isinstance(vocab, AnalysisSet) else sorted(vocab)
+        digest.update(b'\0')
+        digest.update('\n'.join(words).encode('utf-8'))
+    return digest.hexdigest()
+
+
 class AnalysisSet:
-    """Morphological analyses for a set of words"""
+    """Morphological analyses for a set of words
+
+    Morphs are interned to integer ids (see morphs and morph_list) and
+    the analyses are stored in flat arrays: morph_ids contains the
+    morph ids of all alternative analyses, alt_offsets[i] is the start
+    of the alternative i in morph_ids, and word_offsets[j] is the index
+    of the first alternative of the word j in alt_offsets. The
+    analyses attribute provides the analyses as MorphSeq objects.
+
+    """
 
     def __init__(self):
-        self.analyses = collections.defaultdict(list)
+        self.words = []
+        self.word_ids = {}
         self.morphs = {}
-        self.n_morphs = 0
+        self.morph_list = []
+        self.analyses = AnalysisMapping(self)
+        self._word_offsets = np.zeros(1, dtype=np.int64)
+        self._alt_offsets = np.zeros(1, dtype=np.int64)
+        self._morph_ids = np.zeros(0, dtype=np.int32)
+        # Analyses added after the last compaction
+        self._pending_words = array.array('q')
+        self._pending_lengths = array.array('q')
+        self._pending_ids = array.array('i')
+        # Derived data structures, cleared when analyses are added
+        self._cache = {}
 
     def __contains__(self, word):
-        return word in self.analyses
+        return word in self.word_ids
+
+    @property
+    def n_morphs(self):
+        """Number of distinct morphs"""
+        return len(self.morph_list)
+
+    @property
+    def n_words(self):
+        """Number of words"""
+        return len(self.words)
+
+    @property
+    def word_offsets(self):
+        """Offsets of the words in alt_offsets (length n_words + 1)"""
+        self._compact()
+        return self._word_offsets
+
+    @property
+    def alt_offsets(self):
+        """Offsets of the alternative analyses in morph_ids (length n_alternatives + 1)"""
+        self._compact()
+        return self._alt_offsets
+
+    @property
+    def morph_ids(self):
+        """Morph ids of all analyses"""
+        self._compact()
+        return self._morph_ids
+
+    def _compact(self):
+        """Merge pending analyses to the compact arrays"""
+        if not self._pending_words:
+            return
+        n_old = len(self._word_offsets) - 1
+        alt_words = np.concatenate([
+            np.repeat(np.arange(n_old), np.diff(self._word_offsets)),
+            np.array(self._pending_words, dtype=np.int64)])
+        alt_lengths = np.concatenate([
+            np.diff(self._alt_offsets), np.array(self._pending_lengths, dtype=np.int64)])
+        morph_ids = np.concatenate([self._morph_ids, np.array(self._pending_ids, dtype=np.int32)])
+        self._pending_words = array.array('q')
+        self._pending_lengths = array.array('q')
+        self._pending_ids = array.array('i')
+        self._cache = {}
+        if np.any(alt_words[1:] < alt_words[:-1]):
+            # Alternatives of some word were added after other words;
+            # reorder so that the alternatives of each word are contiguous
+            order = np.argsort(alt_words, kind='stable')
+            starts = np.concatenate([[0], np.cumsum(alt_lengths)[:-1]])[order]
+            alt_words = alt_words[order]
+            alt_lengths = alt_lengths[order]
+            morph_ids = morph_ids[segment_indices(starts, alt_lengths)]
+        self._morph_ids = morph_ids
+        self._alt_offsets = np.concatenate([[0], np.cumsum(alt_lengths)])
+        self._word_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(alt_words, minlength=len(self.words)))])
+
+    def alternatives(self, word_idx):
+        """Return the alternative analyses of the word with given index as MorphSeq objects"""
+        self._compact()
+        offsets = self._alt_offsets[self._word_offsets[word_idx]:self._word_offsets[word_idx + 1] + 1].tolist()
+        return [MorphSeq(self.morph_list[morph_id] for morph_id in self._morph_ids[start:end].tolist())
+                for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def boundary_vectors(self):
+        """Return the boundary vectors of all alternatives
+
+        Returns a concatenated uint8 array of the boundary vectors of
+        the alternatives (see MorphSeq.boundaries) and the offsets of
+        the alternatives in the array.
+
+        """
+        self._compact()
+        if 'boundaries' not in self._cache:
+            morph_lengths = np.fromiter((len(morph) for morph in self.morph_list), dtype=np.int64, count=self.n_morphs)
+            ends = np.cumsum(morph_lengths[self._morph_ids])
+            alt_starts = np.concatenate([[0], ends])[self._alt_offsets]
+            sizes = np.maximum(np.diff(alt_starts) - 1, 0)
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+            occurrence_alts = np.repeat(np.arange(len(sizes)), np.diff(self._alt_offsets))
+            # Index of the last character of each morph within its alternative
+            positions = ends - 1 - alt_starts[occurrence_alts]
+            keep = (positions >= 0) & (positions < sizes[occurrence_alts])
+            vectors = np.zeros(offsets[-1], dtype=np.uint8)
+            vectors[offsets[occurrence_alts[keep]] + positions[keep]] = 1
+            self._cache['boundaries'] = (vectors, offsets)
+        return self._cache['boundaries']
+
+    @classmethod
+    def from_file(cls, inputfile, vocab=None, cache_dir=None, workers=None, progress=None):
+        """Create AnalysisSet from file
+
+        The inputfile is either a text file object or a path opened
+        with open_analysis_file (so it can be compressed or '-' for
+        standard input). If cache_dir is given and inputfile is a
+        regular file, the parsed analyses are saved in cache_dir under
+        a key computed from the file contents and vocab, and later calls
+        with the same file and vocab load the saved set instead of
+        parsing the file. If workers is larger than one, a large
+        uncompressed file given as a path is parsed in parallel (see
+        load_parallel). The progress of parsing is reported to
+        progress (see load).
+
+        """
+        with phase('load') as counts:
+            obj = cls._from_cached_input(inputfile, vocab=vocab, cache_dir=cache_dir, workers=workers,
+                                         progress=progress)
+            counts.update(words=obj.n_words, morphs=obj.n_morphs, morph_tokens=len(obj.morph_ids))
+        return obj
+
+    @classmethod
+    def _from_cached_input(cls, inputfile, vocab=None, cache_dir=None, workers=None, progress=None):
+        """Create AnalysisSet from a file object or path using the cache directory if given"""
+        path = inputfile if isinstance(inputfile, str) else getattr(inputfile, 'name', None)
+        if cache_dir is None or not isinstance(path, str) or not os.path.isfile(path):
+            return cls._from_input(inputfile, vocab=vocab, workers=workers, progress=progress)
+        target = os.path.join(cache_dir, cache_key(path, vocab=vocab))
+        if os.path.isdir(target):
+            logger.info("Loading cached analyses for %s from %s", path, target)
+            return cls.from_saved(target)
+        obj = cls._from_input(inputfile, vocab=vocab, workers=workers, progress=progress)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+        obj.save(tmpdir)
+        try:
+            os.rename(tmpdir, target)
+        except OSError:
+            # Saved concurrently by another process
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        else:
+            logger.info("Saved analyses for %s to %s", path, target)
+        return obj
+
+    @classmethod
+    def _from_input(cls, inputfile, vocab=None, workers=None, progress=None):
+        """Create AnalysisSet from a file object or path without caching"""
+        obj = cls()
+        if not isinstance(inputfile, str):
+            obj.load(inputfile, vocab=vocab, progress=progress)
+            return obj
+        if workers and workers > 1 and os.path.isfile(inputfile) and \
+                os.path.getsize(inputfile) >= PARALLEL_PARSE_SIZE:
+            with open(inputfile, 'rb') as fobj:
+                compressed = detect_compression(fobj.read(6))
+            if not compressed:
+                obj.load_parallel(inputfile, workers, vocab=vocab, progress=progress)
+                return obj
+        with open_analysis_file(inputfile) as fobj:
+            obj.load(fobj, vocab=vocab, progress=progress)
+        return obj
+
+    def save(self, directory):
+        """Save the analyses to a directory
+
+        The arrays are saved as .npy files that from_saved maps to
+        memory, and the words and morphs as text files with one item
+        per line.
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in ('word_offsets', 'alt_offsets', 'morph_ids'):
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+        for name, items in (('words', self.words), ('morphs', self.morph_list)):
+            with open(os.path.join(directory, f'{name}.txt'), 'w', encoding='utf-8') as fobj:
+                fobj.write('\n'.join(items))
 
     @classmethod
-    def from_file(cls, inputfile, vocab=None):
-        """Create AnalysisSet from file"""
+    def from_saved(cls, directory):
+        """Create AnalysisSet from a directory written by save
+
+        The arrays are memory-mapped read-only; adding analyses to the
+        set creates new arrays.
+
+        """
         obj = cls()
-        obj.load(inputfile, vocab=vocab)
+        items = []
+        for name in ('words', 'morphs'):
+            with open(os.path.join(directory, f'{name}.txt'), encoding='utf-8') as fobj:
+                text = fobj.read()
+            items.append(text.split('\n') if text else [])
+        obj.words, obj.morph_list = items
+        obj.word_ids = dict(zip(obj.words, range(len(obj.words))))
+        obj.morphs = dict(zip(obj.morph_list, range(len(obj.morph_list))))
+        obj._word_offsets = np.load(os.path.join(directory, 'word_offsets.npy'), mmap_mode='r')
+        obj._alt_offsets = np.load(os.path.join(directory, 'alt_offsets.npy'), mmap_mode='r')
+        obj._morph_ids = np.load(os.path.join(directory, 'morph_ids.npy'), mmap_mode='r')
         return obj
 
     def add(self, word, analysis):
         """Add analysis for a word"""
-        mseq = MorphSeq(analysis)
-        for morph in mseq.unique():
+        analysis = list(analysis)
+        word_idx = self.word_ids.get(word)
+        if word_idx is None:
+            word_idx = self.word_ids[word] = len(self.words)
+            self.words.append(word)
+        for morph in sorted(set(analysis)):
             if morph not in self.morphs:
-                self.morphs[morph] = self.n_morphs
-                self.n_morphs += 1
-        self.analyses[word].append(mseq)
+                self.morphs[morph] = len(self.morph_list)
+                self.morph_list.append(morph)
+        self._pending_words.append(word_idx)
+        self._pending_lengths.append(len(analysis))
+        self._pending_ids.extend(self.morphs[morph] for morph in analysis)
 
-    def load(self, inputfile, vocab=None):
+    def load(self, inputfile, vocab=None, chunk_size=CHUNK_SIZE, progress=None):
         """Load segmentations from given input file object
 
-        Given a container vocab, load only the words found in it.
+        Given a container vocab, load only the words found in it. The
+        file is parsed in chunks of chunk_size characters (or lines, if
+        inputfile is an iterable of lines instead of a file object),
+        and the number of lines parsed is reported to progress after
+        each chunk (see the progress module).
 
         """
-        for line in tqdm.tqdm(inputfile):
-            if line[0] == '#':
-                continue
-            word, rest = line.split("\t")
-            if vocab and word not in vocab:
-                continue
-            for alternative in rest.split(', '):
-                self.add(word, alternative.split())
+        if hasattr(inputfile, 'read'):
+            chunks = self._read_chunks(inputfile, chunk_size)
+        else:
+            line_iter = iter(inputfile)
+            chunks = iter(lambda: list(itertools.islice(line_iter, chunk_size)), [])
+        n_lines = 0
+        report(progress, 'load', n_lines, unit='lines')
+        with gc_disabled():
+            for lines in chunks:
+                self.add_parsed(parse_lines(lines, vocab=vocab))
+                n_lines += len(lines)
+                report(progress, 'load', n_lines, unit='lines')
+        report(progress, 'load', n_lines, unit='lines', finished=True)
+
+    @staticmethod
+    def _read_chunks(inputfile, chunk_size):
+        """Yield lists of complete lines read from a text file in chunks"""
+        remainder = ''
+        while True:
+            text = inputfile.read(chunk_size)
+            if not text:
+                break
+            text = remainder + text
+            end = text.rfind('\n') + 1
+            remainder = text[end:]
+            if end:
+                yield text[:end - 1].split('\n')
+        if remainder:
+            yield [remainder]
+
+    def load_parallel(self, path, workers, vocab=None, encoding=None, progress=None):
+        """Load segmentations from an uncompressed file in worker processes
+
+        The file is split to byte ranges at line boundaries, the ranges
+        are parsed in a pool of worker processes, and the results are
+        added in the file order, so that the words and morph ids are
+        the same as with load. The number of ranges added is reported
+        to progress.
+
+        """
+        import multiprocessing
+        encoding = encoding or locale.getpreferredencoding(False)
+        if vocab and not isinstance(vocab, (set, frozenset, dict)):
+            vocab = set(vocab.words if isinstance(vocab, AnalysisSet) else vocab)
+        tasks = [(path, start, end, encoding) for start, end in line_ranges(path, 4 * workers)]
+        with multiprocessing.Pool(workers, initializer=_init_parser, initargs=(vocab,)) as pool, gc_disabled():
+            for parsed in track(pool.imap(_parse_range, tasks), progress, 'load', total=len(tasks), unit='chunks'):
+                self.add_parsed(parsed)
+
+    def add_parsed(self, parsed):
+        """Add analyses parsed with parse_lines
+
+        The new morphs get the same ids as when adding the analyses one
+        by one with add: in the order of the first analysis that
+        contains them, and alphabetically within the analysis.
+
+        """
+        words, n_alternatives, lengths, morphs, codes = parsed
+        unique = dict.fromkeys(words)
+        if len(unique) == len(words) and self.word_ids.keys().isdisjoint(unique.keys()):
+            # Usual case: each line has a new word
+            word_idx = np.arange(self.n_words, self.n_words + len(words))
+            self.word_ids.update(zip(words, word_idx.tolist()))
+            self.words.extend(words)
+        else:
+            new_words = [word for word in unique if word not in self.word_ids]
+            self.word_ids.update(zip(new_words, range(self.n_words, self.n_words + len(new_words))))
+            self.words.extend(new_words)
+            word_idx = np.fromiter(map(self.word_ids.__getitem__, words), dtype=np.int64, count=len(words))
+        morph_ids = np.fromiter(map(self.morphs.get, morphs, itertools.repeat(-1)), dtype=np.int64, count=len(morphs))
+        new = np.flatnonzero(morph_ids < 0)
+        if len(new):
+            # The codes are numbered in the order of first occurrence
+            previous = np.concatenate([[-1], np.maximum.accumulate(codes)[:-1]])
+            first_alternative = np.repeat(np.arange(len(lengths)), lengths)[codes > previous]
+            new_morphs = [morphs[idx] for idx in new.tolist()]
+            ranks = np.empty(len(new), dtype=np.int64)
+            ranks[sorted(range(len(new)), key=new_morphs.__getitem__)] = np.arange(len(new))
+            new = new[np.lexsort((ranks, first_alternative[new]))]
+            morph_ids[new] = np.arange(self.n_morphs, self.n_morphs + len(new))
+            new_morphs = [morphs[idx] for idx in new.tolist()]
+            self.morphs.update(zip(new_morphs, morph_ids[new].tolist()))
+            self.morph_list.extend(new_morphs)
+        self._pending_words.frombytes(np.repeat(word_idx, n_alternatives).astype(np.int64).tobytes())
+        self._pending_lengths.frombytes(lengths.astype(np.int64).tobytes())
+        self._pending_ids.frombytes(morph_ids[codes].astype(np.int32).tobytes())
 
     def get_word_index(self):
         """Return index for the current set of words"""
-        return {word: idx for idx, word in enumerate(self.analyses)}
+        return dict(self.word_ids)
+
+    def precompute(self):
+        """Build the derived data structures used by the metrics in advance
+
+        Useful for a gold standard that is evaluated against many sets
+        of predictions: the boundary vectors, the similarity index, and
+        the word-morpheme matrices of all words are kept until new
+        analyses are added, and to_word_morpheme_matrix selects its
+        rows from the stored matrices.
+
+        """
+        self.boundary_vectors()
+        self._similarity_index()
+        word_index = dict(self.word_ids)
+        # Add an empty last row for the words missing from the set
+        word_index[None] = self.n_words
+        for binary in (True, False):
+            self._cache[('word_morpheme', binary)] = self.to_word_morpheme_matrix(word_index, binary=binary)
 
     def to_word_morpheme_matrix(self, word_index, selected_alternatives=None, binary=True):
-        """Return bipartite word-morpheme graph as a sparse matrix"""
+        """Return bipartite word-morpheme graph as a sparse matrix
+
+        The rows are given by word_index and the columns by the morph
+        ids. If binary is True, the values are one for each morph
+        present in any of the analyses of the word; otherwise the
+        values are the morph counts summed over the analyses. If
+        selected_alternatives is given, only the analysis with the
+        given index is used for each word.
+
+        """
+        from scipy.sparse import coo_matrix
         n_words = len(word_index)
-        array = lil_matrix((n_words, self.n_morphs), dtype=int)
-        for word, analyses in tqdm.tqdm(self.analyses.items()):
-            if word not in word_index:
-                continue
-            vec = np.zeros(self.n_morphs)
-            if selected_alternatives:
-                analyses = [analyses[selected_alternatives[word]]]
-            for mseq in analyses:
-                if binary:
-                    for morph in mseq.unique():
-                        vec[self.morphs[morph]] = 1
-                else:
-                    for morph, count in mseq.counts().items():
-                        vec[self.morphs[morph]] += count
-            array[word_index[word], :] = vec
-        return array.tocsr()
+        word_offsets, alt_offsets, morph_ids = self.word_offsets, self.alt_offsets, self.morph_ids
+        full = self._cache.get(('word_morpheme', binary))
+        if full is not None and not selected_alternatives:
+            # Select the rows from the matrix built by precompute; the last row is empty
+            rows = np.full(n_words, self.n_words, dtype=np.int64)
+            rows[np.fromiter(word_index.values(), dtype=np.int64, count=n_words)] = np.fromiter(
+                (self.word_ids.get(word, self.n_words) for word in word_index), dtype=np.int64, count=n_words)
+            return full[rows]
+        word_rows = np.fromiter((word_index.get(word, -1) for word in self.words),
+                                dtype=np.int64, count=self.n_words)
+        if selected_alternatives:
+            included = np.flatnonzero(word_rows >= 0)
+            alts = word_offsets[included] + np.fromiter(
+                (selected_alternatives[self.words[idx]] for idx in included.tolist()),
+                dtype=np.int64, count=len(included))
+            alt_rows = word_rows[included]
+        else:
+            alt_rows = np.repeat(word_rows, np.diff(word_offsets))
+            alts = np.flatnonzero(alt_rows >= 0)
+            alt_rows = alt_rows[alts]
+        alt_lengths = alt_offsets[alts + 1] - alt_offsets[alts]
+        rows = np.repeat(alt_rows, alt_lengths)
+        cols = morph_ids[segment_indices(alt_offsets[alts], alt_lengths)]
+        array = coo_matrix((np.ones(len(rows), dtype=int), (rows, cols)),
+                           shape=(n_words, self.n_morphs)).tocsr()
+        array.sum_duplicates()
+        if binary:
+            array.data[:] = 1
+        return array
+
+    def word_morpheme_rows(self, word_ids, binary=True):
+        """Return the word-morpheme matrix of the words with the given ids
+
+        The same as the rows of to_word_morpheme_matrix, but the work
+        is proportional to the number of given words. Ids below zero
+        give empty rows.
+
+        """
+        from scipy.sparse import coo_matrix
+        word_ids = np.asarray(word_ids, dtype=np.int64)
+        present = np.flatnonzero(word_ids >= 0)
+        n_alts = self.word_offsets[word_ids[present] + 1] - self.word_offsets[word_ids[present]]
+        alts = segment_indices(self.word_offsets[word_ids[present]], n_alts)
+        alt_lengths = self.alt_offsets[alts + 1] - self.alt_offsets[alts]
+        rows = np.repeat(np.repeat(present, n_alts), alt_lengths)
+        cols = self.morph_ids[segment_indices(self.alt_offsets[alts], alt_lengths)]
+        array = coo_matrix((np.ones(len(rows), dtype=int), (rows, cols)),
+                           shape=(len(word_ids), self.n_morphs)).tocsr()
+        array.sum_duplicates()
+        if binary:
+            array.data[:] = 1
+        return array
 
     def to_word_matrix(self, word_index, diagonals=False):
         """Return word graph as a sparse matrix
@@ -121,9 +884,11 @@ class AnalysisSet:
         logger.info("Creating word-morpheme matrix")
         word_morpheme_graph = self.to_word_morpheme_matrix(word_index)
         logger.info("Creating word-word matrix")
-        word_graph = word_morpheme_graph @ word_morpheme_graph.T
-        if not diagonals:
-            word_graph.setdiag(0)
+        with phase('word-matrix') as counts:
+            word_graph = word_morpheme_graph @ word_morpheme_graph.T
+            if not diagonals:
+                word_graph.setdiag(0)
+            counts['nnz'] = int(word_graph.nnz)
         return word_graph
 
     @staticmethod
@@ -137,18 +902,68 @@ class AnalysisSet:
                 array[idx1, idx2] = sum(min(counts2[morph], count) for morph, count in counts1.items())
         return array
 
+    def _similarity_index(self):
+        """Return cached data structures for word similarity computations
+
+        Returns a list of binary (n_alternatives, n_morphs) matrices,
+        in which the matrix k marks the morphs occurring at least k + 1
+        times in the alternative, the posting lists from morphs to the
+        alternatives containing them as a (n_morphs, n_alternatives)
+        matrix, and the word index of each alternative.
+
+        """
+        self._compact()
+        if 'similarity' not in self._cache:
+            from scipy.sparse import coo_matrix
+            alt_lengths = np.diff(self._alt_offsets)
+            alt_rows = np.repeat(np.arange(len(alt_lengths)), alt_lengths)
+            counts = coo_matrix((np.ones(len(alt_rows), dtype=int), (alt_rows, self._morph_ids)),
+                                shape=(len(alt_lengths), self.n_morphs)).tocsr()
+            counts.sum_duplicates()
+            max_count = counts.data.max() if counts.nnz else 1
+            levels = [(counts >= level).astype(int) for level in range(1, max_count + 1)]
+            postings = levels[0].T.tocsr()
+            alt_words = np.repeat(np.arange(self.n_words), np.diff(self._word_offsets))
+            self._cache['similarity'] = (levels, postings, alt_words)
+        return self._cache['similarity']
+
     def word_similarity_matrix(self, word, word_index, diagonals=False):
-        """Return the similarity of all analyses of word to other words"""
+        """Return the similarity of all analyses of word to other words
+
+        The value for each word in word_index and each alternative
+        analysis of word is the maximum number of common morphs between
+        the alternative and the analyses of the other word. Only the
+        words that share at least one morph with word are considered.
+
+        """
+        from scipy.sparse import csr_matrix
         n_words = len(word_index)
-        analyses = self.analyses[word]
-        array = lil_matrix((n_words, len(analyses)), dtype=int)
-        for word2, analyses2 in tqdm.tqdm(self.analyses.items()):
-            if word not in word_index:
-                continue
-            if word == word2 and not diagonals:
-                continue
-            array[word_index[word2], :] = self.common_morphs_array(analyses, analyses2).max(1)
-        return array.tocsr()
+        word_idx = self.word_ids.get(word)
+        if word_idx is None:
+            return csr_matrix((n_words, 0), dtype=int)
+        levels, postings, alt_words = self._similarity_index()
+        first, last = self._word_offsets[word_idx], self._word_offsets[word_idx + 1]
+        n_alts = last - first
+        query = [level[first:last] for level in levels]
+        alts = np.unique(postings[query[0].indices].indices)
+        if not len(alts):
+            return csr_matrix((n_words, n_alts), dtype=int)
+        # Sum of minimum counts over the morphs for each pair of alternatives
+        common = sum(qlevel @ level[alts].T for qlevel, level in zip(query, levels)).toarray()
+        cand_words = alt_words[alts]
+        group_starts = np.flatnonzero(np.concatenate([[True], cand_words[1:] != cand_words[:-1]]))
+        similarities = np.maximum.reduceat(common, group_starts, axis=1)
+        cand_words = cand_words[group_starts]
+        rows = np.fromiter((word_index.get(self.words[idx], -1) for idx in cand_words.tolist()),
+                           dtype=np.int64, count=len(cand_words))
+        keep = rows >= 0
+        if not diagonals:
+            keep &= cand_words != word_idx
+        rows = rows[keep]
+        array = csr_matrix((similarities[:, keep].T.ravel(), (np.repeat(rows, n_alts), np.tile(np.arange(n_alts), len(rows)))),
+                           shape=(n_words, n_alts), dtype=int)
+        array.eliminate_zeros()
+        return array
 
     @staticmethod
     def common_morphs(analysis1, analysis2):
@@ -162,15 +977,17 @@ class AnalysisSet:
                 max_ = max(sum_, max_)
         return max_
 
-    def to_word_matrix_direct(self, word_index, diagonals=False):
+    def to_word_matrix_direct(self, word_index, diagonals=False, progress=None):
         """Return word graph as a sparse matrix
 
-        Memory-efficient but slow.
+        Memory-efficient but slow. The progress over the words is
+        reported to progress.
 
         """
+        from scipy.sparse import lil_matrix
         n_words = len(word_index)
         array = lil_matrix((n_words, n_words), dtype=int)
-        for word, analysis in tqdm.tqdm(self.analyses.items()):
+        for word, analysis in track(self.analyses.items(), progress, 'word-matrix', unit='words'):
             if word not in word_index:
                 continue
             vec = np.zeros(n_words)
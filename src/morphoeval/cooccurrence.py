@@ -1,17 +1,21 @@
 """Methods for co-occurrence based evaluation"""
 
+import collections
 import logging
 
-import munkres
 import numpy as np
-from scipy.sparse import csr_matrix
-import tqdm
 
-from .common import vector_recall
+from .common import average_terms, segment_indices, strict_matching
+from .planning import word_graph_plan
+from .profiling import phase
+from .progress import track
 
 
 logger = logging.getLogger(__name__)
 
+# Default number of words in a chunk of the chunked EMMA evaluation
+CHUNK_WORDS = 1 << 16
+
 
 def word_graph_recall(gold, pred):
     """Calucate recall from word co-occurrence graph"""
@@ -25,136 +29,664 @@ def word_graph_recall(gold, pred):
     return recall.mean().item() if recall.shape[1] else 1.0
 
 
-def comma(goldlist, predlist, diagonals=False):
-    """Return precision and recall from CoMMA"""
+def word_graph_blocks(gold_word_morpheme_graph, pred_word_morpheme_graph, block_size=None, rows=None):
+    """Yield blocks of rows of the gold and predicted word graphs
+
+    The word graphs, including the diagonals, are computed from the
+    word-morpheme graphs for block_size rows at a time, or for all rows
+    at once if block_size is None. If rows is given, only the rows with
+    the given indices are computed. Yields the indices of the rows and
+    the gold and predicted blocks.
+
+    """
+    rows = np.arange(gold_word_morpheme_graph.shape[0]) if rows is None else np.asarray(rows, dtype=np.int64)
+    block_size = block_size or max(len(rows), 1)
+    gold_transpose = gold_word_morpheme_graph.T.tocsr()
+    pred_transpose = pred_word_morpheme_graph.T.tocsr()
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        gold_block = gold_word_morpheme_graph[block_rows] @ gold_transpose
+        pred_block = pred_word_morpheme_graph[block_rows] @ pred_transpose
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Gold word graph rows %s:\n%s", block_rows, gold_block.toarray())
+            logger.debug("Pred word graph rows %s:\n%s", block_rows, pred_block.toarray())
+        yield block_rows, gold_block, pred_block
+
+
+WordGraphCounts = collections.namedtuple('WordGraphCounts', ['hits', 'gold_totals', 'pred_totals', 'gold_self', 'pred_self'])
+WordGraphCounts.__doc__ = """Per-row sums of shared, gold, and predicted edge weights and diagonal weights of word graphs"""
+
+
+def word_graph_counts(gold_word_morpheme_graph, pred_word_morpheme_graph, block_size=None, rows=None):
+    """Return WordGraphCounts for the rows of the word graphs
+
+    The counts are computed from the word graph blocks (see
+    word_graph_blocks) for all rows or for the given rows.
+
+    """
+    n_rows = gold_word_morpheme_graph.shape[0] if rows is None else len(rows)
+    counts = WordGraphCounts(*(np.zeros(n_rows, dtype=np.int64) for _ in WordGraphCounts._fields))
+    start = 0
+    with phase('word-graphs', rows=n_rows, gold_nnz=0, pred_nnz=0) as phase_counts:
+        for block_rows, gold_block, pred_block in word_graph_blocks(
+                gold_word_morpheme_graph, pred_word_morpheme_graph, block_size=block_size, rows=rows):
+            end = start + len(block_rows)
+            local = np.arange(len(block_rows))
+            counts.hits[start:end] = np.asarray(gold_block.minimum(pred_block).sum(1)).ravel()
+            counts.gold_totals[start:end] = np.asarray(gold_block.sum(1)).ravel()
+            counts.pred_totals[start:end] = np.asarray(pred_block.sum(1)).ravel()
+            counts.gold_self[start:end] = np.asarray(gold_block[local, block_rows]).ravel()
+            counts.pred_self[start:end] = np.asarray(pred_block[local, block_rows]).ravel()
+            phase_counts['gold_nnz'] += int(gold_block.nnz)
+            phase_counts['pred_nnz'] += int(pred_block.nnz)
+            start = end
+    return counts
+
+
+def word_graph_row(word_morpheme_graph, transpose, row):
+    """Return the neighbours of a word in the word graph and the weights of the edges
+
+    The row of the word graph is computed directly from the posting
+    lists of the morphs of the word in the transposed word-morpheme
+    graph. The neighbours are sorted and include the word itself.
+
+    """
+    start, end = word_morpheme_graph.indptr[row], word_morpheme_graph.indptr[row + 1]
+    morphs = word_morpheme_graph.indices[start:end]
+    lengths = transpose.indptr[morphs + 1] - transpose.indptr[morphs]
+    positions = segment_indices(transpose.indptr[morphs], lengths)
+    neighbours, inverse = np.unique(transpose.indices[positions], return_inverse=True)
+    weights = np.bincount(inverse.ravel(), minlength=len(neighbours),
+                          weights=transpose.data[positions] * np.repeat(word_morpheme_graph.data[start:end], lengths))
+    return neighbours, weights.astype(np.int64)
+
+
+def word_graph_counts_direct(gold_word_morpheme_graph, pred_word_morpheme_graph, rows=None, progress=None):
+    """Return WordGraphCounts computing the word graphs one row at a time
+
+    The counts are the same as from word_graph_counts, but only the
+    neighbours of a single word are stored at a time (see
+    word_graph_row). Memory-efficient but slow; the progress over the
+    rows is reported to progress.
+
+    """
+    rows = np.arange(gold_word_morpheme_graph.shape[0]) if rows is None else np.asarray(rows, dtype=np.int64)
+    counts = WordGraphCounts(*(np.zeros(len(rows), dtype=np.int64) for _ in WordGraphCounts._fields))
+    gold_transpose = gold_word_morpheme_graph.T.tocsr()
+    pred_transpose = pred_word_morpheme_graph.T.tocsr()
+    with phase('word-graphs', rows=len(rows), gold_nnz=0, pred_nnz=0) as phase_counts:
+        for idx, row in enumerate(track(rows.tolist(), progress, 'word-graphs', unit='words')):
+            gold_neighbours, gold_weights = word_graph_row(gold_word_morpheme_graph, gold_transpose, row)
+            pred_neighbours, pred_weights = word_graph_row(pred_word_morpheme_graph, pred_transpose, row)
+            _, gold_shared, pred_shared = np.intersect1d(gold_neighbours, pred_neighbours, assume_unique=True,
+                                                         return_indices=True)
+            counts.hits[idx] = np.minimum(gold_weights[gold_shared], pred_weights[pred_shared]).sum()
+            counts.gold_totals[idx] = gold_weights.sum()
+            counts.pred_totals[idx] = pred_weights.sum()
+            for neighbours, weights, self_counts in ((gold_neighbours, gold_weights, counts.gold_self),
+                                                     (pred_neighbours, pred_weights, counts.pred_self)):
+                position = np.searchsorted(neighbours, row)
+                if position < len(neighbours) and neighbours[position] == row:
+                    self_counts[idx] = weights[position]
+            phase_counts['gold_nnz'] += len(gold_neighbours)
+            phase_counts['pred_nnz'] += len(pred_neighbours)
+    return counts
+
+
+def word_graph_counts_by_plan(gold_word_morpheme_graph, pred_word_morpheme_graph, plan, rows=None, progress=None):
+    """Return WordGraphCounts for the given rows (or all) with the construction of a planning.WordGraphPlan
+
+    The progress of the direct construction is reported to progress.
+
+    """
+    if plan.engine == 'direct':
+        return word_graph_counts_direct(gold_word_morpheme_graph, pred_word_morpheme_graph, rows=rows,
+                                        progress=progress)
+    return word_graph_counts(gold_word_morpheme_graph, pred_word_morpheme_graph, block_size=plan.block_size, rows=rows)
+
+
+def planned_word_graph_counts(gold_word_morpheme_graph, pred_word_morpheme_graph, block_size=None,
+                              memory_limit=None, progress=None):
+    """Return WordGraphCounts for all rows and the planning.WordGraphPlan chosen for building them
+
+    The progress of the direct construction is reported to progress.
+
+    """
+    plan = word_graph_plan(gold_word_morpheme_graph, pred_word_morpheme_graph, memory_limit=memory_limit,
+                           block_size=block_size)
+    logger.info("Building the word graphs with the %s engine (block size %s, estimated %s non-zeros and %s bytes)",
+                plan.engine, plan.block_size, plan.estimated_nnz, plan.estimated_memory)
+    return word_graph_counts_by_plan(gold_word_morpheme_graph, pred_word_morpheme_graph, plan, progress=progress), plan
+
+
+def word_graph_terms(counts, diagonals=(False,)):
+    """Return per-word precision and recall terms from WordGraphCounts
+
+    Returns a list of (precisions, recalls) arrays, one for each value
+    in diagonals. The rows excluded from the averages, i.e. those
+    without any edges, have NaN terms.
+
+    """
+    terms = []
+    for option in diagonals:
+        if option:
+            hits, gold_totals, pred_totals = counts.hits, counts.gold_totals, counts.pred_totals
+        else:
+            hits = counts.hits - np.minimum(counts.gold_self, counts.pred_self)
+            gold_totals = counts.gold_totals - counts.gold_self
+            pred_totals = counts.pred_totals - counts.pred_self
+        precisions, recalls = np.full(len(hits), np.nan), np.full(len(hits), np.nan)
+        recalls[gold_totals > 0] = hits[gold_totals > 0] / gold_totals[gold_totals > 0]
+        precisions[pred_totals > 0] = hits[pred_totals > 0] / pred_totals[pred_totals > 0]
+        terms.append((precisions, recalls))
+    return terms
+
+
+def word_graph_scores(gold_word_morpheme_graph, pred_word_morpheme_graph, diagonals=(False,), block_size=None,
+                      memory_limit=None):
+    """Calculate precision and recall from word co-occurrence graphs
+
+    Returns a list of (precision, recall) tuples, one for each value
+    in diagonals, computed from the same word graph blocks (see
+    planned_word_graph_counts). The values are the same as those from
+    word_graph_recall applied to the full word graphs. With a
+    block_size or a memory_limit in bytes that the full word graphs
+    would exceed, they are never stored in memory.
+
+    """
+    counts, _ = planned_word_graph_counts(gold_word_morpheme_graph, pred_word_morpheme_graph, block_size=block_size,
+                                          memory_limit=memory_limit)
+    return [(average_terms(precisions), average_terms(recalls))
+            for precisions, recalls in word_graph_terms(counts, diagonals=diagonals)]
+
+
+def comma(goldlist, predlist, diagonals=False, block_size=None, memory_limit=None):
+    """Return precision and recall from CoMMA
+
+    If block_size is given, the word graphs are processed in blocks of
+    block_size rows, which limits the memory usage for large inputs.
+    With memory_limit in bytes, the construction of the word graphs
+    is chosen to fit the limit (see planning.word_graph_plan).
+
+    """
     windex = predlist.get_word_index()
-    gold_word_graph = goldlist.to_word_matrix(windex, diagonals=diagonals)
-    pred_word_graph = predlist.to_word_matrix(windex, diagonals=diagonals)
-    logger.debug("Gold word graph:\n%s", gold_word_graph.toarray())
-    logger.debug("Pred word graph:\n%s", pred_word_graph.toarray())
-    logger.info("Calculating precision")
-    pre = word_graph_recall(pred_word_graph, gold_word_graph)
-    logger.info("Calculating recall")
-    rec = word_graph_recall(gold_word_graph, pred_word_graph)
+    logger.info("Creating word-morpheme matrices")
+    gold_word_morpheme_graph = goldlist.to_word_morpheme_matrix(windex)
+    pred_word_morpheme_graph = predlist.to_word_morpheme_matrix(windex)
+    logger.info("Calculating precision and recall")
+    [(pre, rec)] = word_graph_scores(gold_word_morpheme_graph, pred_word_morpheme_graph,
+                                     diagonals=[diagonals], block_size=block_size, memory_limit=memory_limit)
     return pre, rec
 
 
+def strict_comma_pair_scores(gold_sim, pred_sim, exclude_row=None):
+    """Return scores for all pairs of gold and predicted alternatives of a word
+
+    Takes the word similarity matrices of the gold and predicted
+    analyses (see AnalysisSet.word_similarity_matrix) and optionally
+    a row to ignore. Returns the precisions and recalls as (n_gold,
+    n_pred) arrays and the numbers of predicted and gold alternatives
+    with non-zero similarities.
+
+    """
+    rows = np.union1d(gold_sim.nonzero()[0], pred_sim.nonzero()[0])
+    if exclude_row is not None:
+        rows = rows[rows != exclude_row]
+    gold_dense = gold_sim[rows].toarray()
+    pred_dense = pred_sim[rows].toarray()
+    hits = np.minimum(gold_dense[:, :, None], pred_dense[:, None, :]).sum(0)
+    gold_totals = gold_dense.sum(0)
+    pred_totals = pred_dense.sum(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recalls = np.where(gold_totals[:, None] > 0, hits / gold_totals[:, None], 0.0)
+        precisions = np.where(pred_totals[None, :] > 0, hits / pred_totals[None, :], 0.0)
+    return precisions, recalls, (pred_totals > 0).sum(), (gold_totals > 0).sum()
+
+
 def strict_comma_eval(gold_sim, pred_sim, beta=1):
     """Make optimal match for alternative gold and pred analyses and return scores"""
     logger.debug(pred_sim.toarray().T)
     logger.debug(gold_sim.toarray().T)
-    gold_altnum = gold_sim.shape[1]
-    pred_altnum = pred_sim.shape[1]
-    if gold_altnum == 1 and pred_altnum == 1:
-        rec_val, rec_nz = vector_recall(gold_sim, pred_sim)
-        pre_val, pre_nz = vector_recall(pred_sim, gold_sim)
-    else:
-        n_max = max(gold_altnum, pred_altnum)
-        recalls = np.zeros((n_max, n_max))
-        precisions = np.zeros((n_max, n_max))
-        costs = np.ones((n_max, n_max))
-        for gold_idx in range(gold_altnum):
-            for pred_idx in range(pred_altnum):
-                rec, rec_nz_t = vector_recall(gold_sim[:, gold_idx], pred_sim[:, pred_idx])
-                pre, pre_nz_t = vector_recall(pred_sim[:, pred_idx], gold_sim[:, gold_idx])
-                if rec_nz_t == 0:
-                    rec = 0
-                if pre_nz_t == 0:
-                    pre = 0
-                fscore = (1 + beta**2) * pre * rec / (beta**2 * pre + rec) if pre + rec > 0 else 0
-                recalls[gold_idx, pred_idx] = rec
-                precisions[gold_idx, pred_idx] = pre
-                costs[gold_idx, pred_idx] = 1 - fscore
-        indexes = munkres.Munkres().compute(costs)
-        if n_max > 1:
-            logger.debug("Costs:\n%s", costs)
-            logger.debug("Matching: %s", indexes)
-        pre_t, rec_t = 0, 0
-        for gold_idx, pred_idx in indexes:
-            pre_t += precisions[gold_idx, pred_idx].item()
-            rec_t += recalls[gold_idx, pred_idx].item()
-        pre_val = pre_t / pred_altnum
-        rec_val = rec_t / gold_altnum
-        rec_nz = (gold_sim.sum(0) > 0).sum()
-        pre_nz = (pred_sim.sum(0) > 0).sum()
+    precisions, recalls, pre_nz, rec_nz = strict_comma_pair_scores(gold_sim, pred_sim)
+    gold_altnum, pred_altnum = recalls.shape
+    pre_sums, rec_sums = strict_matching(precisions.ravel(), recalls.ravel(), np.zeros(1, dtype=np.int64),
+                                         np.array([gold_altnum]), np.array([pred_altnum]), beta=beta)
+    pre_val = pre_sums[0].item() / pred_altnum
+    rec_val = rec_sums[0].item() / gold_altnum
     logger.debug("rec: %s %s", rec_val, rec_nz)
     logger.debug("pre: %s %s", pre_val, pre_nz)
     return pre_val, rec_val, pre_nz, rec_nz
 
 
-def comma_strict(goldlist, predlist, diagonals=False, beta=1):
-    """Return precision and recall from CoMMA-S"""
-    word_index = predlist.get_word_index()
-    pre_sum, rec_sum, pre_n, rec_n = 0, 0, 0, 0
-    for word in tqdm.tqdm(predlist.analyses):
-        pred_sim = predlist.word_similarity_matrix(word, word_index, diagonals=diagonals)
-        gold_sim = goldlist.word_similarity_matrix(word, word_index, diagonals=diagonals)
-        logger.debug(word)
-        pre_val, rec_val, pre_nz, rec_nz = strict_comma_eval(gold_sim, pred_sim, beta=beta)
-        if rec_nz > 0:
-            rec_sum += rec_val
-            rec_n += 1
-        if pre_nz > 0:
-            pre_sum += pre_val
-            pre_n += 1
-        logger.debug("rec: %s %s", rec_sum, rec_n)
-        logger.debug("pre: %s %s", pre_sum, pre_n)
-    pre = pre_sum / pre_n if pre_n > 0 else 1.0
-    rec = rec_sum / rec_n if rec_n > 0 else 1.0
+def word_pair_scores(goldlist, predlist, word_index, words, diagonals=(False,), progress=None):
+    """Return the scores of all pairs of alternatives of the given predicted words
+
+    The similarity vectors of each word are computed once and shared
+    between the diagonals options. Returns a dictionary from the
+    options to lists of per-word precisions, recalls, and non-zero
+    counts (see strict_comma_pair_scores), and the numbers of gold and
+    predicted alternatives of the words. The progress over the words
+    is reported to progress (see progress.track).
+
+    """
+    terms = {option: ([], [], [], []) for option in diagonals}
+    n_gold, n_pred = [], []
+    for word in track(words, progress, 'comma-s', unit='words'):
+        pred_sim = predlist.word_similarity_matrix(word, word_index, diagonals=True)
+        gold_sim = goldlist.word_similarity_matrix(word, word_index, diagonals=True)
+        if not gold_sim.shape[1]:
+            raise ValueError(f"No gold standard analyses for word {word}")
+        for option, (precisions, recalls, pre_nz, rec_nz) in terms.items():
+            word_pre, word_rec, word_pre_nz, word_rec_nz = strict_comma_pair_scores(
+                gold_sim, pred_sim, exclude_row=None if option else word_index[word])
+            precisions.append(word_pre.ravel())
+            recalls.append(word_rec.ravel())
+            pre_nz.append(word_pre_nz)
+            rec_nz.append(word_rec_nz)
+        n_gold.append(gold_sim.shape[1])
+        n_pred.append(pred_sim.shape[1])
+    return terms, np.array(n_gold, dtype=np.int64), np.array(n_pred, dtype=np.int64)
+
+
+def comma_strict_shard(goldlist, predlist, word_index, words, diagonals=(False,), beta=1, progress=None,
+                       matchings=False):
+    """Return per-word CoMMA-S terms for the given predicted words
+
+    The similarity vectors are computed word by word (see
+    word_pair_scores), and the optimal matchings between the
+    alternatives are then solved for all words with the same numbers
+    of alternatives at once. Returns a list with a tuple for each
+    value in diagonals: the precisions of the words, a mask for the
+    words included in the precision average, and the same for recall.
+    If matchings is True, the tuples contain also the matched pairs of
+    alternatives (see strict_matching).
+
+    """
+    with phase('word-similarities', words=len(words)):
+        terms, n_gold, n_pred = word_pair_scores(goldlist, predlist, word_index, words, diagonals=diagonals,
+                                                 progress=progress)
+    pair_starts = np.cumsum(n_gold * n_pred) - n_gold * n_pred
+    results = []
+    for option in diagonals:
+        precisions, recalls, pre_nz, rec_nz = terms[option]
+        pre_sums, rec_sums, *pairs = strict_matching(np.concatenate(precisions or [np.zeros(0)]),
+                                                     np.concatenate(recalls or [np.zeros(0)]),
+                                                     pair_starts, n_gold, n_pred, beta=beta, matchings=matchings)
+        results.append((pre_sums / n_pred, np.array(pre_nz, dtype=np.int64) > 0,
+                        rec_sums / n_gold, np.array(rec_nz, dtype=np.int64) > 0, *pairs))
+    return results
+
+
+# Analysis sets of the worker processes, set once per process by _init_worker
+_WORKER_DATA = {}
+
+
+def _init_worker(goldlist, predlist):
+    """Store the analysis sets in a worker process"""
+    _WORKER_DATA['goldlist'] = goldlist
+    _WORKER_DATA['predlist'] = predlist
+    _WORKER_DATA['word_index'] = predlist.get_word_index()
+
+
+def _comma_strict_worker(task):
+    """Return per-word CoMMA-S terms for a range of predicted words"""
+    start, end, diagonals, beta, matchings = task
+    predlist = _WORKER_DATA['predlist']
+    return comma_strict_shard(_WORKER_DATA['goldlist'], predlist, _WORKER_DATA['word_index'],
+                              predlist.words[start:end], diagonals=diagonals, beta=beta, matchings=matchings)
+
+
+def comma_strict_terms(goldlist, predlist, diagonals=(False,), beta=1, workers=None, matchings=False, progress=None):
+    """Return per-word CoMMA-S terms for each value in diagonals
+
+    Returns a list of (precisions, recalls) tuples of arrays over the
+    predicted words, with NaN for the words excluded from the
+    averages. If matchings is True, the tuples contain also the
+    matched pairs of alternatives (see strict_matching).
+
+    If workers is larger than one, the words are split into shards
+    that are evaluated in a pool of worker processes. The analysis
+    sets are sent to each worker only once, and the per-word terms
+    are combined in the original word order, so the results are the
+    same as with a single process.
+
+    The progress over the words (or shards with workers) is reported
+    to progress (see progress.track).
+
+    """
+    if workers and workers > 1:
+        import multiprocessing
+        n_words = predlist.n_words
+        shard_size = max(1, -(-n_words // (4 * workers)))
+        tasks = [(start, min(start + shard_size, n_words), tuple(diagonals), beta, matchings)
+                 for start in range(0, n_words, shard_size)]
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(goldlist, predlist)) as pool:
+            shards = list(track(pool.imap(_comma_strict_worker, tasks), progress, 'comma-s', total=len(tasks),
+                                unit='shards'))
+    else:
+        shards = [comma_strict_shard(goldlist, predlist, predlist.get_word_index(), predlist.words,
+                                     diagonals=diagonals, beta=beta, matchings=matchings, progress=progress)]
+    results = []
+    for idx, _ in enumerate(diagonals):
+        parts = [np.concatenate([shard[idx][field] for shard in shards] or [np.zeros(0)])
+                 for field in range(5 if matchings else 4)]
+        result = (np.where(parts[1], parts[0], np.nan), np.where(parts[3], parts[2], np.nan))
+        results.append(result + (parts[4].reshape(-1, 2),) if matchings else result)
+    return results
+
+
+def comma_strict_scores(goldlist, predlist, diagonals=(False,), beta=1, workers=None, progress=None):
+    """Return precision and recall from CoMMA-S for each value in diagonals
+
+    Use workers to evaluate the words in several processes and
+    progress to report the progress (see comma_strict_terms).
+
+    """
+    # Sum in word order to get the same result as summing word by word
+    return [(average_terms(precisions, sequential=True), average_terms(recalls, sequential=True))
+            for precisions, recalls in comma_strict_terms(goldlist, predlist, diagonals=diagonals, beta=beta,
+                                                          workers=workers, progress=progress)]
+
+
+def comma_strict(goldlist, predlist, diagonals=False, beta=1, workers=None, progress=None):
+    """Return precision and recall from CoMMA-S
+
+    Use workers to evaluate the words in several processes and
+    progress to report the progress (see comma_strict_terms).
+
+    """
+    [(pre, rec)] = comma_strict_scores(goldlist, predlist, diagonals=[diagonals], beta=beta, workers=workers,
+                                       progress=progress)
     return pre, rec
 
 
+def positive_argmax(matrix):
+    """Return the column of the maximum value on each row of a sparse matrix with positive values
+
+    The result is the same as from matrix.argmax(axis=1): the first
+    column with the maximum value, or zero for empty rows.
+
+    """
+    matrix = matrix.tocsr()
+    matrix.sum_duplicates()
+    lengths = np.diff(matrix.indptr)
+    assign = np.zeros(matrix.shape[0], dtype=np.int64)
+    if matrix.nnz:
+        rows = np.repeat(np.arange(matrix.shape[0]), lengths)
+        row_max = np.maximum.reduceat(matrix.data, matrix.indptr[:-1][lengths > 0])
+        maxima = np.flatnonzero(matrix.data == row_max[np.cumsum(lengths > 0)[rows] - 1])
+        # The indices are sorted, so the first maximum of each row has the smallest column
+        _, first = np.unique(rows[maxima], return_index=True)
+        assign[rows[maxima[first]]] = matrix.indices[maxima[first]]
+    return assign
+
+
 def morph_assignment_matrix(morph_cooc_graph):
     """Return sparse morph assignment matrix"""
-    assign = morph_cooc_graph.argmax(axis=1).A1  # A1 is equivalent to np.asarray(x).ravel()
+    from scipy.sparse import csr_matrix
+    assign = positive_argmax(morph_cooc_graph)
     logger.debug("Assignment vector: %s", assign)
     dim = assign.shape[0]
     return csr_matrix((np.ones(dim), (assign, np.arange(dim))),
                       shape=(morph_cooc_graph.shape[1], dim), dtype=int)
 
 
-def morph_graph_recall(gold, pred):
-    """Calucate recall from morph co-occurrence graph"""
-    gold_totals = gold.sum(1)
-    pred_totals = pred.sum(1)
+def morph_graph_terms(gold_totals, pred_totals):
+    """Return per-word recall terms from the morph counts of the words
+
+    The term of a word is the share of its gold morphs covered by the
+    number of mapped predicted morphs; words without gold morphs have
+    NaN terms.
+
+    """
     diff = gold_totals - pred_totals
     error = (abs(diff) + diff) / 2
-    recall = (gold_totals - error).sum(1)
     with np.errstate(divide='ignore', invalid='ignore'):
-        recall = recall / gold_totals
-    recall = recall[~np.isnan(recall)]
-    return recall.mean().item() if recall.shape[1] else 1.0
+        return (gold_totals - error) / gold_totals
+
+
+def morph_graph_recall(gold, pred):
+    """Calucate recall from morph co-occurrence graph"""
+    return average_terms(morph_graph_terms(np.asarray(gold.sum(1)).ravel(), np.asarray(pred.sum(1)).ravel()))
+
+
+def morph_cooccurrences(gold_word_morpheme_graph, pred_word_morpheme_graph):
+    """Return the morph co-occurrence matrix of size (M_gold, M_pred) for word-morpheme count matrices"""
+    logger.info("Creating morph co-occurrence matrix")
+    with phase('morph-cooccurrences') as counts:
+        morph_cooc_graph = gold_word_morpheme_graph.T @ pred_word_morpheme_graph
+        counts['nnz'] = int(morph_cooc_graph.nnz)
+    return morph_cooc_graph
+
+
+def emma2_assignment_counts(morph_cooc_graph):
+    """Return the numbers of morphs assigned to each gold and predicted morph in EMMA-2
+
+    The first array gives the number of predicted morphs assigned to
+    each gold morph (used for precision), and the second the number of
+    gold morphs assigned to each predicted morph (used for recall).
+
+    """
+    # When calculating precision, several predicted morphemes may assigned to one reference morpheme
+    pre_assign = morph_assignment_matrix(morph_cooc_graph.T)
+    # When calculating recall, several reference morphemes may assigned to one predicted morpheme
+    rec_assign = morph_assignment_matrix(morph_cooc_graph)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Precision assignments:\n%s", pre_assign.toarray())
+        logger.debug("Recall assignments:\n%s", rec_assign.toarray())
+    return np.asarray(pre_assign.sum(1)).ravel(), np.asarray(rec_assign.sum(1)).ravel()
+
+
+def assigned_morph_terms(gold_word_morpheme_graph, pred_word_morpheme_graph, gold_assigned, pred_assigned):
+    """Return per-word precision and recall terms from the numbers of assigned morphs
+
+    The number of mapped morphs of a word is the sum of its morph
+    counts weighted by the numbers of morphs assigned to the morphs
+    (see emma2_assignment_counts), so the mapped word-morpheme matrices
+    are never built.
+
+    """
+    pre = morph_graph_terms(np.asarray(pred_word_morpheme_graph.sum(1)).ravel(),
+                            gold_word_morpheme_graph @ gold_assigned)
+    rec = morph_graph_terms(np.asarray(gold_word_morpheme_graph.sum(1)).ravel(),
+                            pred_word_morpheme_graph @ pred_assigned)
+    return pre, rec
+
+
+def emma2_terms(gold_word_morpheme_graph, pred_word_morpheme_graph):
+    """Return per-word precision and recall terms from EMMA-2 for word-morpheme count matrices
+
+    The terms are arrays over the rows of the matrices, with NaN for
+    the words excluded from the averages.
+
+    """
+    morph_cooc_graph = morph_cooccurrences(gold_word_morpheme_graph, pred_word_morpheme_graph)
+    logger.debug(morph_cooc_graph.shape)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Morph co-occurrence graph:\n%s", morph_cooc_graph.toarray())
+    logger.info("Assigning morphs")
+    gold_assigned, pred_assigned = emma2_assignment_counts(morph_cooc_graph)
+    del morph_cooc_graph
+    logger.info("Calculating precision and recall")
+    pre, rec = assigned_morph_terms(gold_word_morpheme_graph, pred_word_morpheme_graph, gold_assigned, pred_assigned)
+    logger.debug(pre)
+    logger.debug(rec)
+    return pre, rec
+
+
+def emma2_scores(gold_word_morpheme_graph, pred_word_morpheme_graph):
+    """Return precision and recall from EMMA-2 for word-morpheme count matrices"""
+    pre, rec = emma2_terms(gold_word_morpheme_graph, pred_word_morpheme_graph)
+    return average_terms(pre), average_terms(rec)
 
 
-def emma2(goldlist, predlist):
-    """Return precision and recall from EMMA-2"""
+def emma2(goldlist, predlist, chunk_size=None):
+    """Return precision and recall from EMMA-2
+
+    With chunk_size, the words are processed in chunks of chunk_size
+    words to limit the memory usage (see chunked_emma_terms).
+
+    """
+    if chunk_size:
+        pre, rec = chunked_emma_terms(goldlist, predlist, chunk_size=chunk_size)
+        return average_terms(pre), average_terms(rec)
     windex = predlist.get_word_index()
     logger.info("Creating gold word-morpheme matrix")
     gold_word_morpheme_graph = goldlist.to_word_morpheme_matrix(windex, binary=False)
     logger.info("Creating pred word-morpheme matrix")
     pred_word_morpheme_graph = predlist.to_word_morpheme_matrix(windex, binary=False)
-    logger.info("Creating morph co-occurrence matrix")
-    morph_cooc_graph = gold_word_morpheme_graph.T @ pred_word_morpheme_graph  # size (M_gold, M_pred)
-    logger.debug(morph_cooc_graph.shape)
     logger.debug("Gold morphs: %s", goldlist.morphs)
     logger.debug("Pred morphs: %s", predlist.morphs)
-    logger.debug("Morph co-occurrence graph:\n%s", morph_cooc_graph.toarray())
-    logger.info("Calculating precision")
-    # When calculating precision, several predicted morphemes may assigned to one reference morpheme
-    assign = morph_assignment_matrix(morph_cooc_graph.T)
-    logger.debug("Pred word-morpheme matrix:\n%s", pred_word_morpheme_graph.toarray())
-    logger.debug("Assignments:\n%s", assign.toarray())
-    gold_to_pred = gold_word_morpheme_graph @ assign  # Gold mapped to pred morphs
-    logger.debug("Gold mapped to pred:\n%s", gold_to_pred.toarray())
-    pre = morph_graph_recall(pred_word_morpheme_graph, gold_to_pred)
-    logger.debug(pre)
-    logger.info("Calculating recall")
-    # When calculating recall, several reference morphemes may assigned to one predicted morpheme
-    assign = morph_assignment_matrix(morph_cooc_graph)
-    logger.debug("Gold word-morpheme matrix:\n%s", gold_word_morpheme_graph.toarray())
-    logger.debug("Assignments:\n%s", assign.toarray())
-    pred_to_gold = pred_word_morpheme_graph @ assign  # Gold mapped to pred morphs
-    logger.debug("Pred mapped to gold:\n%s", pred_to_gold.toarray())
-    rec = morph_graph_recall(gold_word_morpheme_graph, pred_to_gold)
-    logger.debug(rec)
+    return emma2_scores(gold_word_morpheme_graph, pred_word_morpheme_graph)
+
+
+def one_to_one_assignment(morph_cooc_graph):
+    """Return the maximum-weight one-to-one assignment between the rows and columns of a sparse matrix
+
+    Returns the row and column indices of the assigned pairs. A row
+    and a column that have no other non-zero elements than each other
+    are always assigned together. The rest are solved as a
+    minimum-weight full matching of the rows with the sparse bipartite
+    matching of SciPy: each row gets an extra column that stands for
+    leaving it unassigned, and the weights are turned into positive
+    costs, so the memory stays proportional to the number of non-zero
+    elements.
+
+    """
+    from scipy.sparse import csr_matrix, hstack, identity
+    from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+    # The order of the edges decides between equal assignments
+    matrix = csr_matrix(morph_cooc_graph, copy=True)
+    matrix.sum_duplicates()
+    matrix.sort_indices()
+    matrix.eliminate_zeros()
+    row_nnz = np.diff(matrix.indptr)
+    edge_rows = np.repeat(np.arange(matrix.shape[0]), row_nnz)
+    isolated = (row_nnz[edge_rows] == 1) & (np.bincount(matrix.indices, minlength=matrix.shape[1])[matrix.indices] == 1)
+    rows, columns = [edge_rows[isolated]], [matrix.indices[isolated].astype(np.int64)]
+    row_nnz[edge_rows[isolated]] = 0
+    active = np.flatnonzero(row_nnz)
+    if len(active):
+        matrix = matrix[active]
+        # An assigned edge costs its weight less than leaving the row unassigned
+        unassigned = float(matrix.data.max()) + 1
+        costs = csr_matrix((unassigned - matrix.data, matrix.indices, matrix.indptr), shape=matrix.shape)
+        costs = hstack([costs, identity(len(active), format='csr') * unassigned], format='csr')
+        _, matched = min_weight_full_bipartite_matching(costs)
+        assigned = np.flatnonzero(matched < matrix.shape[1])
+        rows.append(active[assigned])
+        columns.append(matched[assigned].astype(np.int64))
+    rows, columns = np.concatenate(rows), np.concatenate(columns)
+    order = np.argsort(rows, kind='stable')
+    return rows[order], columns[order]
+
+
+def emma_assignment_counts(morph_cooc_graph):
+    """Return the numbers of morphs assigned to each gold and predicted morph in EMMA
+
+    The same as emma2_assignment_counts, but the morphs are assigned
+    one-to-one to maximize the sum of their co-occurrence counts, so
+    the numbers are one for the assigned morphs and zero for the rest.
+
+    """
+    with phase('one-to-one-assignment') as counts:
+        gold_morphs, pred_morphs = one_to_one_assignment(morph_cooc_graph)
+        counts['assigned'] = len(gold_morphs)
+    gold_assigned = np.zeros(morph_cooc_graph.shape[0], dtype=np.int64)
+    gold_assigned[gold_morphs] = 1
+    pred_assigned = np.zeros(morph_cooc_graph.shape[1], dtype=np.int64)
+    pred_assigned[pred_morphs] = 1
+    return gold_assigned, pred_assigned
+
+
+def emma_terms(gold_word_morpheme_graph, pred_word_morpheme_graph):
+    """Return per-word precision and recall terms from EMMA for word-morpheme count matrices
+
+    The gold and predicted morphs are assigned one-to-one to maximize
+    the sum of their co-occurrence counts, and the terms are computed
+    from the numbers of assigned morphs as in EMMA-2. The terms are
+    arrays over the rows of the matrices, with NaN for the words
+    excluded from the averages.
+
+    """
+    morph_cooc_graph = morph_cooccurrences(gold_word_morpheme_graph, pred_word_morpheme_graph)
+    logger.info("Assigning morphs one-to-one")
+    gold_assigned, pred_assigned = emma_assignment_counts(morph_cooc_graph)
+    del morph_cooc_graph
+    logger.info("Calculating precision and recall")
+    return assigned_morph_terms(gold_word_morpheme_graph, pred_word_morpheme_graph, gold_assigned, pred_assigned)
+
+
+def emma_scores(gold_word_morpheme_graph, pred_word_morpheme_graph):
+    """Return precision and recall from EMMA for word-morpheme count matrices"""
+    pre, rec = emma_terms(gold_word_morpheme_graph, pred_word_morpheme_graph)
+    return average_terms(pre), average_terms(rec)
+
+
+def emma(goldlist, predlist, chunk_size=None):
+    """Return precision and recall from EMMA with one-to-one morph assignments
+
+    With chunk_size, the words are processed in chunks of chunk_size
+    words to limit the memory usage (see chunked_emma_terms).
+
+    """
+    if chunk_size:
+        pre, rec = chunked_emma_terms(goldlist, predlist, one_to_one=True, chunk_size=chunk_size)
+        return average_terms(pre), average_terms(rec)
+    windex = predlist.get_word_index()
+    logger.info("Creating word-morpheme matrices")
+    return emma_scores(goldlist.to_word_morpheme_matrix(windex, binary=False),
+                       predlist.to_word_morpheme_matrix(windex, binary=False))
+
+
+def word_morpheme_chunks(goldlist, predlist, chunk_size=CHUNK_WORDS, progress=None, task='word-morpheme-chunks'):
+    """Yield the gold and predicted word-morpheme count matrices of chunks of the predicted words
+
+    Yields (start, gold, pred) tuples, where start is the index of the
+    first word of the chunk in predlist. The progress of the chunks is
+    reported to progress as task.
+
+    """
+    starts = range(0, predlist.n_words, chunk_size)
+    for start in track(starts, progress, task, unit='chunks'):
+        words = predlist.words[start:start + chunk_size]
+        gold_ids = np.fromiter((goldlist.word_ids.get(word, -1) for word in words), dtype=np.int64, count=len(words))
+        yield (start, goldlist.word_morpheme_rows(gold_ids, binary=False),
+               predlist.word_morpheme_rows(np.arange(start, start + len(words)), binary=False))
+
+
+def chunked_emma_terms(goldlist, predlist, one_to_one=False, chunk_size=CHUNK_WORDS, progress=None):
+    """Return per-word precision and recall terms from EMMA-2 or EMMA computed in chunks of words
+
+    The terms are the same as from emma2_terms (or emma_terms if
+    one_to_one is True) for the word-morpheme count matrices of the
+    predicted words, but the matrices are built for chunk_size words
+    at a time. The first pass over the chunks accumulates the morph
+    co-occurrence matrix and the second computes the terms from the
+    numbers of assigned morphs, so the peak memory is bounded by the
+    co-occurrence matrix and the matrices of one chunk.
+
+    """
+    from scipy.sparse import csr_matrix
+    logger.info("Creating morph co-occurrence matrix in chunks of %s words", chunk_size)
+    with phase('morph-cooccurrences') as counts:
+        morph_cooc_graph = csr_matrix((goldlist.n_morphs, predlist.n_morphs), dtype=int)
+        chunks = word_morpheme_chunks(goldlist, predlist, chunk_size=chunk_size, progress=progress,
+                                      task='morph-cooccurrences')
+        for _, gold_chunk, pred_chunk in chunks:
+            morph_cooc_graph = morph_cooc_graph + gold_chunk.T @ pred_chunk
+        counts.update(nnz=int(morph_cooc_graph.nnz), chunk_size=chunk_size)
+    logger.info("Assigning morphs")
+    if one_to_one:
+        gold_assigned, pred_assigned = emma_assignment_counts(morph_cooc_graph)
+    else:
+        gold_assigned, pred_assigned = emma2_assignment_counts(morph_cooc_graph)
+    del morph_cooc_graph
+    logger.info("Calculating precision and recall in chunks of %s words", chunk_size)
+    pre, rec = np.empty(predlist.n_words), np.empty(predlist.n_words)
+    chunks = word_morpheme_chunks(goldlist, predlist, chunk_size=chunk_size, progress=progress,
+                                  task='emma' if one_to_one else 'emma-2')
+    for start, gold_chunk, pred_chunk in chunks:
+        rows = slice(start, start + gold_chunk.shape[0])
+        pre[rows], rec[rows] = assigned_morph_terms(gold_chunk, pred_chunk, gold_assigned, pred_assigned)
     return pre, rec
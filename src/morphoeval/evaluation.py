@@ -0,0 +1,287 @@
+"""Evaluation of several metrics with shared intermediate data structures"""
+
+import collections
+import json
+import logging
+
+import numpy as np
+
+from .boundary import bpr_strict_terms, bpr_terms, evaluated_words
+from .common import average_terms
+from .cooccurrence import (chunked_emma_terms, comma_strict_terms, emma2_terms, emma_terms, planned_word_graph_counts,
+                           word_graph_terms)
+from .profiling import phase
+
+
+logger = logging.getLogger(__name__)
+
+METRICS = ['comma-b0', 'comma-b1', 'comma-s0', 'comma-s1', 'emma', 'emma-2', 'bpr', 'bpr-s']
+
+# Word lists of the precision and recall terms of each metric
+TERM_WORDS = {'comma-b0': ('pred', 'pred'), 'comma-b1': ('pred', 'pred'), 'comma-s0': ('pred', 'pred'),
+              'comma-s1': ('pred', 'pred'), 'emma': ('pred', 'pred'), 'emma-2': ('pred', 'pred'),
+              'bpr': ('pred', 'gold'), 'bpr-s': ('gold', 'gold')}
+
+# Metrics whose terms are summed one by one instead of with NumPy
+SEQUENTIAL_METRICS = ('comma-s0', 'comma-s1', 'bpr', 'bpr-s')
+
+WordScores = collections.namedtuple('WordScores', ['metric', 'words', 'precisions', 'recalls', 'matchings',
+                                                   'matching_offsets'])
+WordScores.__doc__ = """Per-word precisions and recalls of a metric (see evaluate_words)"""
+
+
+def score_dict(pre, rec, beta=1):
+    """Return rounded scores for output"""
+    scores = {'precision': round(pre, 4), 'recall': round(rec, 4)}
+    fscore = (1 + beta**2) * pre * rec / (beta**2 * pre + rec) if pre + rec > 0 else 0
+    if beta == 1:
+        scores['f-score'] = round(fscore, 4)
+    else:
+        scores['f_beta-score'] = round(fscore, 4)
+        scores['beta'] = beta
+    return scores
+
+
+def word_morpheme_matrices(goldlist, predlist, binary=True, counts=None):
+    """Return gold and predicted word-morpheme matrices for the predicted words
+
+    If the count matrices are given, the binary matrices are derived
+    from them instead of building them from the analyses.
+
+    """
+    with phase('word-morpheme-matrices') as phase_counts:
+        if counts is None:
+            windex = predlist.get_word_index()
+            logger.info("Creating word-morpheme matrices")
+            matrices = (goldlist.to_word_morpheme_matrix(windex, binary=binary),
+                        predlist.to_word_morpheme_matrix(windex, binary=binary))
+        else:
+            matrices = []
+            for matrix in counts:
+                matrix = matrix.copy()
+                matrix.data[:] = 1
+                matrices.append(matrix)
+            matrices = tuple(matrices)
+        phase_counts.update(rows=matrices[0].shape[0], gold_nnz=int(matrices[0].nnz), pred_nnz=int(matrices[1].nnz))
+    return matrices
+
+
+def metric_terms(goldlist, predlist, metrics, beta=1, block_size=None, workers=None, matchings=False,
+                 memory_limit=None, chunk_size=None, progress=None, plans=None):
+    """Yield per-word precision and recall terms for each of the given metrics
+
+    The intermediate data structures are shared between the metrics
+    as described in evaluate. Yields (metric, precisions, recalls,
+    pairs) tuples in the order the metrics are computed. The terms
+    are arrays over the words given by TERM_WORDS: all predicted
+    words for CoMMA and EMMA, and the evaluated words (see
+    boundary.evaluated_words) of predlist or goldlist for BPR. The
+    words excluded from the averages have NaN terms. If matchings is
+    True, pairs contains the matched alternatives of the strict
+    metrics (see common.strict_matching); otherwise it is None. The
+    progress of the long loops is reported to progress (see the
+    progress module). If plans is a list, the WordGraphPlan chosen for
+    the CoMMA-B word graphs is appended to it.
+
+    """
+    unknown = set(metrics) - set(METRICS)
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(sorted(unknown))}")
+    counts = None
+    for metric, function in (('emma', emma_terms), ('emma-2', emma2_terms)):
+        if metric in metrics:
+            logger.info("Evaluating %s", metric)
+            with phase('metric:' + metric):
+                if chunk_size:
+                    terms = chunked_emma_terms(goldlist, predlist, one_to_one=metric == 'emma', chunk_size=chunk_size,
+                                               progress=progress)
+                else:
+                    if counts is None:
+                        counts = word_morpheme_matrices(goldlist, predlist, binary=False)
+                    terms = function(*counts)
+            yield (metric, *terms, None)
+    comma_b = [metric for metric in METRICS[:2] if metric in metrics]
+    if comma_b:
+        logger.info("Evaluating %s", ', '.join(comma_b))
+        with phase('metric:' + ','.join(comma_b)):
+            binary = word_morpheme_matrices(goldlist, predlist, counts=counts)
+            counts = None
+            graph_counts, plan = planned_word_graph_counts(*binary, block_size=block_size, memory_limit=memory_limit,
+                                                           progress=progress)
+            if plans is not None:
+                plans.append(plan)
+            del binary
+            terms = word_graph_terms(graph_counts, diagonals=[metric == 'comma-b1' for metric in comma_b])
+        for metric, (precisions, recalls) in zip(comma_b, terms):
+            yield metric, precisions, recalls, None
+    comma_s = [metric for metric in METRICS[2:4] if metric in metrics]
+    if comma_s:
+        logger.info("Evaluating %s", ', '.join(comma_s))
+        with phase('metric:' + ','.join(comma_s)):
+            terms = comma_strict_terms(goldlist, predlist, diagonals=[metric == 'comma-s1' for metric in comma_s],
+                                       beta=beta, workers=workers, matchings=matchings, progress=progress)
+        for metric, (precisions, recalls, *pairs) in zip(comma_s, terms):
+            yield metric, precisions, recalls, (pairs or [None])[0]
+    if 'bpr' in metrics:
+        logger.info("Evaluating bpr")
+        with phase('metric:bpr'):
+            terms = bpr_terms(goldlist, predlist, workers=workers, progress=progress)
+        yield ('bpr', *terms, None)
+    if 'bpr-s' in metrics:
+        logger.info("Evaluating bpr-s")
+        with phase('metric:bpr-s'):
+            precisions, recalls, *pairs = bpr_strict_terms(goldlist, predlist, beta=beta, workers=workers,
+                                                           matchings=matchings, progress=progress)
+        yield 'bpr-s', precisions, recalls, (pairs or [None])[0]
+
+
+def evaluate(goldlist, predlist, metrics, beta=1, block_size=None, workers=None, memory_limit=None, chunk_size=None,
+             progress=None, plans=None):
+    """Return precision and recall for each of the given metrics
+
+    The intermediate data structures are shared between the metrics:
+    the gold and predicted word-morpheme matrices are built once,
+    CoMMA-B0 and CoMMA-B1 use the same word graphs, and CoMMA-S0 and
+    CoMMA-S1 the same word similarity vectors. With workers, the
+    metrics that support it are computed in several processes. With
+    memory_limit in bytes, the construction of the CoMMA-B word graphs
+    is chosen to fit the limit (see planning.word_graph_plan), and if
+    plans is a list, the chosen WordGraphPlan is appended to it. With
+    chunk_size, EMMA and EMMA-2 are computed in chunks of chunk_size
+    words without the full word-morpheme matrices (see
+    cooccurrence.chunked_emma_terms). The progress of the long loops
+    is reported to progress (see the progress module). Returns a
+    dictionary from the metric names to (precision, recall) tuples.
+
+    """
+    results = {}
+    for metric, precisions, recalls, _ in metric_terms(goldlist, predlist, metrics, beta=beta, block_size=block_size,
+                                                       workers=workers, memory_limit=memory_limit,
+                                                       chunk_size=chunk_size, progress=progress, plans=plans):
+        sequential = metric in SEQUENTIAL_METRICS
+        results[metric] = (average_terms(precisions, sequential=sequential),
+                           average_terms(recalls, sequential=sequential))
+    return {metric: results[metric] for metric in metrics}
+
+
+def term_words(aset, metric):
+    """Return the words of aset that have terms for a metric (see TERM_WORDS)"""
+    if metric.startswith('bpr'):
+        return [aset.words[idx] for idx in evaluated_words(aset).tolist()]
+    return aset.words
+
+
+def alternative_counts(aset, words):
+    """Return the numbers of alternative analyses of the words in aset (zero for missing words)"""
+    word_idx = np.fromiter((aset.word_ids.get(word, -1) for word in words), dtype=np.int64, count=len(words))
+    return np.where(word_idx >= 0, np.diff(aset.word_offsets)[word_idx], 0)
+
+
+def evaluate_words(goldlist, predlist, metrics, beta=1, block_size=None, workers=None, memory_limit=None,
+                   chunk_size=None, progress=None, plans=None):
+    """Yield per-word scores for each of the given metrics
+
+    Yields a WordScores tuple for each metric as soon as it is
+    computed. The precisions and recalls are arrays over the words,
+    with NaN for the words excluded from the averages. For BPR, the
+    words are the evaluated gold words followed by the evaluated
+    predicted words missing from gold. For the strict metrics,
+    matchings contains the matched (gold, predicted) alternatives of
+    the words, those of word i in
+    matchings[matching_offsets[i]:matching_offsets[i + 1]]; for other
+    metrics, both are None. The plans are collected as in evaluate.
+    Returns the same dictionary as evaluate.
+
+    """
+    results = {}
+    for metric, precisions, recalls, pairs in metric_terms(goldlist, predlist, metrics, beta=beta,
+                                                           block_size=block_size, workers=workers, matchings=True,
+                                                           memory_limit=memory_limit, chunk_size=chunk_size,
+                                                           progress=progress, plans=plans):
+        sequential = metric in SEQUENTIAL_METRICS
+        results[metric] = (average_terms(precisions, sequential=sequential),
+                           average_terms(recalls, sequential=sequential))
+        pre_words, rec_words = (term_words(predlist if side == 'pred' else goldlist, metric)
+                                for side in TERM_WORDS[metric])
+        words = rec_words
+        if pre_words is not rec_words and pre_words != rec_words:
+            # Merge the precision terms to the recall words
+            index = {word: idx for idx, word in enumerate(rec_words)}
+            words = rec_words + [word for word in pre_words if word not in index]
+            index.update((word, idx) for idx, word in enumerate(words[len(rec_words):], len(rec_words)))
+            recalls = np.concatenate([recalls, np.full(len(words) - len(rec_words), np.nan)])
+            merged = np.full(len(words), np.nan)
+            merged[np.fromiter((index[word] for word in pre_words), dtype=np.int64, count=len(pre_words))] = precisions
+            precisions = merged
+        offsets = None
+        if pairs is not None:
+            n_matched = np.minimum(alternative_counts(goldlist, words), alternative_counts(predlist, words))
+            offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(n_matched)])
+        yield WordScores(metric, words, precisions, recalls, pairs, offsets)
+    return {metric: results[metric] for metric in metrics}
+
+
+def process_word_scores(word_scores, *callbacks):
+    """Call the callbacks with each WordScores from evaluate_words and return its results"""
+    while True:
+        try:
+            scores = next(word_scores)
+        except StopIteration as stop:
+            return stop.value
+        for callback in callbacks:
+            callback(scores)
+
+
+class WordScoreWriter:
+    """Write per-word scores to a JSONL or npz file
+
+    The format is selected by the file name: with the .npz suffix, the
+    arrays of each metric are stored with keys 'METRIC.words',
+    'METRIC.precisions', 'METRIC.recalls', and for the strict metrics
+    'METRIC.matchings' and 'METRIC.matching_offsets' (see
+    evaluate_words); the file is written when closed. Otherwise, each
+    word of each metric is written as a JSON object on its own line,
+    with null for the excluded terms.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.arrays = {} if path.endswith('.npz') else None
+        self.fobj = None if path.endswith('.npz') else open(path, 'w', encoding='utf-8')
+
+    def write(self, scores):
+        """Write the WordScores of a metric"""
+        if self.arrays is not None:
+            for field in WordScores._fields[1:]:
+                value = getattr(scores, field)
+                if value is not None:
+                    self.arrays[f'{scores.metric}.{field}'] = np.array(value) if field == 'words' else value
+            return
+        precisions = [None if np.isnan(value) else value for value in scores.precisions.tolist()]
+        recalls = [None if np.isnan(value) else value for value in scores.recalls.tolist()]
+        for idx, word in enumerate(scores.words):
+            item = {'metric': scores.metric, 'word': word, 'precision': precisions[idx], 'recall': recalls[idx]}
+            if scores.matchings is not None:
+                item['matching'] = scores.matchings[
+                    scores.matching_offsets[idx]:scores.matching_offsets[idx + 1]].tolist()
+            self.fobj.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+    def write_all(self, word_scores):
+        """Write all WordScores from a generator and return its return value (see evaluate_words)"""
+        return process_word_scores(word_scores, self.write)
+
+    def close(self):
+        """Close the file, writing it if needed"""
+        if self.arrays is not None:
+            np.savez(self.path, **self.arrays)
+            self.arrays = None
+        elif self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,418 @@
+"""Incremental re-evaluation of predictions that change only in part
+
+The precision and recall of each metric are averages of per-word
+terms. IncrementalEvaluator keeps the terms of the last evaluated
+predictions and, given new predictions, recomputes only the terms that
+may have changed:
+
+- BPR and BPR-S terms depend only on the analyses of the word itself.
+- CoMMA-B terms are computed from per-word sums over the rows of the
+  word graphs. The edges to the changed words are subtracted from the
+  sums using the old word graphs and added using the new ones, and
+  only the rows of the changed words are computed from scratch.
+- CoMMA-S terms are recomputed for the changed words and for the words
+  that share a morph with them.
+- EMMA and EMMA-2 terms depend on the morph assignments. The morph
+  co-occurrence matrix is updated by subtracting the old and adding
+  the new counts of the changed words, the assignments are made again,
+  and the terms are recomputed for the changed words and the words
+  with a morph whose number of assigned morphs changed.
+
+The averages are taken in the same word order and in the same way as
+in evaluate, so the results are equal to those of a full evaluation.
+
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy.sparse import coo_matrix, load_npz, save_npz
+
+from .boundary import best_boundary_recalls, boundary_data, evaluated_words, strict_boundary_scores, word_alternatives
+from .common import AnalysisSet, average_terms, segment_indices
+from .cooccurrence import (WordGraphCounts, assigned_morph_terms, comma_strict_shard, emma2_assignment_counts,
+                           emma_assignment_counts, word_graph_blocks, word_graph_counts_by_plan, word_graph_terms)
+from .evaluation import METRICS, SEQUENTIAL_METRICS, TERM_WORDS
+from .planning import word_graph_plan
+
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+
+Changes = collections.namedtuple('Changes', ['changed', 'added', 'removed'])
+Changes.__doc__ = """Words with changed analyses, new words, and removed words"""
+
+
+def analysis_digest(aset):
+    """Return a hash of the words and analyses of an analysis set"""
+    digest = hashlib.sha256()
+    for items in (aset.words, aset.morph_list):
+        digest.update('\n'.join(items).encode('utf-8'))
+        digest.update(b'\0')
+    for array in (aset.word_offsets, aset.alt_offsets, aset.morph_ids):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def morph_map(old, new):
+    """Return the ids in new of the morphs of old (-1 for missing morphs)"""
+    return np.fromiter((new.morphs.get(morph, -1) for morph in old.morph_list), dtype=np.int64, count=old.n_morphs)
+
+
+def word_indices(aset, words):
+    """Return the sorted indices of the given words that are in the analysis set"""
+    return np.unique(np.array([aset.word_ids[word] for word in words if word in aset.word_ids], dtype=np.int64))
+
+
+def translate_indices(aset, word_idx, other):
+    """Return the sorted indices in other of the words given by their indices in aset"""
+    return word_indices(other, (aset.words[idx] for idx in word_idx.tolist()))
+
+
+def occurrence_words(aset):
+    """Return the word index of each morph occurrence in morph_ids"""
+    alt_words = np.repeat(np.arange(aset.n_words), np.diff(aset.word_offsets))
+    return np.repeat(alt_words, np.diff(aset.alt_offsets))
+
+
+def morph_words(aset, morphs):
+    """Return the indices of the words containing any of the morphs given as a boolean mask"""
+    return np.unique(occurrence_words(aset)[morphs[aset.morph_ids]])
+
+
+def neighbour_words(aset, word_idx):
+    """Return the indices of the given words and the words sharing a morph with them"""
+    morphs = np.zeros(aset.n_morphs, dtype=bool)
+    morphs[aset.morph_ids[np.isin(occurrence_words(aset), word_idx)]] = True
+    return np.union1d(word_idx, morph_words(aset, morphs))
+
+
+def _segment_any(values, lengths):
+    """Return whether any of the values is true in each consecutive segment with the given lengths"""
+    cumulative = np.concatenate([[0], np.cumsum(values, dtype=np.int64)])
+    ends = np.cumsum(lengths)
+    return cumulative[ends] > cumulative[ends - lengths]
+
+
+def _realign(values, old_idx, fill):
+    """Return values of the old predicted words for the new words given their old indices"""
+    new_values = np.full(len(old_idx), fill, dtype=values.dtype)
+    new_values[old_idx >= 0] = values[old_idx[old_idx >= 0]]
+    return new_values
+
+
+def analysis_changes(old, new):
+    """Return the differences between two analysis sets as Changes
+
+    The alternatives of a word are compared in order, so reordering
+    them counts as a change.
+
+    """
+    old_idx = np.fromiter((old.word_ids.get(word, -1) for word in new.words), dtype=np.int64, count=new.n_words)
+    added = [new.words[idx] for idx in np.flatnonzero(old_idx < 0).tolist()]
+    removed = [word for word in old.words if word not in new.word_ids]
+    new_idx = np.flatnonzero(old_idx >= 0)
+    old_idx = old_idx[new_idx]
+    # Compare the numbers of alternatives, the lengths of the alternatives, and the morphs
+    n_alts = new.word_offsets[new_idx + 1] - new.word_offsets[new_idx]
+    same = n_alts == old.word_offsets[old_idx + 1] - old.word_offsets[old_idx]
+    n_alts = np.where(same, n_alts, 0)
+    new_alts = segment_indices(new.word_offsets[new_idx], n_alts)
+    old_alts = segment_indices(old.word_offsets[old_idx], n_alts)
+    new_lengths = new.alt_offsets[new_alts + 1] - new.alt_offsets[new_alts]
+    same &= ~_segment_any(new_lengths != old.alt_offsets[old_alts + 1] - old.alt_offsets[old_alts], n_alts)
+    new_starts = new.alt_offsets[new.word_offsets[new_idx]]
+    n_morphs = np.where(same, new.alt_offsets[new.word_offsets[new_idx + 1]] - new_starts, 0)
+    new_morphs = new.morph_ids[segment_indices(new_starts, n_morphs)]
+    old_morphs = morph_map(old, new)[old.morph_ids[segment_indices(old.alt_offsets[old.word_offsets[old_idx]], n_morphs)]]
+    same &= ~_segment_any(new_morphs != old_morphs, n_morphs)
+    changed = [new.words[idx] for idx in new_idx[~same].tolist()]
+    return Changes(changed, added, removed)
+
+
+class IncrementalEvaluator:
+    """Evaluate successive predictions against a gold standard incrementally
+
+    The first call of evaluate computes all per-word terms, and the
+    later calls recompute only the terms affected by the words whose
+    analyses changed since the previous call. The state can be saved
+    to a directory and loaded in a later run with from_saved. With
+    memory_limit in bytes, the construction of the CoMMA-B word graphs
+    is chosen to fit the limit as in evaluation.evaluate.
+
+    """
+
+    def __init__(self, goldlist, metrics, beta=1, block_size=None, memory_limit=None):
+        unknown = set(metrics) - set(METRICS)
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(sorted(unknown))}")
+        self.goldlist = goldlist
+        self.metrics = list(metrics)
+        self.beta = beta
+        self.block_size = block_size
+        self.memory_limit = memory_limit
+        self.predlist = None
+        # Precision and recall terms of each metric for the words given by TERM_WORDS
+        self.terms = {}
+        # Word graph counts of CoMMA-B for the predicted words
+        self.graph_counts = None
+        # Morph co-occurrence matrix of EMMA and EMMA-2 and for each of
+        # them the numbers of gold morphs assigned to each predicted
+        # morph and vice versa
+        self.cooc = None
+        self.assigned = {}
+        self._gold_digest = None
+
+    @property
+    def gold_digest(self):
+        """Hash of the gold standard analyses"""
+        if self._gold_digest is None:
+            self._gold_digest = analysis_digest(self.goldlist)
+        return self._gold_digest
+
+    def evaluate(self, predlist, plans=None):
+        """Return precision and recall for each metric as a dictionary
+
+        If plans is a list, the WordGraphPlan chosen for the CoMMA-B
+        word graphs is appended to it.
+
+        """
+        changes, old_idx = None, None
+        if self.predlist is None:
+            terms = {metric: [np.full(self._n_terms(words, predlist), np.nan) for words in TERM_WORDS[metric]]
+                     for metric in self.metrics}
+        else:
+            changes = analysis_changes(self.predlist, predlist)
+            logger.info("Re-evaluating %s changed, %s added, and %s removed words",
+                        len(changes.changed), len(changes.added), len(changes.removed))
+            old_idx = np.fromiter((self.predlist.word_ids.get(word, -1) for word in predlist.words),
+                                  dtype=np.int64, count=predlist.n_words)
+            terms = {metric: [_realign(values, old_idx, np.nan) if words == 'pred' else values.copy()
+                              for words, values in zip(TERM_WORDS[metric], self.terms[metric])]
+                     for metric in self.metrics}
+        if 'bpr' in self.metrics or 'bpr-s' in self.metrics:
+            self._update_boundary(predlist, changes, terms)
+        graph_counts = None
+        if any(metric in self.metrics for metric in METRICS[:4]):
+            graph_counts = self._update_comma(predlist, changes, old_idx, terms, plans)
+        cooc, assigned = None, {}
+        emma = [metric for metric in ('emma', 'emma-2') if metric in self.metrics]
+        if emma:
+            cooc, assigned = self._update_emma(predlist, changes, terms, emma)
+        self.predlist, self.terms = predlist, terms
+        self.graph_counts, self.cooc, self.assigned = graph_counts, cooc, assigned
+        return {metric: tuple(average_terms(values, sequential=metric in SEQUENTIAL_METRICS)
+                              for values in terms[metric]) for metric in self.metrics}
+
+    def _n_terms(self, words, predlist):
+        """Return the number of terms for a word list in TERM_WORDS"""
+        return predlist.n_words if words == 'pred' else self.goldlist.n_words
+
+    def _update_boundary(self, predlist, changes, terms):
+        """Update the terms of BPR and BPR-S"""
+        goldlist = self.goldlist
+        if changes is None:
+            gold_idx, pred_idx = evaluated_words(goldlist), evaluated_words(predlist)
+        else:
+            gold_idx = word_indices(goldlist, (word for word in changes.changed + changes.added + changes.removed
+                                               if len(word) > 1))
+            pred_idx = word_indices(predlist, (word for word in changes.changed + changes.added if len(word) > 1))
+        gold_data, pred_data = boundary_data(goldlist), boundary_data(predlist)
+        if 'bpr' in self.metrics:
+            pre, rec = terms['bpr']
+            if len(pred_idx):
+                pre[pred_idx] = best_boundary_recalls(pred_data, gold_data,
+                                                      *word_alternatives(predlist, goldlist, pred_idx)[1:])
+            if len(gold_idx):
+                rec[gold_idx] = best_boundary_recalls(gold_data, pred_data,
+                                                      *word_alternatives(goldlist, predlist, gold_idx)[1:])
+        if 'bpr-s' in self.metrics and len(gold_idx):
+            _, gold_first, n_gold, pred_first, n_pred = word_alternatives(goldlist, predlist, gold_idx)
+            if np.any(n_pred == 0):
+                raise ValueError(f"No predicted analyses for word {goldlist.words[gold_idx[np.argmax(n_pred == 0)]]}")
+            pre, rec = terms['bpr-s']
+            pre[gold_idx], rec[gold_idx] = strict_boundary_scores(gold_data, pred_data, gold_first, n_gold,
+                                                                  pred_first, n_pred, beta=self.beta)
+
+    def _update_graph_counts(self, predlist, changes, old_idx, gold_graph, pred_graph, plan):
+        """Return the word graph counts updated with the changed words
+
+        The edges to the changed words are subtracted from the counts
+        of the other words using the old word graphs and added using
+        the new ones, and the counts of the changed words are computed
+        from scratch.
+
+        """
+        counts = WordGraphCounts(*(_realign(values, old_idx, 0) for values in self.graph_counts))
+        old_to_new = np.full(self.predlist.n_words, -1, dtype=np.int64)
+        old_to_new[old_idx[old_idx >= 0]] = np.flatnonzero(old_idx >= 0)
+        old_index = self.predlist.get_word_index()
+        new_rows = word_indices(predlist, changes.changed + changes.added)
+        for sign, rows, targets, graphs in (
+                (-1, word_indices(self.predlist, changes.changed + changes.removed), old_to_new,
+                 (self.goldlist.to_word_morpheme_matrix(old_index), self.predlist.to_word_morpheme_matrix(old_index))),
+                (1, new_rows, np.arange(predlist.n_words), (gold_graph, pred_graph))):
+            keep = targets >= 0
+            # The word graphs are symmetric, so the rows of the changed words give their edges to all words
+            for _, gold_block, pred_block in word_graph_blocks(*graphs, block_size=plan.block_size, rows=rows):
+                for field, block in (('hits', gold_block.minimum(pred_block)), ('gold_totals', gold_block),
+                                     ('pred_totals', pred_block)):
+                    getattr(counts, field)[targets[keep]] += sign * np.asarray(block.sum(0)).ravel()[keep]
+        if len(new_rows):
+            for field, values in zip(WordGraphCounts._fields, word_graph_counts_by_plan(
+                    gold_graph, pred_graph, plan, rows=new_rows)):
+                getattr(counts, field)[new_rows] = values
+        return counts
+
+    def _comma_rows(self, predlist, changes):
+        """Return the indices of the words whose CoMMA-S terms may have changed"""
+        rows = [neighbour_words(predlist, word_indices(predlist, changes.changed + changes.added)),
+                translate_indices(self.predlist, neighbour_words(
+                    self.predlist, word_indices(self.predlist, changes.changed + changes.removed)), predlist)]
+        if changes.added or changes.removed:
+            # The gold similarities change for the words sharing a gold morph with the added or removed words
+            moved = word_indices(self.goldlist, changes.added + changes.removed)
+            rows.append(translate_indices(self.goldlist, neighbour_words(self.goldlist, moved), predlist))
+        return np.unique(np.concatenate(rows))
+
+    def _update_comma(self, predlist, changes, old_idx, terms, plans=None):
+        """Update the terms of CoMMA-B and CoMMA-S and return the word graph counts"""
+        comma_b = [metric for metric in METRICS[:2] if metric in self.metrics]
+        comma_s = [metric for metric in METRICS[2:4] if metric in self.metrics]
+        word_index = predlist.get_word_index()
+        counts = None
+        if comma_b:
+            gold_graph = self.goldlist.to_word_morpheme_matrix(word_index)
+            pred_graph = predlist.to_word_morpheme_matrix(word_index)
+            plan = word_graph_plan(gold_graph, pred_graph, memory_limit=self.memory_limit, block_size=self.block_size)
+            if plans is not None:
+                plans.append(plan)
+            if changes is None:
+                counts = word_graph_counts_by_plan(gold_graph, pred_graph, plan)
+            else:
+                counts = self._update_graph_counts(predlist, changes, old_idx, gold_graph, pred_graph, plan)
+            diagonals = [metric == 'comma-b1' for metric in comma_b]
+            for metric, pair in zip(comma_b, word_graph_terms(counts, diagonals=diagonals)):
+                terms[metric] = list(pair)
+        if comma_s:
+            rows = np.arange(predlist.n_words) if changes is None else self._comma_rows(predlist, changes)
+            logger.info("Re-evaluating CoMMA-S for %s words", len(rows))
+            if len(rows):
+                results = comma_strict_shard(self.goldlist, predlist, word_index,
+                                             [predlist.words[idx] for idx in rows.tolist()],
+                                             diagonals=[metric == 'comma-s1' for metric in comma_s], beta=self.beta)
+                for metric, (pre, pre_mask, rec, rec_mask) in zip(comma_s, results):
+                    terms[metric][0][rows] = np.where(pre_mask, pre, np.nan)
+                    terms[metric][1][rows] = np.where(rec_mask, rec, np.nan)
+        return counts
+
+    def _update_cooc(self, predlist, changes):
+        """Return the morph co-occurrence matrix updated with the changed words"""
+        old_index = {word: idx for idx, word in enumerate(changes.changed + changes.removed)}
+        new_index = {word: idx for idx, word in enumerate(changes.changed + changes.added)}
+        cooc = (self.cooc - self.goldlist.to_word_morpheme_matrix(old_index, binary=False).T
+                @ self.predlist.to_word_morpheme_matrix(old_index, binary=False)).tocoo()
+        # Move the columns to the morph ids of the new predictions
+        columns = morph_map(self.predlist, predlist)[cooc.col]
+        keep = (cooc.data != 0) & (columns >= 0)
+        cooc = coo_matrix((cooc.data[keep], (cooc.row[keep], columns[keep])),
+                          shape=(self.goldlist.n_morphs, predlist.n_morphs)).tocsr()
+        cooc = cooc + (self.goldlist.to_word_morpheme_matrix(new_index, binary=False).T
+                       @ predlist.to_word_morpheme_matrix(new_index, binary=False))
+        cooc.eliminate_zeros()
+        return cooc
+
+    def _update_emma(self, predlist, changes, terms, metrics):
+        """Update the terms of EMMA and EMMA-2 and return the new co-occurrence matrix and assignment counts"""
+        word_index = predlist.get_word_index()
+        gold_graph = self.goldlist.to_word_morpheme_matrix(word_index, binary=False)
+        pred_graph = predlist.to_word_morpheme_matrix(word_index, binary=False)
+        cooc = gold_graph.T @ pred_graph if changes is None else self._update_cooc(predlist, changes)
+        assigned = {}
+        for metric in metrics:
+            assignment_counts = emma_assignment_counts if metric == 'emma' else emma2_assignment_counts
+            pre_assigned, rec_assigned = assignment_counts(cooc)
+            assigned[metric] = (rec_assigned, pre_assigned)
+            if changes is None:
+                rows = np.arange(predlist.n_words)
+            else:
+                old_rec, old_pre = self.assigned[metric]
+                mapping = morph_map(self.predlist, predlist)
+                previous = np.zeros(predlist.n_morphs, dtype=old_rec.dtype)
+                previous[mapping[mapping >= 0]] = old_rec[mapping >= 0]
+                rows = np.unique(np.concatenate([
+                    word_indices(predlist, changes.changed + changes.added),
+                    morph_words(predlist, previous != rec_assigned),
+                    translate_indices(self.goldlist, morph_words(self.goldlist, old_pre != pre_assigned), predlist)]))
+            logger.info("Re-evaluating %s for %s words", metric, len(rows))
+            pre, rec = terms[metric]
+            pre[rows], rec[rows] = assigned_morph_terms(gold_graph[rows], pred_graph[rows], pre_assigned, rec_assigned)
+        return cooc, assigned
+
+    def save(self, directory):
+        """Save the state after the last evaluation to a directory
+
+        An existing directory is replaced only if it contains a saved
+        state.
+
+        """
+        if self.predlist is None:
+            raise ValueError("Nothing evaluated yet")
+        if os.path.exists(directory) and os.listdir(directory) and \
+                not os.path.isfile(os.path.join(directory, 'state.json')):
+            raise ValueError(f"Directory {directory} exists and does not contain a saved state")
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(directory)))
+        self.predlist.save(os.path.join(tmpdir, 'predictions'))
+        arrays = {f'{metric}.{direction}': values for metric, pair in self.terms.items()
+                  for direction, values in zip(('precision', 'recall'), pair)}
+        if self.graph_counts is not None:
+            arrays.update({f'comma-b.{field}': values for field, values in self.graph_counts._asdict().items()})
+        if self.cooc is not None:
+            save_npz(os.path.join(tmpdir, 'cooccurrence.npz'), self.cooc)
+        for metric, (rec_assigned, pre_assigned) in self.assigned.items():
+            arrays[f'{metric}.rec_assigned'], arrays[f'{metric}.pre_assigned'] = rec_assigned, pre_assigned
+        np.savez(os.path.join(tmpdir, 'terms.npz'), **arrays)
+        with open(os.path.join(tmpdir, 'state.json'), 'w', encoding='utf-8') as fobj:
+            json.dump({'version': STATE_VERSION, 'gold': self.gold_digest, 'metrics': self.metrics,
+                       'beta': self.beta}, fobj)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.rename(tmpdir, directory)
+
+    @classmethod
+    def from_saved(cls, directory, goldlist, metrics, beta=1, block_size=None, memory_limit=None):
+        """Create IncrementalEvaluator with the state saved in a directory
+
+        If the directory does not contain a state saved for the same
+        gold standard, beta, and the given metrics (or more), the
+        returned evaluator starts from scratch.
+
+        """
+        obj = cls(goldlist, metrics, beta=beta, block_size=block_size, memory_limit=memory_limit)
+        path = os.path.join(directory, 'state.json')
+        if not os.path.isfile(path):
+            return obj
+        with open(path, encoding='utf-8') as fobj:
+            state = json.load(fobj)
+        if state.get('version') != STATE_VERSION or state.get('beta') != beta or \
+                not set(obj.metrics) <= set(state.get('metrics', [])) or state.get('gold') != obj.gold_digest:
+            logger.info("Ignoring the state in %s saved for other gold standard or options", directory)
+            return obj
+        logger.info("Loading the state of the previous evaluation from %s", directory)
+        obj.predlist = AnalysisSet.from_saved(os.path.join(directory, 'predictions'))
+        with np.load(os.path.join(directory, 'terms.npz')) as arrays:
+            obj.terms = {metric: [arrays[f'{metric}.precision'], arrays[f'{metric}.recall']] for metric in obj.metrics}
+            if any(metric in obj.metrics for metric in METRICS[:2]):
+                obj.graph_counts = WordGraphCounts(*(arrays[f'comma-b.{field}'] for field in WordGraphCounts._fields))
+            emma = [metric for metric in ('emma', 'emma-2') if metric in obj.metrics]
+            if emma:
+                obj.assigned = {metric: (arrays[f'{metric}.rec_assigned'], arrays[f'{metric}.pre_assigned'])
+                                for metric in emma}
+                obj.cooc = load_npz(os.path.join(directory, 'cooccurrence.npz')).tocsr()
+        return obj
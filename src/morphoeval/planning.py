@@ -0,0 +1,135 @@
+"""Memory planning of the CoMMA-B word graph construction
+
+The word graphs of CoMMA-B can have up to n_words ** 2 non-zero
+elements, and building them at once runs out of memory for large
+inputs. Before building anything, the numbers of non-zero elements are
+bounded from the morph document frequencies (the numbers of words
+containing each morph), and the construction is chosen to fit a
+memory limit:
+
+- 'product': the full word graphs as sparse matrix products,
+- 'blocked': the word graphs for blocks of rows at a time, and
+- 'direct': one row at a time without sparse matrix products, which is
+  slow but stores only the neighbours of a single word.
+
+"""
+
+import collections
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ('product', 'blocked', 'direct')
+
+# Bytes per stored element of a CSR matrix with int64 values and int32 indices
+CSR_ELEMENT_BYTES = 12
+
+# Stored elements per word graph edge while computing the counts of a
+# block: the gold and predicted blocks, their minimum, and temporaries
+BLOCK_COPIES = 3
+
+# Bytes per word of the dense work arrays of the sparse products of a block
+PRODUCT_WORK_BYTES = 32
+
+# Bytes per word of the per-row counts and terms
+COUNT_BYTES = 80
+
+# Bytes per neighbour of the arrays used by the direct construction of a row
+DIRECT_NEIGHBOUR_BYTES = 64
+
+# Blocks smaller than this are computed with the direct construction
+MIN_BLOCK_SIZE = 64
+
+WordGraphPlan = collections.namedtuple('WordGraphPlan', ['engine', 'block_size', 'estimated_nnz', 'estimated_memory',
+                                                         'memory_limit'])
+WordGraphPlan.__doc__ = """Construction of the CoMMA-B word graphs chosen by word_graph_plan
+
+The engine is one of ENGINES, and block_size is the number of rows
+computed at a time (None for all rows and 1 for the direct engine).
+The estimated numbers of non-zero elements of the gold and predicted
+word graphs and the estimated peak memory in bytes are upper bounds.
+
+"""
+
+
+def row_nnz_bounds(word_morpheme_graph):
+    """Return upper bounds for the numbers of non-zero elements in the rows of a word graph
+
+    The bound for a word is the sum of the document frequencies of
+    its morphs, i.e. the number of words sharing each morph with it,
+    capped at the number of words.
+
+    """
+    n_rows = word_morpheme_graph.shape[0]
+    frequencies = np.bincount(word_morpheme_graph.indices, minlength=word_morpheme_graph.shape[1])
+    row_ids = np.repeat(np.arange(n_rows), np.diff(word_morpheme_graph.indptr))
+    bounds = np.bincount(row_ids, weights=frequencies[word_morpheme_graph.indices], minlength=n_rows)
+    return np.minimum(bounds.astype(np.int64), n_rows)
+
+
+def matrix_memory(matrix):
+    """Return the memory used by a CSR matrix and its transpose in bytes"""
+    return 2 * matrix.nnz * CSR_ELEMENT_BYTES + 8 * (sum(matrix.shape) + 2)
+
+
+def largest_block_size(row_memory, available):
+    """Return the largest number of consecutive rows whose memory stays within available bytes
+
+    Returns zero if not even a single row fits.
+
+    """
+    cumulative = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(row_memory)])
+    low, high = 0, len(row_memory)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if (cumulative[middle:] - cumulative[:-middle]).max() <= available:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def largest_block_memory(row_memory, block_size):
+    """Return the memory of the largest block of block_size rows in bytes"""
+    sums = np.add.reduceat(row_memory, np.arange(0, len(row_memory), block_size)) if len(row_memory) else [0]
+    return max(sums)
+
+
+def word_graph_plan(gold_word_morpheme_graph, pred_word_morpheme_graph, memory_limit=None, block_size=None):
+    """Return a WordGraphPlan for the word graphs of the word-morpheme graphs
+
+    A given block_size is always used. Otherwise, the full word graphs
+    are built if they are estimated to fit in memory_limit bytes (or
+    if there is no limit), blocks of rows if the largest block that
+    fits has at least MIN_BLOCK_SIZE rows, and single rows with the
+    direct construction if not. If even that is estimated to exceed
+    the limit, a warning is logged and the direct construction is
+    tried anyway.
+
+    """
+    n_rows = gold_word_morpheme_graph.shape[0]
+    row_nnz = row_nnz_bounds(gold_word_morpheme_graph) + row_nnz_bounds(pred_word_morpheme_graph)
+    row_memory = row_nnz * CSR_ELEMENT_BYTES * BLOCK_COPIES
+    fixed = matrix_memory(gold_word_morpheme_graph) + matrix_memory(pred_word_morpheme_graph) + n_rows * COUNT_BYTES
+    product_fixed = fixed + n_rows * PRODUCT_WORK_BYTES
+    estimated_nnz = int(row_nnz.sum())
+    if block_size is None and memory_limit is not None and product_fixed + row_memory.sum() > memory_limit:
+        block_size = largest_block_size(row_memory, memory_limit - product_fixed)
+        if block_size < MIN_BLOCK_SIZE:
+            memory = fixed + int(row_nnz.max(initial=0)) * DIRECT_NEIGHBOUR_BYTES
+            if memory > memory_limit:
+                logger.warning("The word graphs are estimated to need %s bytes even when computed one row at a time",
+                               memory)
+            return WordGraphPlan('direct', 1, estimated_nnz, memory, memory_limit)
+    if block_size is None or block_size >= n_rows:
+        return WordGraphPlan('product', None, estimated_nnz, product_fixed + int(row_memory.sum()), memory_limit)
+    memory = product_fixed + int(largest_block_memory(row_memory, block_size))
+    return WordGraphPlan('blocked', block_size, estimated_nnz, memory, memory_limit)
+
+
+def plan_dict(plan):
+    """Return a WordGraphPlan for output"""
+    return {field: value for field, value in plan._asdict().items() if value is not None}
@@ -0,0 +1,145 @@
+"""Timing and memory instrumentation of the evaluation phases
+
+The evaluation code marks its phases with the phase context manager.
+When no hooks are registered, the phases are not measured at all.
+Library users can register a hook with add_hook to receive a
+PhaseRecord at the end of each phase, or collect the records with a
+PhaseRecorder:
+
+    with PhaseRecorder() as recorder:
+        evaluate(goldlist, predlist, ['bpr'])
+    for record in recorder.records:
+        print(record.name, record.wall_time)
+
+"""
+
+import collections
+import contextlib
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+
+PhaseRecord = collections.namedtuple('PhaseRecord', ['name', 'depth', 'start', 'wall_time', 'cpu_time', 'max_rss',
+                                                     'traced_peak', 'counts'])
+PhaseRecord.__doc__ = """Measurements of a phase
+
+The start is given by time.perf_counter. The maximum resident set
+size of the process (max_rss) is in bytes, and the peak of the memory
+traced by tracemalloc during the phase (traced_peak) is None if
+tracemalloc is not tracing. The counts are numbers of items such as
+words or non-zero matrix elements.
+
+"""
+
+_HOOKS = []
+
+# Stack of the open phases of each thread
+_STATE = threading.local()
+
+
+def add_hook(hook):
+    """Register a function that is called with a PhaseRecord at the end of each phase"""
+    _HOOKS.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    """Unregister a hook function"""
+    _HOOKS.remove(hook)
+
+
+def max_rss():
+    """Return the maximum resident set size of the process in bytes, or None if not available"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+@contextlib.contextmanager
+def phase(name, **counts):
+    """Mark a phase of the evaluation
+
+    Yields a dictionary of item counts that the phase can update. If
+    hooks are registered, the wall time, CPU time, memory, and counts
+    of the phase are passed to them as a PhaseRecord at the end.
+
+    """
+    if not _HOOKS:
+        yield counts
+        return
+    stack = getattr(_STATE, 'stack', None)
+    if stack is None:
+        stack = _STATE.stack = []
+    tracing = tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+    if tracing:
+        # The peak of the enclosing phase so far, kept over the reset
+        if stack:
+            stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    stack.append(0)
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield counts
+    finally:
+        wall_time, cpu_time = time.perf_counter() - start, time.process_time() - cpu_start
+        enclosed_peak = stack.pop()
+        traced_peak = max(enclosed_peak, tracemalloc.get_traced_memory()[1]) if tracing else None
+        if tracing and stack:
+            stack[-1] = max(stack[-1], traced_peak)
+        record = PhaseRecord(name, len(stack), start, wall_time, cpu_time, max_rss(), traced_peak, dict(counts))
+        for hook in list(_HOOKS):
+            hook(record)
+
+
+class PhaseRecorder:
+    """Collect the PhaseRecords of the phases run within a with block
+
+    If trace_memory is True, tracemalloc is started for the block (if
+    not already tracing) to record the peak memory of each phase; this
+    slows down the Python loops considerably.
+
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.records = []
+        self._started_tracing = False
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        add_hook(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_hook(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def as_list(self):
+        """Return the records in the order the phases were started as dictionaries for output"""
+        output = []
+        for record in sorted(self.records, key=lambda record: (record.start, record.depth)):
+            item = {'phase': record.name, 'depth': record.depth, 'wall_time': round(record.wall_time, 6),
+                    'cpu_time': round(record.cpu_time, 6)}
+            if record.max_rss is not None:
+                item['max_rss'] = record.max_rss
+            if record.traced_peak is not None:
+                item['traced_peak'] = record.traced_peak
+            item.update(record.counts)
+            output.append(item)
+        return output
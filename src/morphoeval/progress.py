@@ -0,0 +1,100 @@
+"""Progress reporting of the long-running loops
+
+The functions with long loops take a progress argument: a function
+that is called with a ProgressEvent when the loop starts, as it
+advances, and when it finishes. By default, progress is None and the
+loops do no progress work at all. The command-line interface shows the
+events as tqdm progress bars (see TqdmProgress), and services can use
+any function that takes the structured events, e.g. rate-limited with
+RateLimited:
+
+    events = []
+    evaluate(goldlist, predlist, ['comma-s0'], progress=RateLimited(events.append, interval=1))
+
+"""
+
+import collections
+import time
+
+
+ProgressEvent = collections.namedtuple('ProgressEvent', ['task', 'done', 'total', 'unit', 'finished'])
+ProgressEvent.__doc__ = """Progress of a task
+
+The number of items done so far is given in unit (e.g. 'lines' or
+'words'), and total is None if not known in advance.
+
+"""
+
+
+def report(progress, task, done, total=None, unit='items', finished=False):
+    """Report a ProgressEvent to progress unless it is None"""
+    if progress is not None:
+        progress(ProgressEvent(task, done, total, unit, finished))
+
+
+def track(iterable, progress, task, total=None, unit='items'):
+    """Return an iterable that reports the progress of iterating over iterable
+
+    If progress is None, iterable is returned as is. The total is
+    taken from the length of iterable if not given.
+
+    """
+    if progress is None:
+        return iterable
+    if total is None and hasattr(iterable, '__len__'):
+        total = len(iterable)
+    return _tracked(iterable, progress, task, total, unit)
+
+
+def _tracked(iterable, progress, task, total, unit):
+    """Yield the items of iterable and report the progress after each"""
+    done = 0
+    progress(ProgressEvent(task, done, total, unit, False))
+    for item in iterable:
+        yield item
+        done += 1
+        progress(ProgressEvent(task, done, total, unit, False))
+    progress(ProgressEvent(task, done, total, unit, True))
+
+
+class RateLimited:
+    """Pass progress events on to a function at most once per interval seconds per task
+
+    The first and the final event of each task are always passed on.
+
+    """
+
+    def __init__(self, callback, interval=0.1):
+        self.callback = callback
+        self.interval = interval
+        self.last = {}
+
+    def __call__(self, event):
+        now = time.monotonic()
+        last = self.last.get(event.task)
+        if event.finished:
+            self.last.pop(event.task, None)
+        elif last is not None and now - last < self.interval:
+            return
+        else:
+            self.last[event.task] = now
+        self.callback(event)
+
+
+class TqdmProgress:
+    """Show progress events as tqdm progress bars, one for each running task"""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.bars = {}
+
+    def __call__(self, event):
+        import tqdm
+        bar = self.bars.get(event.task)
+        if bar is None:
+            bar = self.bars[event.task] = tqdm.tqdm(desc=event.task, total=event.total, unit=' ' + event.unit,
+                                                    **self.kwargs)
+        bar.update(event.done - bar.n)
+        if event.finished:
+            bar.close()
+            del self.bars[event.task]
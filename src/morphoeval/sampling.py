@@ -0,0 +1,210 @@
+"""Approximate CoMMA from a sample of the words
+
+The original Morpho Challenge evaluation compared sampled pairs of
+words instead of the full word graphs. Here, a random sample of the
+predicted words (rows of the word graphs) is evaluated exactly, and
+the averages over the sample estimate the averages over all words
+with a confidence interval. The sample is grown in batches until it
+reaches the requested size or the time budget is used, so that the
+estimate is refined until the deadline.
+
+"""
+
+import collections
+import logging
+import statistics
+import time
+
+import numpy as np
+
+from .common import average_terms, fscores
+from .cooccurrence import comma_strict_shard, word_graph_counts_by_plan, word_graph_terms
+from .evaluation import METRICS, evaluate, word_morpheme_matrices
+from .planning import word_graph_plan
+from .significance import score_names
+
+
+logger = logging.getLogger(__name__)
+
+ApproximateScores = collections.namedtuple('ApproximateScores', ['precision', 'recall', 'precision_interval',
+                                                                 'recall_interval', 'n_sampled', 'n_words'])
+ApproximateScores.__doc__ = """Estimated precision and recall with confidence intervals and the sample size"""
+
+
+def word_strata(aset, max_morphs=5):
+    """Return the number of morphs in the first analysis of each word, at most max_morphs, as sampling strata"""
+    first = aset.word_offsets[:-1]
+    return np.minimum(aset.alt_offsets[first + 1] - aset.alt_offsets[first], max_morphs)
+
+
+def sample_order(n_words, seed=None, strata=None):
+    """Return the order in which the words are sampled
+
+    Any prefix of the order is a simple random sample of the words.
+    If strata is given, the words of each stratum are spread evenly
+    over the order, so that any prefix is a stratified sample with
+    proportional allocation.
+
+    """
+    rng = np.random.default_rng(seed)
+    if strata is None:
+        return rng.permutation(n_words)
+    keys = np.zeros(n_words)
+    for stratum in np.unique(strata).tolist():
+        members = np.flatnonzero(strata == stratum)
+        keys[members] = (rng.permutation(len(members)) + rng.random(len(members))) / len(members)
+    return np.argsort(keys, kind='stable')
+
+
+def ratio_interval(terms, sample_strata, stratum_sizes, confidence=0.95):
+    """Return a confidence interval for the average of the terms over all words
+
+    The terms of the sampled words have NaN for the words excluded
+    from the average, so the average is estimated with a ratio
+    estimator. The variance is approximated with the stratified
+    formula including the finite population correction, given the
+    stratum of each sampled word and the numbers of words in each
+    stratum. The interval is clipped to [0, 1].
+
+    """
+    mask = ~np.isnan(terms)
+    if not mask.any():
+        return (1.0, 1.0) if len(terms) == stratum_sizes.sum() else (0.0, 1.0)
+    estimate = terms[mask].mean().item()
+    deviations = np.where(mask, terms - estimate, 0.0)
+    n_words = stratum_sizes.sum()
+    if np.any((stratum_sizes > 0) & (np.bincount(sample_strata, minlength=len(stratum_sizes)) == 0)):
+        return 0.0, 1.0
+    variance = 0.0
+    for stratum in np.unique(sample_strata).tolist():
+        values = deviations[sample_strata == stratum]
+        size = stratum_sizes[stratum]
+        if len(values) == size:
+            continue
+        if len(values) < 2:
+            return 0.0, 1.0
+        variance += (size / n_words) ** 2 * (1 - len(values) / size) * values.var(ddof=1) / len(values)
+    half_width = statistics.NormalDist().inv_cdf((1 + confidence) / 2) * np.sqrt(variance).item() / mask.mean().item()
+    return max(0.0, estimate - half_width), min(1.0, estimate + half_width)
+
+
+def approximate_comma_scores(goldlist, predlist, diagonals=(False,), strict=False, beta=1, sample_size=None,
+                             time_budget=None, seed=None, stratified=False, confidence=0.95, block_size=None,
+                             memory_limit=None, initial_batch=1000, plans=None):
+    """Return approximate CoMMA-B (or CoMMA-S if strict) scores from a sample of the predicted words
+
+    The words are evaluated in the random order given by sample_order
+    (stratified by word_strata if stratified is True), starting with
+    initial_batch words and doubling the batch size, until sample_size
+    words are evaluated or the time budget in seconds would be
+    exceeded. The first batch is always evaluated. The construction of
+    the CoMMA-B word graphs is chosen once for all batches from
+    block_size and memory_limit (see planning.word_graph_plan), and
+    if plans is a list, the chosen WordGraphPlan is appended to it.
+    Returns a list of ApproximateScores, one for each value in
+    diagonals; if all words are sampled, the scores equal those of the
+    exact evaluation.
+
+    """
+    start_time = time.perf_counter()
+    n_words = predlist.n_words
+    strata = word_strata(predlist) if stratified else np.zeros(n_words, dtype=np.int64)
+    order = sample_order(n_words, seed=seed, strata=strata if stratified else None)
+    limit = n_words if sample_size is None else min(sample_size, n_words)
+    if strict:
+        word_index = predlist.get_word_index()
+    else:
+        matrices = word_morpheme_matrices(goldlist, predlist)
+        plan = word_graph_plan(*matrices, memory_limit=memory_limit, block_size=block_size)
+        if plans is not None:
+            plans.append(plan)
+    terms = [([], []) for _ in diagonals]
+    n_sampled, batch = 0, initial_batch
+    while n_sampled < limit and batch > 0:
+        rows = order[n_sampled:min(n_sampled + batch, limit)]
+        batch_start = time.perf_counter()
+        if strict:
+            shard = comma_strict_shard(goldlist, predlist, word_index, [predlist.words[idx] for idx in rows.tolist()],
+                                       diagonals=diagonals, beta=beta)
+            batch_terms = [(np.where(pre_mask, pre, np.nan), np.where(rec_mask, rec, np.nan))
+                           for pre, pre_mask, rec, rec_mask in shard]
+        else:
+            counts = word_graph_counts_by_plan(*matrices, plan, rows=rows)
+            batch_terms = word_graph_terms(counts, diagonals=diagonals)
+        for (precisions, recalls), (batch_pre, batch_rec) in zip(terms, batch_terms):
+            precisions.append(batch_pre)
+            recalls.append(batch_rec)
+        n_sampled += len(rows)
+        now = time.perf_counter()
+        logger.info("Evaluated a sample of %s of %s words", n_sampled, n_words)
+        batch *= 2
+        if time_budget is not None:
+            # Estimate the number of words that can still be evaluated in time
+            rate = len(rows) / max(now - batch_start, 1e-9)
+            batch = min(batch, int((time_budget - (now - start_time)) * rate))
+    sampled = order[:n_sampled]
+    # Sum the terms in word order to get the exact results for a full sample
+    word_order = np.argsort(sampled, kind='stable')
+    stratum_sizes = np.bincount(strata, minlength=1)
+    results = []
+    for precisions, recalls in terms:
+        precisions = np.concatenate(precisions)[word_order]
+        recalls = np.concatenate(recalls)[word_order]
+        results.append(ApproximateScores(
+            average_terms(precisions, sequential=strict), average_terms(recalls, sequential=strict),
+            ratio_interval(precisions, strata[sampled][word_order], stratum_sizes, confidence=confidence),
+            ratio_interval(recalls, strata[sampled][word_order], stratum_sizes, confidence=confidence),
+            n_sampled, n_words))
+    return results
+
+
+def approximation_dict(scores, beta=1, confidence=0.95):
+    """Return the sample size and the confidence intervals of ApproximateScores for output
+
+    The interval of the F-score is obtained from those of precision and
+    recall, so its coverage is at least 1 - 2 * (1 - confidence).
+
+    """
+    pre_interval, rec_interval = np.array(scores.precision_interval), np.array(scores.recall_interval)
+    intervals = (pre_interval, rec_interval, fscores(pre_interval, rec_interval, beta=beta))
+    result = {'words': scores.n_sampled, 'total': scores.n_words, 'confidence': confidence}
+    for name, interval in zip(score_names(beta), intervals):
+        result[name] = [round(value, 4) for value in interval.tolist()]
+    return result
+
+
+def approximate_evaluate(goldlist, predlist, metrics, beta=1, sample_size=None, time_budget=None, seed=None,
+                         stratified=False, confidence=0.95, block_size=None, workers=None, chunk_size=None,
+                         memory_limit=None, plans=None):
+    """Return precision and recall for the metrics with approximate CoMMA
+
+    The CoMMA metrics are estimated from a sample of words (see
+    approximate_comma_scores) and the other metrics are evaluated
+    exactly. The time budget is shared by the CoMMA-B and CoMMA-S
+    evaluations, and memory_limit and plans apply to the sampled
+    CoMMA-B word graphs. Returns the same dictionary as evaluate and a
+    dictionary from the approximated metrics to their sample sizes
+    and confidence intervals (see approximation_dict).
+
+    """
+    exact = [metric for metric in metrics if not metric.startswith('comma')]
+    results = evaluate(goldlist, predlist, exact, beta=beta, block_size=block_size, workers=workers,
+                       chunk_size=chunk_size) if exact else {}
+    approximations = {}
+    groups = [group for group in ([metric for metric in METRICS[:2] if metric in metrics],
+                                  [metric for metric in METRICS[2:4] if metric in metrics]) if group]
+    start_time = time.perf_counter()
+    for idx, group in enumerate(groups):
+        budget = None
+        if time_budget is not None:
+            budget = (time_budget - (time.perf_counter() - start_time)) / (len(groups) - idx)
+        logger.info("Estimating %s", ', '.join(group))
+        scores = approximate_comma_scores(
+            goldlist, predlist, diagonals=[metric[-1] == '1' for metric in group],
+            strict=group[0].startswith('comma-s'), beta=beta, sample_size=sample_size, time_budget=budget,
+            seed=seed, stratified=stratified, confidence=confidence, block_size=block_size,
+            memory_limit=memory_limit, plans=plans)
+        for metric, metric_scores in zip(group, scores):
+            results[metric] = (metric_scores.precision, metric_scores.recall)
+            approximations[metric] = approximation_dict(metric_scores, beta=beta, confidence=confidence)
+    return {metric: results[metric] for metric in metrics}, approximations
@@ -0,0 +1,257 @@
+"""Evaluation server that keeps gold standards in memory
+
+The server speaks HTTP with JSON request and response bodies, either
+on a local TCP port or on a Unix socket:
+
+    GET  /golds       list the registered gold standards
+    PUT  /golds/NAME  register a gold standard: {"path": "gold.txt"}
+    POST /evaluate    evaluate predictions against a registered gold
+                      standard: {"gold": "NAME", "predictions": "pred.txt",
+                      "metrics": ["bpr"], "beta": 1}
+
+Instead of a file name in "predictions", the analyses can be sent in
+the Morpho Challenge format in "analyses". The gold standards are
+loaded when first needed, their derived data structures are built
+once (see AnalysisSet.precompute), and the least recently used ones
+are dropped when the memory limit is exceeded.
+
+"""
+
+import collections
+import concurrent.futures
+import http.server
+import io
+import json
+import logging
+import socketserver
+import sys
+import threading
+
+from .common import AnalysisSet
+from .evaluation import METRICS, evaluate, score_dict
+
+
+logger = logging.getLogger(__name__)
+
+
+def analysis_set_size(aset):
+    """Return a rough estimate of the memory used by an analysis set in bytes"""
+    size = sum(array.nbytes for array in (aset.word_offsets, aset.alt_offsets, aset.morph_ids))
+    # Strings and the dictionary entries that refer to them
+    size += sum(sys.getsizeof(item) + 100 for item in aset.words)
+    size += sum(sys.getsizeof(item) + 100 for item in aset.morph_list)
+    values = []
+    for value in aset._cache.values():  # pylint: disable=protected-access
+        values.extend(value if isinstance(value, tuple) else [value])
+    for value in values:
+        for item in (value if isinstance(value, list) else [value]):
+            if hasattr(item, 'indptr'):
+                size += item.data.nbytes + item.indices.nbytes + item.indptr.nbytes
+            elif hasattr(item, 'nbytes'):
+                size += item.nbytes
+    return size
+
+
+class GoldCache:
+    """Named gold standards loaded on demand
+
+    The loaded gold standards are kept in the order of use. When their
+    estimated total size exceeds memory_limit bytes, the least recently
+    used ones are dropped; they are loaded again from their files when
+    needed.
+
+    """
+
+    def __init__(self, memory_limit=None, cache_dir=None):
+        self.memory_limit = memory_limit
+        self.cache_dir = cache_dir
+        self.paths = {}
+        self.loaded = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, path):
+        """Register a gold standard file with a name"""
+        with self._lock:
+            if self.paths.get(name) != path:
+                self.loaded.pop(name, None)
+                self._loading.pop(name, None)
+            self.paths[name] = path
+
+    def get(self, name):
+        """Return the named gold standard, loading it if needed
+
+        The file is loaded without holding the lock, so that requests
+        for the other gold standards are not blocked meanwhile. Threads
+        asking for a gold standard that is being loaded wait for that
+        load instead of starting another one.
+
+        """
+        with self._lock:
+            if name not in self.paths:
+                raise KeyError(name)
+            if name in self.loaded:
+                self.loaded.move_to_end(name)
+                return self.loaded[name][0]
+            path = self.paths[name]
+            future = self._loading.get(name)
+            if future is not None:
+                owner = False
+            else:
+                future = self._loading[name] = concurrent.futures.Future()
+                owner = True
+        if not owner:
+            return future.result()
+        try:
+            logger.info("Loading gold standard %s from %s", name, path)
+            aset = AnalysisSet.from_file(path, cache_dir=self.cache_dir)
+            aset.precompute()
+            size = analysis_set_size(aset)
+        except BaseException as err:
+            with self._lock:
+                if self._loading.get(name) is future:
+                    del self._loading[name]
+            future.set_exception(err)
+            raise
+        with self._lock:
+            if self._loading.get(name) is future:
+                del self._loading[name]
+                self.loaded[name] = (aset, size)
+                while self.memory_limit and len(self.loaded) > 1 and \
+                        sum(size for _, size in self.loaded.values()) > self.memory_limit:
+                    evicted, _ = self.loaded.popitem(last=False)
+                    logger.info("Dropped gold standard %s from memory", evicted)
+        future.set_result(aset)
+        return aset
+
+    def info(self):
+        """Return a list of the registered gold standards"""
+        with self._lock:
+            return [{'name': name, 'path': path, 'loaded': name in self.loaded,
+                     'size': self.loaded[name][1] if name in self.loaded else None}
+                    for name, path in self.paths.items()]
+
+
+class Evaluator:
+    """Evaluate requests against gold standards in a GoldCache
+
+    At most max_concurrent evaluations are run at the same time;
+    further requests wait for their turn.
+
+    """
+
+    def __init__(self, golds, max_concurrent=1):
+        self.golds = golds
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    def evaluate(self, request):
+        """Evaluate a request dictionary and return the result dictionary
+
+        Raises KeyError for an unknown gold standard and ValueError for
+        an invalid request.
+
+        """
+        metrics = request.get('metrics', ['comma-b0'])
+        metrics = [metrics] if isinstance(metrics, str) else metrics
+        unknown = set(metrics) - set(METRICS)
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(sorted(unknown))}")
+        if ('predictions' in request) == ('analyses' in request):
+            raise ValueError("Give either predictions or analyses")
+        beta = request.get('beta', 1)
+        with self._slots:
+            goldlist = self.golds.get(request.get('gold'))
+            if 'predictions' in request:
+                predlist = AnalysisSet.from_file(request['predictions'], vocab=goldlist)
+            else:
+                predlist = AnalysisSet.from_file(io.StringIO(request['analyses']), vocab=goldlist)
+            results = evaluate(goldlist, predlist, metrics, beta=beta, block_size=request.get('block_size'))
+        return {'gold': request['gold'],
+                'metrics': {metric: {'scores': score_dict(pre, rec, beta=beta)} for metric, (pre, rec) in results.items()}}
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handler for the requests to the evaluation server"""
+
+    server_version = 'morphoeval'
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+        if not isinstance(body, dict):
+            raise ValueError("Request body is not a JSON object")
+        return body
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handle GET requests"""
+        if self.path == '/golds':
+            self._send(200, self.server.evaluator.golds.info())
+        else:
+            self._send(404, {'error': f"Not found: {self.path}"})
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """Handle PUT requests"""
+        name = self.path[len('/golds/'):] if self.path.startswith('/golds/') else ''
+        if not name:
+            self._send(404, {'error': f"Not found: {self.path}"})
+            return
+        try:
+            self.server.evaluator.golds.register(name, self._read_json()['path'])
+        except (KeyError, ValueError) as err:
+            self._send(400, {'error': f"Invalid request: {err}"})
+            return
+        self._send(200, {'name': name})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Handle POST requests"""
+        if self.path != '/evaluate':
+            self._send(404, {'error': f"Not found: {self.path}"})
+            return
+        try:
+            result = self.server.evaluator.evaluate(self._read_json())
+        except KeyError as err:
+            self._send(404, {'error': f"Unknown gold standard: {err}"})
+        except (OSError, ValueError) as err:
+            self._send(400, {'error': f"{type(err).__name__}: {err}"})
+        except Exception as err:  # pylint: disable=broad-except
+            logger.exception("Evaluation failed")
+            self._send(500, {'error': f"{type(err).__name__}: {err}"})
+        else:
+            self._send(200, result)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.info("%s %s", self.address_string(), format % args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server handling each request in a thread"""
+
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket handling each request in a thread"""
+
+    daemon_threads = True
+
+
+def make_server(evaluator, host='127.0.0.1', port=8765, socket_path=None):
+    """Return an evaluation server for a TCP port or a Unix socket"""
+    if socket_path:
+        server = ThreadingUnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.evaluator = evaluator
+    return server
@@ -0,0 +1,146 @@
+"""Bootstrap confidence intervals and paired significance tests
+
+Both are computed from the per-word precision and recall terms of the
+metrics (see evaluation.evaluate_words). A resample only changes which
+terms are included in the averages, so the resamples are evaluated in
+batches of matrix operations without computing the metrics again.
+
+"""
+
+import numpy as np
+
+from .common import fscores
+
+
+# Maximum number of per-word values of the resamples kept in memory at once
+MAX_BATCH_ELEMENTS = 1 << 23
+
+
+def batch_sizes(n_samples, n_words, max_elements=MAX_BATCH_ELEMENTS):
+    """Yield the numbers of resamples in batches of at most max_elements per-word values"""
+    size = max(1, max_elements // max(1, n_words))
+    for start in range(0, n_samples, size):
+        yield min(size, n_samples - start)
+
+
+def term_arrays(terms):
+    """Return the terms with zeros for NaN and a float mask of the terms that are not NaN"""
+    mask = ~np.isnan(terms)
+    return np.where(mask, terms, 0.0), mask.astype(np.float64)
+
+
+def term_averages(sums, counts):
+    """Return the averages of terms from their sums and counts (1.0 if there are no terms)"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, 1.0)
+
+
+def score_names(beta=1):
+    """Return the names of precision, recall, and F-score for output (see evaluation.score_dict)"""
+    return 'precision', 'recall', 'f-score' if beta == 1 else 'f_beta-score'
+
+
+def bootstrap_samples(precisions, recalls, n_samples, seed=None, max_elements=MAX_BATCH_ELEMENTS):
+    """Return the precisions and recalls of bootstrap resamples of the words
+
+    The precisions and recalls are per-word terms over the same words,
+    with NaN for the words excluded from the averages. Each resample
+    draws the words with replacement, and the same words are used for
+    precision and recall. Returns two arrays of n_samples values.
+
+    """
+    rng = np.random.default_rng(seed)
+    n_words = len(precisions)
+    if not n_words:
+        return np.ones(n_samples), np.ones(n_samples)
+    pre_values, pre_mask = term_arrays(precisions)
+    rec_values, rec_mask = term_arrays(recalls)
+    pre_samples, rec_samples = [], []
+    for size in batch_sizes(n_samples, n_words, max_elements=max_elements):
+        words = rng.integers(n_words, size=(size, n_words))
+        pre_samples.append(term_averages(pre_values[words].sum(1), pre_mask[words].sum(1)))
+        rec_samples.append(term_averages(rec_values[words].sum(1), rec_mask[words].sum(1)))
+    return np.concatenate(pre_samples), np.concatenate(rec_samples)
+
+
+def bootstrap_intervals(precisions, recalls, n_samples, beta=1, confidence=0.95, seed=None):
+    """Return bootstrap confidence intervals for precision, recall, and F-score
+
+    The per-word terms are resampled n_samples times (see
+    bootstrap_samples), and the percentile intervals are returned as
+    a dictionary for output.
+
+    """
+    pre_samples, rec_samples = bootstrap_samples(precisions, recalls, n_samples, seed=seed)
+    percentiles = [50 * (1 - confidence), 50 * (1 + confidence)]
+    intervals = {'samples': n_samples, 'confidence': confidence}
+    for name, samples in zip(score_names(beta),
+                             (pre_samples, rec_samples, fscores(pre_samples, rec_samples, beta=beta))):
+        intervals[name] = [round(value, 4) for value in np.percentile(samples, percentiles).tolist()]
+    return intervals
+
+
+def align_terms(scores_a, scores_b):
+    """Return the terms of two WordScores over the union of their words
+
+    Returns (precisions, recalls) tuples for both, with NaN for the
+    words missing from one of them.
+
+    """
+    index = {word: idx for idx, word in enumerate(scores_a.words)}
+    for word in scores_b.words:
+        index.setdefault(word, len(index))
+    aligned = []
+    for scores in (scores_a, scores_b):
+        rows = np.fromiter((index[word] for word in scores.words), dtype=np.int64, count=len(scores.words))
+        terms = []
+        for values in (scores.precisions, scores.recalls):
+            full = np.full(len(index), np.nan)
+            full[rows] = values
+            terms.append(full)
+        aligned.append(tuple(terms))
+    return tuple(aligned)
+
+
+def randomization_test(terms_a, terms_b, n_samples, beta=1, seed=None, max_elements=MAX_BATCH_ELEMENTS):
+    """Paired approximate randomization test between two systems
+
+    The terms are (precisions, recalls) tuples of the systems over the
+    same words (see align_terms). In each resample, the terms of each
+    word are swapped between the systems with probability 0.5; the
+    sums of the swapped averages are obtained with one matrix product
+    per batch of resamples. Returns the differences of precision,
+    recall, and F-score (b minus a) and their two-sided p-values, the
+    smoothed fractions of resamples with an absolute difference at
+    least as large.
+
+    """
+    rng = np.random.default_rng(seed)
+    arrays = [term_arrays(terms) for terms in terms_a + terms_b]
+    # Sums and counts of precision and recall terms for both systems
+    sums = [values.sum() for values, _ in arrays]
+    counts = [mask.sum() for _, mask in arrays]
+    changes = np.stack([arrays[2][0] - arrays[0][0], arrays[2][1] - arrays[0][1],
+                        arrays[3][0] - arrays[1][0], arrays[3][1] - arrays[1][1]], axis=1)
+    averages = term_averages(np.array(sums), np.array(counts))
+    observed = np.array([averages[2] - averages[0], averages[3] - averages[1],
+                         (fscores(averages[2:3], averages[3:4], beta=beta) -
+                          fscores(averages[0:1], averages[1:2], beta=beta))[0]])
+    n_words = len(changes)
+    extreme = np.zeros(3, dtype=np.int64)
+    for size in batch_sizes(n_samples, n_words, max_elements=max_elements):
+        swaps = (rng.random((size, n_words)) < 0.5).astype(np.float64)
+        # Changes in the sums and counts of precision and recall terms of system a
+        delta = swaps @ changes
+        pre_a = term_averages(sums[0] + delta[:, 0], counts[0] + delta[:, 1])
+        rec_a = term_averages(sums[1] + delta[:, 2], counts[1] + delta[:, 3])
+        pre_b = term_averages(sums[2] - delta[:, 0], counts[2] - delta[:, 1])
+        rec_b = term_averages(sums[3] - delta[:, 2], counts[3] - delta[:, 3])
+        differences = np.stack([pre_b - pre_a, rec_b - rec_a,
+                                fscores(pre_b, rec_b, beta=beta) - fscores(pre_a, rec_a, beta=beta)], axis=1)
+        # Allow for rounding errors in the sums
+        extreme += (np.abs(differences) >= np.abs(observed) - 1e-12).sum(0)
+    names = score_names(beta)
+    return {'samples': n_samples,
+            'difference': {name: round(value, 4) for name, value in zip(names, observed.tolist())},
+            'p-value': {name: round(value, 4) for name, value in zip(names, ((extreme + 1) / (n_samples + 1)).tolist())}}
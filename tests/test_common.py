@@ -1,9 +1,17 @@
 """Unit tests for morphoeval.cooccurrence"""
 
+import bz2
+import gzip
+import io
+import lzma
+import os
+import tempfile
 import unittest
 
 from numpy.testing import assert_array_equal
 
+from scipy.optimize import linear_sum_assignment
+
 from morphoeval.common import *
 
 
@@ -45,3 +53,228 @@ class TestAnalysisSet(unittest.TestCase):
         sim_mat = aset.word_similarity_matrix('koirakin', windex)
         self.assertEqual(sim_mat.shape, (7, 2))
 
+    def test_compact_storage(self):
+        aset = self._create_set({
+            'koira': [['koira']],
+            'koirakin': [['koira', 'kin'], ['koi', 'raki', 'n']],
+            'kissa': [['kissa']],
+        })
+        # Alternative for an earlier word added after the others
+        aset.add('koira', ['koi', 'ra'])
+        self.assertEqual(aset.n_words, 3)
+        self.assertEqual(aset.n_morphs, 7)
+        self.assertEqual(aset.morphs, {'koira': 0, 'kin': 1, 'koi': 2, 'n': 3, 'raki': 4, 'kissa': 5, 'ra': 6})
+        assert_array_equal(aset.word_offsets, [0, 2, 4, 5])
+        assert_array_equal(aset.alt_offsets, [0, 1, 3, 5, 8, 9])
+        assert_array_equal(aset.morph_ids, [0, 2, 6, 0, 1, 2, 4, 3, 5])
+        self.assertEqual(aset.morph_ids.dtype, np.int32)
+        self.assertEqual(list(aset.analyses), ['koira', 'koirakin', 'kissa'])
+        self.assertEqual(aset.analyses['koira'], [['koira'], ['koi', 'ra']])
+        self.assertIsInstance(aset.analyses['koira'][0], MorphSeq)
+        self.assertEqual(aset.analyses['koirakin'], [['koira', 'kin'], ['koi', 'raki', 'n']])
+        aset.add('kissan', ['kissa', 'n'])
+        self.assertEqual(aset.analyses['kissan'], [['kissa', 'n']])
+        assert_array_equal(aset.word_offsets, [0, 2, 4, 5, 6])
+
+    def test_save(self):
+        aset = self._create_set({
+            'koira': [['koira']],
+            'koirakin': [['koira', 'kin'], ['koi', 'raki', 'n']],
+            'kissa': [['kissa']],
+        })
+        with tempfile.TemporaryDirectory() as tmpdir:
+            aset.save(tmpdir)
+            saved = AnalysisSet.from_saved(tmpdir)
+            self.assertEqual(saved.words, aset.words)
+            self.assertEqual(saved.morphs, aset.morphs)
+            assert_array_equal(saved.word_offsets, aset.word_offsets)
+            assert_array_equal(saved.alt_offsets, aset.alt_offsets)
+            assert_array_equal(saved.morph_ids, aset.morph_ids)
+            self.assertEqual(dict(saved.analyses), dict(aset.analyses))
+            saved.add('kissan', ['kissa', 'n'])
+            self.assertEqual(saved.analyses['kissan'], [['kissa', 'n']])
+            self.assertEqual(saved.n_words, 4)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'gold.txt')
+            with open(path, 'w', encoding='utf-8') as fobj:
+                fobj.write('koira\tkoira\nkoiran\tkoira n, koi ran\nkissa\tkissa\n')
+            cache_dir = os.path.join(tmpdir, 'cache')
+            with open(path, encoding='utf-8') as fobj:
+                aset = AnalysisSet.from_file(fobj, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            with open(path, encoding='utf-8') as fobj:
+                cached = AnalysisSet.from_file(fobj, cache_dir=cache_dir)
+            self.assertIsInstance(cached.word_offsets, np.memmap)
+            self.assertEqual(dict(cached.analyses), dict(aset.analyses))
+            with open(path, encoding='utf-8') as fobj:
+                filtered = AnalysisSet.from_file(fobj, vocab={'koiran'}, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            self.assertEqual(filtered.words, ['koiran'])
+            # Streams without a file name are not cached
+            aset = AnalysisSet.from_file(io.StringIO('koira\tkoira\n'), cache_dir=cache_dir)
+            self.assertEqual(aset.words, ['koira'])
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def _assert_same_sets(self, aset, other):
+        self.assertEqual(aset.words, other.words)
+        self.assertEqual(aset.morphs, other.morphs)
+        assert_array_equal(aset.word_offsets, other.word_offsets)
+        assert_array_equal(aset.alt_offsets, other.alt_offsets)
+        assert_array_equal(aset.morph_ids, other.morph_ids)
+
+    def test_load(self):
+        data = ('# comment\n'
+                'koirakin\tkoira kin, koi raki n\n'
+                'kissa\tkissa\n'
+                'koira\tkoira, koi ra\n'
+                'tyhjä\t\n'
+                'kissa\tkis sa\n'
+                'kissan\tkissa  n\n')
+        expected = AnalysisSet()
+        for line in data.splitlines()[1:]:
+            word, rest = line.split('\t')
+            for alternative in rest.split(', '):
+                expected.add(word, alternative.split())
+        for chunk_size in (5, 1000):
+            aset = AnalysisSet()
+            aset.load(io.StringIO(data), chunk_size=chunk_size)
+            self._assert_same_sets(aset, expected)
+            aset = AnalysisSet()
+            aset.load(data.splitlines(keepends=True), chunk_size=2)
+            self._assert_same_sets(aset, expected)
+        self.assertEqual(expected.analyses['kissa'], [['kissa'], ['kis', 'sa']])
+        aset = AnalysisSet.from_file(io.StringIO(data), vocab={'kissa', 'koira'})
+        self.assertEqual(aset.words, ['kissa', 'koira'])
+        self.assertEqual(aset.morph_list, ['kissa', 'koira', 'koi', 'ra', 'kis', 'sa'])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'gold.txt')
+            with open(path, 'w', encoding='utf-8') as fobj:
+                fobj.write(data * 3)
+            aset = AnalysisSet()
+            aset.load_parallel(path, 2, encoding='utf-8')
+            with open(path, encoding='utf-8') as fobj:
+                self._assert_same_sets(aset, AnalysisSet.from_file(fobj))
+        with self.assertRaises(ValueError):
+            AnalysisSet.from_file(io.StringIO('koira\tkoira\nkissa kissa\n'))
+
+    def test_compressed_input(self):
+        data = 'koira\tkoira\nkoiran\tkoira n, koi ran\n'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for suffix, module in (('', None), ('.gz', gzip), ('.bz2', bz2), ('.xz', lzma)):
+                path = os.path.join(tmpdir, 'gold.txt' + suffix)
+                with (module.open(path, 'wt', encoding='utf-8') if module else open(path, 'w', encoding='utf-8')) as fobj:
+                    fobj.write(data)
+                with open_analysis_file(path, encoding='utf-8') as fobj:
+                    self.assertEqual(fobj.read(), data)
+                aset = AnalysisSet.from_file(path)
+                self.assertEqual(aset.analyses['koiran'], [['koira', 'n'], ['koi', 'ran']])
+
+    def test_precompute(self):
+        aset = self._create_set({
+            'koira': [['koira']],
+            'koirakin': [['koira', 'kin'], ['koi', 'raki', 'n']],
+            'kissa': [['kissa']],
+        })
+        word_index = {'kissa': 0, 'koira': 1, 'hiiri': 2}
+        expected = [aset.to_word_morpheme_matrix(word_index, binary=binary) for binary in (True, False)]
+        aset.precompute()
+        for binary, matrix in zip((True, False), expected):
+            assert_array_equal(aset.to_word_morpheme_matrix(word_index, binary=binary).toarray(), matrix.toarray())
+        aset.add('kissan', ['kissa', 'n'])
+        self.assertEqual(aset.to_word_morpheme_matrix({'kissan': 0}).toarray().sum(), 2)
+
+    def test_missing_word(self):
+        aset = self._create_set({'koira': [['koira']]})
+        self.assertNotIn('kissa', aset)
+        with self.assertRaises(KeyError):
+            aset.analyses['kissa']  # pylint: disable=pointless-statement
+        self.assertEqual(aset.analyses.get('kissa', []), [])
+        self.assertNotIn('kissa', aset.analyses)
+        self.assertEqual(len(aset.analyses), 1)
+
+    def test_word_morpheme_matrix(self):
+        aset = self._create_set({
+            'koira': [['koira']],
+            'koirakin': [['koira', 'kin'], ['koi', 'raki', 'n']],
+            'kissassa': [['kissa', 'ssa', 'ssa']],
+        })
+        windex = {'kissassa': 0, 'koirakin': 1, 'hiiri': 2}
+        # morphs: koira, kin, koi, n, raki, kissa, ssa
+        assert_array_equal(aset.to_word_morpheme_matrix(windex).toarray(),
+                           [[0, 0, 0, 0, 0, 1, 1], [1, 1, 1, 1, 1, 0, 0], [0, 0, 0, 0, 0, 0, 0]])
+        assert_array_equal(aset.to_word_morpheme_matrix(windex, binary=False).toarray(),
+                           [[0, 0, 0, 0, 0, 1, 2], [1, 1, 1, 1, 1, 0, 0], [0, 0, 0, 0, 0, 0, 0]])
+        windex = {'kissassa': 0, 'koirakin': 1}
+        selected = {'kissassa': 0, 'koirakin': 1}
+        assert_array_equal(aset.to_word_morpheme_matrix(windex, selected_alternatives=selected).toarray(),
+                           [[0, 0, 0, 0, 0, 1, 1], [0, 0, 1, 1, 1, 0, 0]])
+
+    def test_word_similarity_matrix(self):
+        aset = self._create_set({
+            'koira': [['koira']],
+            'koirakin': [['koira', 'kin'], ['koi', 'raki', 'n']],
+            'kissassa': [['kissa', 'ssa', 'ssa']],
+            'ssassa': [['ssa', 'ssa', 'ssa']],
+            'koin': [['koi', 'n']],
+        })
+        # Words missing from the index are skipped
+        windex = {'koira': 0, 'koirakin': 1, 'kissassa': 2, 'koin': 3}
+        assert_array_equal(aset.word_similarity_matrix('koirakin', windex).toarray(),
+                           [[1, 0], [0, 0], [0, 0], [0, 2]])
+        assert_array_equal(aset.word_similarity_matrix('koirakin', windex, diagonals=True).toarray(),
+                           [[1, 0], [2, 3], [0, 0], [0, 2]])
+        assert_array_equal(aset.word_similarity_matrix('ssassa', windex).toarray(),
+                           [[0], [0], [2], [0]])
+        self.assertEqual(aset.word_similarity_matrix('hiiri', windex).shape, (4, 0))
+
+    def test_boundary_vectors(self):
+        aset = self._create_set({
+            'koira': [['koira']],
+            'koirakin': [['koira', 'kin'], ['koi', 'raki', 'n']],
+            'a': [['a']],
+        })
+        vectors, offsets = aset.boundary_vectors()
+        self.assertEqual(vectors.dtype, np.uint8)
+        assert_array_equal(offsets, [0, 4, 11, 18, 18])
+        for idx, mseq in enumerate(aset.analyses['koira'] + aset.analyses['koirakin'] + aset.analyses['a']):
+            assert_array_equal(vectors[offsets[idx]:offsets[idx + 1]], mseq.boundaries())
+
+
+class TestAssignment(unittest.TestCase):
+
+    def test_assignment_batch(self):
+        rng = np.random.default_rng(1)
+        for n_rows, n_cols in [(1, 1), (1, 3), (3, 2), (3, 3), (4, 7), (8, 8)]:
+            costs = rng.random((5, n_rows, n_cols))
+            rows, cols = assignment_batch(costs)
+            self.assertEqual(rows.shape, (5, min(n_rows, n_cols)))
+            for idx in range(5):
+                expected = costs[idx][linear_sum_assignment(costs[idx])].sum()
+                self.assertAlmostEqual(costs[idx, rows[idx], cols[idx]].sum(), expected)
+                assert_array_equal(rows[idx], np.sort(rows[idx]))
+                self.assertEqual(len(set(cols[idx])), len(cols[idx]))
+
+    def test_strict_matching(self):
+        # Two words: 2x2 with a clear optimum, 1x2 with tied optima
+        precisions = np.array([1.0, 0.0, 0.0, 0.5, 1.0, 0.0])
+        recalls = np.array([1.0, 0.0, 0.0, 0.5, 0.0, 1.0])
+        pre_sums, rec_sums = strict_matching(precisions, recalls, np.array([0, 4]),
+                                             np.array([2, 1]), np.array([2, 2]))
+        assert_array_equal(pre_sums, [1.5, 1.0])
+        assert_array_equal(rec_sums, [1.5, 0.0])
+        costs = 1 - fscores(precisions[4:], recalls[4:]).reshape(1, 1, 2)
+        values = np.stack([precisions[4:], recalls[4:]], axis=-1).reshape(1, 1, 2, 2)
+        assert_array_equal(ambiguous_assignments(costs, values), [True])
+
+    def test_strict_matching_large(self):
+        # Too many matchings for enumeration; the tied optima have different sums
+        rng = np.random.default_rng(8)
+        precisions = rng.integers(0, 3, 49) / 2
+        recalls = rng.integers(0, 3, 49) / 2
+        pre_sums, rec_sums = strict_matching(precisions, recalls, np.array([0]), np.array([7]), np.array([7]))
+        costs = (1 - fscores(precisions, recalls)).reshape(7, 7)
+        rows, cols = munkres_assignment(costs)
+        self.assertEqual(pre_sums[0], precisions.reshape(7, 7)[rows, cols].sum())
+        self.assertEqual(rec_sums[0], recalls.reshape(7, 7)[rows, cols].sum())